@@ -1,3 +1,5 @@
 from .models import *
 from .motion import *
 from .motion_vectorized import *
+from .kinematics import *
+from .batch_model import *
@@ -0,0 +1,205 @@
+'''
+Batched simulation of the Paramecium model in pure NumPy (no Brian 2).
+
+This is the model of `paramecium_equations` (see `models.py`), with
+dv/dt = (IL+ICa_cilia+IK+IKCa_cilia+I)/C, integrated for N cells and P parameter sets at once.
+State variables are (P,N) arrays of floats in SI units (volt, amp, second, molar), with one row per
+parameter set.
+
+Integration methods:
+* `euler`: forward Euler, as Brian 2 does with these equations (same results up to rounding)
+* `exponential_euler`: exponential Euler for the gating variables n_IK and m_Ca_cilia
+  (Euler for v and pCa), which is more stable at large time steps
+'''
+import numpy as np
+from brian2 import Quantity
+from .models import paramecium_constants
+
+__all__ = ['unitless_constants', 'stack_constants', 'simulate_paramecium']
+
+state_variables = ['v', 'n_IK', 'm_Ca_cilia', 'pCa']
+recordable_variables = state_variables + ['Cai_cilia', 'IK', 'ICa_cilia', 'IKCa_cilia', 'I',
+                                          'velocity', 'theta', 'omega']
+
+def unitless_constants(constants):
+    '''
+    Returns a dictionary of constants as floats in SI units (non-numerical entries, e.g. names, are dropped).
+    `constants` is a dictionary (e.g. `paramecium_constants(name)`) or the name of a cell.
+    '''
+    if not isinstance(constants, dict):
+        constants = paramecium_constants(constants)
+    unitless = {}
+    for key, value in constants.items():
+        if isinstance(value, Quantity) or np.isscalar(value) and not isinstance(value, str):
+            unitless[key] = float(value)
+    return unitless
+
+def stack_constants(constant_sets):
+    '''
+    Stacks P sets of constants (dictionaries or cell names) into a dictionary of (P,1) arrays,
+    which broadcast against (P,N) state arrays.
+    Only the constants common to all sets are kept.
+    '''
+    constant_sets = [unitless_constants(constants) for constants in constant_sets]
+    keys = set.intersection(*[set(constants.keys()) for constants in constant_sets])
+    return {key: np.array([constants[key] for constants in constant_sets])[:,None] for key in keys}
+
+def simulate_paramecium(duration, I, constants=None, N=None, dt=1e-4, method='euler',
+                        record=('velocity', 'theta', 'omega'), record_every=1, init=None):
+    '''
+    Simulates the Paramecium model for N cells and P parameter sets.
+    Quantities are floats in SI units.
+
+    `duration` : duration of the simulation (second)
+    `I` : injected current (amp), either a function of time returning an array broadcastable to (P,N),
+          or an array of shape (n_steps, ...), where the trailing dimensions broadcast to (P,N)
+    `constants` : a set of constants (dictionary or cell name, default cell if None),
+          or a list of P sets (see `stack_constants`)
+    `N` : number of cells (by default, inferred from `I`)
+    `dt` : time step (second)
+    `method` : 'euler' or 'exponential_euler'
+    `record` : names of recorded variables (see `recordable_variables`)
+    `record_every` : number of time steps between recorded values
+    `init` : dictionary of initial values of state variables (default: v = EL, others 0)
+
+    Returns a dictionary of recorded variables, as (n_recorded, P, N) arrays, and times `t`.
+    Values are recorded at the beginning of each step, as Brian 2 monitors do.
+    '''
+    duration, dt = float(duration), float(dt)
+    if method not in ['euler', 'exponential_euler']:
+        raise ValueError('Unknown integration method: {}'.format(method))
+    for name in record:
+        if name not in recordable_variables:
+            raise ValueError('Cannot record {}'.format(name))
+    if constants is None or not isinstance(constants, (list, tuple)):
+        constants = [constants]
+    c = stack_constants(constants)
+    P = len(constants)
+    n_steps = int(round(duration/dt))
+
+    if callable(I):
+        current = lambda i: I(i*dt)
+    else:
+        I = np.asarray(I, dtype=float)
+        if len(I) != n_steps:
+            raise ValueError('The current has {} time steps, {} expected'.format(len(I), n_steps))
+        current = lambda i: I[i]
+    if N is None:
+        N = np.broadcast(np.empty(P)[:,None], np.asarray(current(0))).shape[1]
+
+    ## Constants
+    C = c['C']
+    g_IK, g_L, gCa, gKCa = c['g_IK'], c['gL'], c['gCa_cilia'], c['gKCa_cilia']
+    EK, EL, DV = c['EK'], c['EL'], c['DV']
+    V_IK, k_IK, a_IK, b_IK = c['V_IK'], c['k_IK'], c['a_IK'], c['b_IK']
+    VCa, kCa, taum_Ca = c['VCa_cilia'], c['kCa_cilia'], c['taum_Ca_cilia']
+    nCaM_Ca, nCaM_KCa, pKCa, pKKCa = c['nCaM_Ca_cilia'], c['nCaM_KCa_cilia'], c['pKCa'], c['pKKCa']
+    Cai0, alpha, Jpumpmax = c['Cai0_cilia'], c['alpha_cilia'], c['Jpumpmax_cilia']
+    calcium_flux = 1/(2*c['F']*Cai0*c['v_cilia'])
+    K = c['K_electromotor']
+
+    ## State variables
+    state = {'v': EL, 'n_IK': 0., 'm_Ca_cilia': 0., 'pCa': 0.}
+    if init is not None:
+        state.update(init)
+    state = {name: np.array(np.broadcast_to(value, (P, N)), dtype=float) for name, value in state.items()}
+    v, n_IK, m_Ca, pCa = [state[name] for name in state_variables]
+
+    n_recorded = (n_steps + record_every - 1) // record_every
+    recordings = {name: np.zeros((n_recorded, P, N)) for name in record}
+
+    for i in range(n_steps):
+        ## Currents
+        IV_K = (EK - v)/DV
+        x = 2*v/DV
+        small = np.abs(x) < 1e-8 # exprel(x) = (exp(x)-1)/x, 1 at x = 0
+        IV_Ca = np.where(small, 1 - x/2, x/np.expm1(np.where(small, 1., x)))
+        IK = g_IK * n_IK**2 * IV_K
+        IL = g_L*(EL - v)
+        h_Ca = 1/(1 + np.exp(nCaM_Ca*(pCa - pKCa)))
+        ICa = gCa * m_Ca**2 * h_Ca * IV_Ca
+        IKCa = gKCa/(1 + np.exp(-nCaM_KCa*(pCa - pKKCa))) * IV_K
+        I_i = current(i)
+
+        ## Record
+        if i % record_every == 0:
+            j = i // record_every
+            if len(recordings)>0:
+                Cai = Cai0*np.exp(pCa)
+                values = {'v': v, 'n_IK': n_IK, 'm_Ca_cilia': m_Ca, 'pCa': pCa, 'Cai_cilia': Cai,
+                          'IK': IK, 'ICa_cilia': ICa, 'IKCa_cilia': IKCa, 'I': I_i}
+                # Electromotor coupling
+                if ('velocity' in record) or ('theta' in record) or ('omega' in record):
+                    ratio = (Cai/K)**2
+                    values['velocity'] = c['v_plus']*(2/(1 + ratio) - 1)
+                    activation = 2/(1/ratio + ratio)
+                    values['theta'] = c['theta_min'] + (c['theta_max'] - c['theta_min'])*activation
+                    values['omega'] = c['omega_min'] + (c['omega_max'] - c['omega_min'])*activation
+                for name in record:
+                    recordings[name][j] = values[name]
+
+        ## Derivatives
+        dv = (IL + ICa + IK + IKCa + I_i)/C
+        ninf_IK = 1/(1 + np.exp((V_IK - v)/k_IK))
+        tau_IK = a_IK + b_IK/np.cosh((v - V_IK)/(2*k_IK))
+        minf_Ca = 1/(1 + np.exp((VCa - v)/kCa))
+        exp_pCa = np.exp(-pCa)
+        dpCa = ICa*calcium_flux*exp_pCa + alpha*(exp_pCa - 1) - Jpumpmax/(1 + 1/exp_pCa)
+
+        ## Update
+        if method == 'euler':
+            n_IK += dt*(ninf_IK - n_IK)/tau_IK
+            m_Ca += dt*(minf_Ca - m_Ca)/taum_Ca
+        else:
+            n_IK[:] = ninf_IK + (n_IK - ninf_IK)*np.exp(-dt/tau_IK)
+            m_Ca[:] = minf_Ca + (m_Ca - minf_Ca)*np.exp(-dt/taum_Ca)
+        v += dt*dv
+        pCa += dt*dpCa
+
+    recordings['t'] = np.arange(n_recorded)*record_every*dt
+    return recordings
+
+## Comparison with Brian 2 (see models.py)
+if __name__ == '__main__':
+    from brian2 import *
+    from .models import paramecium_equations
+    import time
+
+    N = 10
+    t1 = 300*ms
+    t2 = 302*ms
+    I0 = linspace(0, 4, N)*nA
+
+    t0 = time.time()
+    eqs = paramecium_equations() + Equations('''
+    dv/dt = (IL+ICa_cilia+IK+IKCa_cilia+I)/C : volt
+    I = I0*(int(t>t1)*int(t<t2)) : amp
+    I0 : amp (constant)
+    ''', C=paramecium_constants()['C'])
+    neuron = NeuronGroup(N, eqs, method='euler')
+    neuron.v = paramecium_constants()['EL']
+    neuron.I0 = I0
+    M = StateMonitor(neuron, ('v', 'Cai_cilia'), record=True)
+    run(700*ms)
+    print('Brian 2: {:.2f} s'.format(time.time()-t0))
+
+    t0 = time.time()
+    R = simulate_paramecium(0.7, lambda t: I0/amp*(float(t1)<t<float(t2)), dt=float(defaultclock.dt),
+                            record=('v', 'Cai_cilia', 'velocity', 'theta', 'omega'))
+    print('NumPy: {:.2f} s'.format(time.time()-t0))
+    print('Max difference in v: {:.3g} mV'.format(np.max(np.abs(R['v'][:,0,:].T - M.v_))/1e-3))
+
+    subplot(411)
+    plot(M.t/ms, M.v.T/mV, 'k')
+    plot(R['t']/1e-3, R['v'][:,0,:]/1e-3, 'r--')
+    ylabel('v')
+    subplot(412)
+    semilogy(R['t']/1e-3, R['Cai_cilia'][:,0,:])
+    ylabel(r'[Ca$^2+$]')
+    subplot(413)
+    plot(R['t']/1e-3, R['velocity'][:,0,:]/1e-3)
+    ylabel('v')
+    subplot(414)
+    plot(R['t']/1e-3, R['theta'][:,0,:]*180/np.pi)
+    ylabel(r'$\theta$')
+    show()
@@ -0,0 +1,192 @@
+'''
+Paramecium kinematics as Brian 2 code.
+
+This is the same model as `MovingCells` and `PlaneMovingCells` (see `motion_vectorized.py`),
+but written as code run regularly by the neuron group, so that the electrophysiological and kinematic
+models run together in generated code (no network operation).
+
+Orientation is stored as a quaternion (qw, qx, qy, qz), positions x, y, z are in meter.
+For cells moving in a plane, the 2D angle of the cell is stored in `orientation`.
+'''
+from brian2 import *
+import numpy as np
+from .motion_vectorized import MovingCells, PlaneMovingCells
+
+__all__ = ['kinematic_equations', 'kinematic_code', 'add_kinematics',
+           'set_plane_orientation', 'set_3D_orientation']
+
+# arctan2 is not a default Brian 2 function: it is added to the namespace of groups (see `add_kinematics`)
+arctan2 = Function(np.arctan2, arg_units=[1, 1], return_unit=1)
+arctan2.implementations.add_implementation('cpp', code=None, name='atan2')
+arctan2.implementations.add_implementation('cython', code='''
+from libc.math cimport atan2 as _atan2
+cdef double _arctan2(double y, double x):
+    return _atan2(y, x)
+''', name='_arctan2')
+
+def kinematic_equations():
+    '''
+    Returns the equations of the kinematic variables.
+    '''
+    return Equations('''
+    x : meter
+    y : meter
+    z : meter
+    qw : 1
+    qx : 1
+    qy : 1
+    qz : 1
+    orientation : 1
+    ''')
+
+def rotation_code(rx, ry, rz):
+    '''
+    Code that multiplies the quaternion q by the rotation of vector (rx, ry, rz) (code expressions),
+    on the right side.
+    '''
+    return '''
+    angle_kinematics = sqrt(({rx})**2 + ({ry})**2 + ({rz})**2)
+    dqw = cos(angle_kinematics/2)
+    dq_factor = sin(angle_kinematics/2)/clip(angle_kinematics, 1e-300, inf)
+    dqx = dq_factor*({rx})
+    dqy = dq_factor*({ry})
+    dqz = dq_factor*({rz})
+    qw_new = qw*dqw - qx*dqx - qy*dqy - qz*dqz
+    qx_new = qw*dqx + qx*dqw + qy*dqz - qz*dqy
+    qy_new = qw*dqy - qx*dqz + qy*dqw + qz*dqx
+    qz_new = qw*dqz + qx*dqy - qy*dqx + qz*dqw
+    '''.format(rx=rx, ry=ry, rz=rz)
+
+def kinematic_code(dt, plane=True, v_sedimentation=0*um/second, beta=None, omega='omega', exact_correction=False):
+    '''
+    Returns the code for one integration step of duration `dt`.
+    The code uses the `velocity`, `theta` and `omega` variables of the group
+    (see `paramecium_equations`), and the `arctan2` function (see `add_kinematics`).
+
+    `plane` : if True, the cell is moved back to the horizontal plane after each step,
+              and its 2D angle is stored in `orientation`
+    `v_sedimentation`, `beta` : gravity parameters (see `MovingCells.set_gravity`);
+              by default, `beta` is as in `PlaneMovingCells` (7 deg/s) or `MovingCells` (0)
+    `omega` : code expression of the spin (angular speed), by default the `omega` variable
+    `exact_correction` : if True, the cell is rotated exactly back to the plane, as in `PlaneMovingCell`
+              (`motion.py`); otherwise the correction is as in `PlaneMovingCells`
+    '''
+    if beta is None:
+        if plane:
+            beta = 7/180.*np.pi/second
+        else:
+            beta = 0*Hz
+    constants = {'dt': '{:.17g}*second'.format(float(dt)), 'omega': '({})'.format(omega),
+                 'v_sedimentation': '{:.17g}*meter/second'.format(float(v_sedimentation)),
+                 'beta': '{:.17g}/second'.format(float(beta))}
+
+    # Orientation vector: q*ez*q.conjugate()
+    code = '''
+    px_kinematics = 2*(qw*qy + qx*qz)
+    py_kinematics = 2*(qy*qz - qw*qx)
+    pz_kinematics = 1 - 2*(qx**2 + qy**2)
+    '''
+    # Displacement
+    code += '''
+    x += velocity*px_kinematics*{dt}
+    y += velocity*py_kinematics*{dt}
+    z += (velocity*pz_kinematics - {v_sedimentation})*{dt}
+    '''
+    # Rotation vector, in the cell coordinate system
+    if float(beta) != 0.:
+        # Gravity torque: -beta * (ez x p), where p = q.conjugate()*(-ez)*q is the gravity vector
+        code += '''
+        rx_kinematics = (-sin(theta)*{omega} - {beta}*2*(qy*qz + qw*qx))*{dt}
+        ry_kinematics = ({beta}*2*(qx*qz - qw*qy))*{dt}
+        '''
+    else:
+        code += '''
+        rx_kinematics = -sin(theta)*{omega}*{dt}
+        ry_kinematics = 0
+        '''
+    code += '''
+    rz_kinematics = -cos(theta)*{omega}*{dt}
+    '''
+    # Rotation and renormalization
+    code += rotation_code('rx_kinematics', 'ry_kinematics', 'rz_kinematics')
+    code += '''
+    q_norm = sqrt(qw_new**2 + qx_new**2 + qy_new**2 + qz_new**2)
+    qw = qw_new/q_norm
+    qx = qx_new/q_norm
+    qy = qy_new/q_norm
+    qz = qz_new/q_norm
+    '''
+
+    if plane:
+        # Orientation vector
+        code += '''
+        px_kinematics = 2*(qw*qy + qx*qz)
+        py_kinematics = 2*(qy*qz - qw*qx)
+        pz_kinematics = 1 - 2*(qx**2 + qy**2)
+        p_norm = sqrt(px_kinematics**2 + py_kinematics**2 + pz_kinematics**2)
+        px_kinematics = px_kinematics/p_norm
+        py_kinematics = py_kinematics/p_norm
+        pz_kinematics = pz_kinematics/p_norm
+        '''
+        # Corrective rotation, around the orthogonal axis ez x p, applied on the left side:
+        # correction*q = (q.conjugate()*correction.conjugate()).conjugate()
+        if exact_correction: # the angle is arctan2(pz, |p_H|), around the normalized axis
+            code += '''
+            pH_kinematics = clip(sqrt(px_kinematics**2 + py_kinematics**2), 1e-300, inf)
+            theta_correction = arctan2(pz_kinematics, pH_kinematics)/pH_kinematics
+            '''
+        else: # the angle is arctan2(pz, abs(pz)), as in PlaneMovingCells
+            code += '''
+            theta_correction = sign(pz_kinematics)*pi/4
+            '''
+        code += '''
+        qx = -qx
+        qy = -qy
+        qz = -qz
+        '''
+        code += rotation_code('py_kinematics*theta_correction', '-px_kinematics*theta_correction', '0')
+        code += '''
+        qw = qw_new
+        qx = -qx_new
+        qy = -qy_new
+        qz = -qz_new
+        px_kinematics = 2*(qw*qy + qx*qz)
+        py_kinematics = 2*(qy*qz - qw*qx)
+        orientation = arctan2(py_kinematics, px_kinematics)
+        '''
+
+    # Remove indentation
+    code = '\n'.join([line.strip() for line in code.split('\n') if len(line.strip())>0])
+    return code.format(**constants)
+
+def add_kinematics(group, dt=1*ms, plane=True, v_sedimentation=0*um/second, beta=None, omega='omega',
+                   exact_correction=False, when='end', order=0):
+    '''
+    Adds the kinematic model to `group`, which must include the `kinematic_equations()`
+    and the electromotor coupling variables `velocity`, `theta`, `omega`.
+    The kinematic variables are updated every `dt` (see `kinematic_code` for the other arguments).
+    An `arctan2` function is added to the namespace of the group, and can also be used in its other code.
+    Returns the `CodeRunner` object.
+    '''
+    group.namespace = dict(group.namespace or {}, arctan2=arctan2) # copied: the namespace may be shared
+    return group.run_regularly(kinematic_code(dt, plane=plane, v_sedimentation=v_sedimentation, beta=beta,
+                                              omega=omega, exact_correction=exact_correction),
+                               dt=dt, when=when, order=order)
+
+def set_plane_orientation(group, theta=0.):
+    '''
+    Sets the 2D orientation of cells in `group`, as `PlaneMovingCells.set_orientation`.
+    `theta` is in radians.
+    '''
+    cells = PlaneMovingCells(len(group), theta)
+    group.qw, group.qx, group.qy, group.qz = cells.q.T
+    group.orientation = cells.orientation()
+
+def set_3D_orientation(group, axis, angle=np.pi/2):
+    '''
+    Sets the orientation of cells in `group`, as `MovingCells.set_orientation`.
+    `angle` is in radians.
+    '''
+    cells = MovingCells(len(group))
+    cells.set_orientation(axis, angle)
+    group.qw, group.qx, group.qy, group.qz = cells.q.T
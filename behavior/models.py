@@ -33,7 +33,7 @@ with open(split(__file__)[0]+'/../models/full_models/ciliated.csv') as f:
 def paramecium_constants(name = '2020-10-28 17.46.05'):
     if name is None:
         name = '2020-10-28 17.46.05'
-    constants = paramecium_table[name]
+    constants = paramecium_table[name].copy()
 
     constants.update(dict(K_electromotor = 1.4e-6*molar,
         F=faraday_constant,
@@ -5,11 +5,43 @@ Uses quaternions for 3D motion.
 The cell coordinate system is chosen so that the cell points upward (along positive z axis).
 '''
 import numpy as np
-import quaternion
 from numpy.linalg import norm
 import imageio
+from .quaternion_arrays import *
 
-__all__ = ['MovingCells', 'PlaneMovingCells']
+__all__ = ['MovingCells', 'PlaneMovingCells', 'trajectory_buffer']
+
+# Unit vectors
+ex = np.array([1., 0., 0.])
+ez = np.array([0., 0., 1.])
+gravity = -ez
+
+max_cells_scan = 500 # maximum number of cells for which steps are calculated together (see `step_orientations`)
+
+def trajectory_buffer(shape, filename=None):
+    '''
+    Returns a zero array of the given shape, to record trajectories.
+    If `filename` is given, the array is a memory-mapped .npy file.
+    '''
+    if filename is None:
+        return np.zeros(shape)
+    else:
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=float, shape=shape)
+
+def kinematic_input(value, n_steps):
+    '''
+    Returns a kinematic input as an array of blocks, and the number of steps per block.
+    `value` is a scalar or an array of N values (constant: the number of steps per block is then None),
+    or an array of shape (K,N), piecewise constant over K blocks of n_steps/K steps
+    (K = n_steps: one value per step).
+    '''
+    value = np.asarray(value)
+    if value.ndim < 2:
+        return value, None
+    K = value.shape[0]
+    if n_steps % K != 0:
+        raise ValueError('The number of steps ({}) must be a multiple of the number of input rows ({})'.format(n_steps, K))
+    return value, n_steps // K
 
 class MovingCells(object):
     '''
@@ -17,13 +49,15 @@ class MovingCells(object):
     All coordinates in um.
 
     `x` : coordinate array, of shape (N,3)
-    `axis` : orientation of the cells
+    `q` : orientation of the cells, as an array of quaternions of shape (N,4) (w, x, y, z),
+          in Fortran order (each component is contiguous)
     '''
     def __init__(self, N, axis=None):
         # Initial position
-        self.x = np.zeros((N,3))
-        self.v = np.zeros((len(self),3))
-        self.omega = np.zeros((len(self),3))
+        self.x = np.zeros((N,3), order='F')
+        self.v = np.zeros((len(self),3), order='F')
+        self.omega = np.zeros((len(self),3), order='F')
+        self.allocate_buffers()
 
         # Initial orientation
         if axis is None: # Default: horizontal
@@ -40,15 +74,28 @@ class MovingCells(object):
     def __len__(self):
         return self.x.shape[0]
 
+    def allocate_buffers(self):
+        '''
+        Allocates work arrays used by `integrate`.
+        '''
+        N = len(self)
+        self._work = quaternion_buffer(N)
+        self._dq = quaternion_buffer(N)
+        self._q_next = quaternion_buffer(N)
+        self._vector = quaternion_buffer(N)[:,:3]
+        self._rotation = quaternion_buffer(N)[:,:3]
+        self._angle = np.zeros(N)
+
     def set_orientation(self, axis, angle = np.pi / 2):
         '''
         Sets the orientation of cells.
         `angle` is in radians.
         '''
+        axis = np.asarray(axis, dtype=float)
         if axis.shape == (3,): # The same axis for all
-            self. q = np.ones(len(self))*quaternion.from_rotation_vector(axis*angle)
-        else:
-            self.q = quaternion.from_rotation_vector(axis*angle)
+            axis = np.tile(axis, (len(self), 1))
+        self.q = quaternion_buffer(len(self))
+        quaternion_from_rotation_vector(axis*angle, self.q, self._work)
 
     def set_gravity(self, v_sedimentation = 84., beta = 7/180.*np.pi):
         '''
@@ -56,7 +103,7 @@ class MovingCells(object):
         `v_sedimentation` : sedimentation velocity (Machemer et al. 1991: 84 um/s)
         `beta` : gravity torque in rad/s (Roberts: 7 deg/s = 7/180*pi rad/s)
         '''
-        self.v_sedimentation = np.zeros((len(self),3))
+        self.v_sedimentation = np.zeros((len(self),3), order='F')
         self.v_sedimentation[:,2] = - v_sedimentation
         self.beta_gravity = beta
 
@@ -76,12 +123,22 @@ class MovingCells(object):
         self.omega[:,1] = 0
         self.omega[:,2] = -np.cos(theta)*spin # left spiral, 1 Hz
 
+    def rotated(self, vector):
+        '''
+        Returns `vector`, given in the cell coordinate system, in the observer coordinate system.
+        '''
+        result = np.zeros((len(self),3))
+        quaternion_rotate(self.q, vector, result, quaternion_buffer(len(self)))
+        return result
+
     def spiral_axis(self):
         '''
         Returns the spiral axis vector in the observer coordinate system.
         The magnitude is the angular speed.
         '''
-        return quaternion.as_vector_part(self.q*quaternion.from_rotation_vector(self.omega)*self.q.conjugate())
+        dq = np.zeros((len(self),4))
+        quaternion_from_rotation_vector(self.omega, dq, quaternion_buffer(len(self)))
+        return self.rotated(dq[:,1:])
 
     def integrate(self, dt=None):
         '''
@@ -89,17 +146,178 @@ class MovingCells(object):
         '''
         if dt is None:
             dt = self.dt
+        work, displacement = self._work, self._vector
+
+        # Displacement
+        quaternion_rotate(self.q, self.v, displacement, work)
+        np.add(displacement, self.v_sedimentation, out=displacement)
+        np.multiply(displacement, dt, out=displacement)
+        np.add(self.x, displacement, out=self.x)
+
+        self.rotate(self.omega, dt)
 
-        # Gravity torque (in Paramecium system!)
-        p = quaternion.as_vector_part(self.q.conjugate() * quaternion.from_vector_part(np.array([0., 0., -1.])) * self.q)  # gravity vector
-        omega_gravity = -self.beta_gravity * np.cross(np.array([0., 0., 1.]), p)
+    def rotate(self, omega, dt):
+        '''
+        Rotates the cells by one timestep, with angular velocity `omega` (N,3) in the cell coordinate system,
+        and the gravity torque.
+        '''
+        work, rotation = self._work, self._rotation
+
+        # Rotation vector
+        if self.beta_gravity != 0.:
+            # Gravity torque (in Paramecium system!)
+            p = self._vector
+            quaternion_rotate(self.q, gravity, p, work, conjugate=True) # gravity vector
+            # -beta * (ez x p)
+            np.multiply(p[:,1], self.beta_gravity, out=rotation[:,0])
+            np.multiply(p[:,0], -self.beta_gravity, out=rotation[:,1])
+            rotation[:,2] = 0.
+            np.add(omega, rotation, out=rotation)
+        else:
+            np.copyto(rotation, omega)
+        np.multiply(rotation, dt, out=rotation)
 
-        self.x += (quaternion.as_vector_part(self.q*quaternion.from_vector_part(self.v)*self.q.conjugate()) + self.v_sedimentation)*dt
+        # Rotation and renormalization
+        quaternion_from_rotation_vector(rotation, self._dq, work)
+        quaternion_multiply(self.q, self._dq, self._q_next, work)
+        self.q, self._q_next = self._q_next, self.q
+        quaternion_normalize(self.q, work)
 
-        #self.q.integrate(self.omega+omega_gravity,dt)
-        self.q = self.q*quaternion.from_rotation_vector((self.omega+omega_gravity)*dt)
-        # Renormalize
-        self.q = self.q/np.absolute(self.q)
+    def orientation_shape(self):
+        '''
+        Shape of the recorded orientation of one cell.
+        '''
+        return (4,) # quaternion
+
+    def recorded_orientation(self, q):
+        '''
+        Returns the orientation to record for an (M,4) array `q` of quaternions.
+        '''
+        return q
+
+    def trajectory_buffers(self, n_steps, record_every=1, filename=None):
+        '''
+        Returns arrays to record positions, shape (T,N,3), and orientations over `n_steps` steps,
+        with T = n_steps // record_every.
+        If `filename` is given, they are memory-mapped files `filename`_x.npy and `filename`_orientation.npy.
+        '''
+        T, N = n_steps // record_every, len(self)
+        if filename is None:
+            return trajectory_buffer((T, N, 3)), trajectory_buffer((T, N) + self.orientation_shape())
+        else:
+            return trajectory_buffer((T, N, 3), filename+'_x.npy'),\
+                   trajectory_buffer((T, N) + self.orientation_shape(), filename+'_orientation.npy')
+
+    def step_orientations(self, omega, dt):
+        '''
+        Returns the orientations of the cells before and after each of S steps, with angular velocities `omega`
+        in the cell coordinate system, and sets the orientation to the last one.
+        `omega` is an (S*N,3) array, where row k*N+i is the angular velocity of cell i at step k,
+        and orientations are returned in the same way, as an ((S+1)*N,4) array.
+        Without gravity torque, orientations are cumulative products of the rotations of each step, calculated
+        for all steps at once (see `quaternion_cumulative_product`). Otherwise, the rotation of a step depends
+        on the orientation, and steps are calculated one after the other. They are also calculated one after
+        the other for more than `max_cells_scan` cells, since the per-step overhead is then small.
+        '''
+        N = len(self)
+        S = len(omega) // N
+        q = quaternion_buffer((S+1)*N)
+        q[:N] = self.q
+        if (self.beta_gravity != 0.) or (N > max_cells_scan):
+            for k in range(S):
+                self.rotate(omega[k*N:(k+1)*N], dt)
+                q[(k+1)*N:(k+2)*N] = self.q
+            return q
+
+        steps, work = quaternion_buffer(S*N), quaternion_buffer(S*N)
+        quaternion_from_rotation_vector(omega*dt, steps, work)
+        quaternion_cumulative_product(steps, N, q[N:], work)
+        quaternion_multiply(np.tile(self.q, (S, 1)), steps, q[N:], work)
+        quaternion_normalize(q[N:], work)
+        self.q[:] = q[-N:]
+        return q
+
+    def integrate_n(self, n_steps, velocity=None, theta=None, omega=2*np.pi, dt=None, record_every=1,
+                    positions=None, orientations=None, block_size=None):
+        '''
+        Moves the cells by `n_steps` timesteps, and records positions and orientations
+        every `record_every` steps, after integration.
+
+        Kinematic inputs are (see `set_velocity` and `set_rotation_angle`):
+        `velocity` : linear velocity (None: unchanged)
+        `theta` : angle of the rotation axis (None: unchanged, `omega` is then ignored)
+        `omega` : rotation speed in radians per second
+        Each input is either constant (scalar or array of N values), or an array of shape (K,N), piecewise
+        constant over K blocks of n_steps/K steps (K = n_steps: one value per step).
+
+        `positions` and `orientations` are arrays to write into, as returned by `trajectory_buffers`
+        (allocated if None).
+
+        Steps are calculated by blocks of `block_size` steps (by default, about 2**14 / N), with array operations
+        over all steps of a block (see `step_orientations`).
+
+        Returns positions, orientations.
+        '''
+        if dt is None:
+            dt = self.dt
+        T, N = n_steps // record_every, len(self)
+        if (positions is None) or (orientations is None):
+            positions, orientations = self.trajectory_buffers(n_steps, record_every)
+        for name, buffer, shape in [('positions', positions, (T, N, 3)),
+                                    ('orientations', orientations, (T, N) + self.orientation_shape())]:
+            if np.shape(buffer) != shape:
+                raise ValueError('`{}` has shape {}, expected {} for {} steps recorded every {} steps'.
+                                 format(name, np.shape(buffer), shape, n_steps, record_every))
+
+        # Kinematic inputs
+        if velocity is not None:
+            velocity, velocity_block = kinematic_input(velocity, n_steps)
+        if theta is not None:
+            theta, theta_block = kinematic_input(theta, n_steps)
+            omega, omega_block = kinematic_input(omega, n_steps)
+
+        if block_size is None:
+            block_size = max(2**14 // N, 1)
+        block_size = max(block_size - block_size % record_every, record_every) # blocks end with a recording
+        for start in range(0, n_steps, block_size):
+            steps = np.arange(start, min(start + block_size, n_steps))
+            S = len(steps)
+
+            # Inputs of each step (as set by `set_velocity` and `set_rotation_angle`), as (3,S,N) arrays
+            v = np.empty((3, S, N))
+            v[:] = self.v.T[:,None,:]
+            if velocity is not None:
+                v[2] = velocity if velocity_block is None else velocity[steps // velocity_block]
+            rotation = np.empty((3, S, N))
+            rotation[:] = self.omega.T[:,None,:]
+            if theta is not None:
+                theta_k = theta if theta_block is None else theta[steps // theta_block]
+                omega_k = omega if omega_block is None else omega[steps // omega_block]
+                rotation[0] = -np.sin(theta_k)*omega_k
+                rotation[1] = 0
+                rotation[2] = -np.cos(theta_k)*omega_k
+            self.v[:], self.omega[:] = v[:,-1].T, rotation[:,-1].T
+
+            # Orientations, then displacements; (S*N,3) arrays are views of (3,S,N) arrays
+            q = self.step_orientations(rotation.reshape((3, -1)).T, dt)
+            displacement = np.empty((3, S, N))
+            quaternion_rotate(q[:-N], v.reshape((3, -1)).T, displacement.reshape((3, -1)).T, quaternion_buffer(S*N))
+            np.add(displacement, self.v_sedimentation.T[:,None,:], out=displacement)
+            np.multiply(displacement, dt, out=displacement)
+            x = np.cumsum(displacement, axis=1, out=displacement)
+            np.add(x, self.x.T[:,None,:], out=x)
+            self.x[:] = x[:,-1].T
+
+            # Recording
+            recorded = np.nonzero((steps + 1) % record_every == 0)[0]
+            if len(recorded) > 0:
+                j = (steps[recorded] + 1) // record_every - 1
+                positions[j[0]:j[-1]+1] = x[:,recorded].transpose((1, 2, 0))
+                rows = ((recorded + 1)[:,None]*N + np.arange(N)).flatten()
+                orientations[j[0]:j[-1]+1] = self.recorded_orientation(q[rows]).\
+                    reshape((len(j), N) + self.orientation_shape())
+
+        return positions, orientations
 
 class PlaneMovingCells(MovingCells):
     '''
@@ -108,9 +326,10 @@ class PlaneMovingCells(MovingCells):
     '''
     def __init__(self, N, theta=0.):
         # Initial position
-        self.x = np.zeros((N,3))
-        self.v = np.zeros((len(self),3))
-        self.omega = np.zeros((len(self),3))
+        self.x = np.zeros((N,3), order='F')
+        self.v = np.zeros((len(self),3), order='F')
+        self.omega = np.zeros((len(self),3), order='F')
+        self.allocate_buffers()
         self.dt = 1 # to be changed by user
         self.set_velocity(1000.) # 1 mm/s
         self.set_rotation_angle(20./180.*np.pi) # 20 degrees
@@ -127,36 +346,55 @@ class PlaneMovingCells(MovingCells):
         axis[:,1] = np.sin(theta)
         MovingCells.set_orientation(self, axis)
 
-    def integrate(self, dt=None):
-        # We make a 3D movement, then move the cell back into the plane
-        MovingCells.integrate(self, dt)
+    def rotate(self, omega, dt):
+        # We make a 3D rotation, then move the cell back into the plane
+        MovingCells.rotate(self, omega, dt)
+        work, p, rotation, theta = self._work, self._vector, self._rotation, self._angle
 
         # Orientation vector
-        p = quaternion.as_vector_part(self.q * quaternion.from_vector_part(np.array([0., 0., 1.])) * self.q.conjugate())
-        p = (p.T / norm(p, axis=1)).T
-
-        # Orthogonal axis: this is the rotation axis to move the orientation vector back to the plane
-        axis = np.cross(np.array([0., 0., 1.]), p)
-
-        # Projection on the horizontal plane
-        p_H = np.zeros_like(p)
-        p_H[:,2] = p[:,2]
-
-        # Angle
-        cos_theta = norm(p_H, axis=1)
-        sin_theta = p[:,2]
-        theta = np.arctan2(sin_theta, cos_theta)
-
-        # Corrective rotation
-        correction = quaternion.from_rotation_vector((axis.T*theta).T)
-        self.q = correction * self.q
+        quaternion_rotate(self.q, ez, p, work)
+        np.einsum('ij,ij->i', p, p, out=theta)
+        np.sqrt(theta, out=theta)
+        np.divide(p, theta[:,None], out=p)
+
+        # Angle, between the orientation vector and its projection
+        np.absolute(p[:,2], out=theta) # cos_theta
+        np.arctan2(p[:,2], theta, out=theta)
+
+        # Corrective rotation, around the orthogonal axis ez x p
+        np.multiply(p[:,1], theta, out=rotation[:,0])
+        np.negative(rotation[:,0], out=rotation[:,0])
+        np.multiply(p[:,0], theta, out=rotation[:,1])
+        rotation[:,2] = 0.
+        quaternion_from_rotation_vector(rotation, self._dq, work)
+        quaternion_multiply(self._dq, self.q, self._q_next, work)
+        self.q, self._q_next = self._q_next, self.q
+
+    def step_orientations(self, omega, dt):
+        # The corrective rotation depends on the orientation: steps are calculated one after the other
+        N = len(self)
+        S = len(omega) // N
+        q = quaternion_buffer((S+1)*N)
+        q[:N] = self.q
+        for k in range(S):
+            self.rotate(omega[k*N:(k+1)*N], dt)
+            q[(k+1)*N:(k+2)*N] = self.q
+        return q
+
+    def orientation_shape(self):
+        return () # 2D angle
+
+    def recorded_orientation(self, q):
+        p = quaternion_buffer(len(q))[:,:3]
+        quaternion_rotate(q, ez, p, quaternion_buffer(len(q)))
+        return np.arctan2(p[:,1], p[:,0])
 
     def orientation(self):
         '''
         Returns the 2D angle of the cells.
         '''
         # Orientation vector (missing: the spin angle)
-        p = quaternion.as_vector_part(self.q * quaternion.from_vector_part(np.array([0., 0., 1.])) * self.q.conjugate())[:,:2]
+        p = self.rotated(ez)[:,:2]
         p = (p.T / norm(p, axis=1)).T
         return np.arctan2(p[:,1],p[:,0])
 
@@ -166,7 +404,7 @@ class PlaneMovingCells(MovingCells):
 
         NOT VECTORIZED YET
         '''
-        p2 = quaternion.as_vector_part(self.q * quaternion.from_vector_part(np.array([1., 0., 0.])) * self.q.conjugate())
+        p2 = self.rotated(ex)
         # Side
         if p2[2] < 0.:
             return None # mouth is not visible
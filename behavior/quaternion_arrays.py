@@ -0,0 +1,114 @@
+'''
+Kernels on arrays of quaternions.
+
+Quaternions are stored as (N,4) float64 arrays, with components (w, x, y, z).
+Arrays are preferably in Fortran order (structure of arrays), so that each component is a contiguous
+array of N values: all operations are done component-wise.
+All functions write into preallocated arrays given as arguments, so that they allocate nothing
+when called in a simulation loop.
+'''
+import numpy as np
+
+__all__ = ['quaternion_multiply', 'quaternion_rotate', 'quaternion_from_rotation_vector',
+           'quaternion_normalize', 'quaternion_cumulative_product', 'quaternion_buffer']
+
+tiny = np.finfo(float).tiny
+
+def quaternion_buffer(N):
+    '''
+    Returns a work array for the functions of this module, for N quaternions.
+    It can also be used to store quaternions or vectors (first 3 columns).
+    '''
+    return np.zeros((N,4), order='F')
+
+def _sum_of_products(out, tmp, terms):
+    '''
+    out = a0*b0 +- a1*b1 +- ..., with `terms` a sequence of (a, b, sign).
+    '''
+    (a, b, _), rest = terms[0], terms[1:]
+    np.multiply(a, b, out=out)
+    for a, b, sign in rest:
+        np.multiply(a, b, out=tmp)
+        if sign > 0:
+            np.add(out, tmp, out=out)
+        else:
+            np.subtract(out, tmp, out=out)
+
+def _cross(a, b, out, tmp):
+    '''
+    Cross product of (N,3) vectors `a` and `b` (`b` can be a single vector), written into `out`.
+    '''
+    a0, a1, a2 = a[:,0], a[:,1], a[:,2]
+    b0, b1, b2 = b[...,0], b[...,1], b[...,2]
+    _sum_of_products(out[:,0], tmp, ((a1, b2, 1), (a2, b1, -1)))
+    _sum_of_products(out[:,1], tmp, ((a2, b0, 1), (a0, b2, -1)))
+    _sum_of_products(out[:,2], tmp, ((a0, b1, 1), (a1, b0, -1)))
+
+def quaternion_multiply(p, q, out, work):
+    '''
+    Hamilton product p*q, written into `out` (which must not be `p` or `q`).
+    '''
+    a1, b1, c1, d1 = p[:,0], p[:,1], p[:,2], p[:,3]
+    a2, b2, c2, d2 = q[:,0], q[:,1], q[:,2], q[:,3]
+    tmp = work[:,3]
+    _sum_of_products(out[:,0], tmp, ((a1, a2, 1), (b1, b2, -1), (c1, c2, -1), (d1, d2, -1)))
+    _sum_of_products(out[:,1], tmp, ((a1, b2, 1), (b1, a2, 1), (c1, d2, 1), (d1, c2, -1)))
+    _sum_of_products(out[:,2], tmp, ((a1, c2, 1), (b1, d2, -1), (c1, a2, 1), (d1, b2, 1)))
+    _sum_of_products(out[:,3], tmp, ((a1, d2, 1), (b1, c2, 1), (c1, b2, -1), (d1, a2, 1)))
+
+def quaternion_rotate(q, v, out, work, conjugate=False):
+    '''
+    Rotates vectors `v` by unit quaternions `q`, i.e., vector part of q*v*q.conjugate(),
+    written into `out` (N,3).
+    `v` is either (N,3) or a single 3D vector.
+    If `conjugate` is True, rotates by q.conjugate() instead.
+    '''
+    w, u = q[:,0], q[:,1:]
+    t, tmp = work[:,:3], work[:,3]
+    # t = 2 u x v ; v' = v + w t + u x t
+    _cross(u, v, t, tmp)
+    np.multiply(t, 2., out=t)
+    _cross(u, t, out, tmp)
+    np.multiply(t, w[:,None], out=t)
+    if conjugate: # u -> -u
+        np.subtract(out, t, out=out)
+    else:
+        np.add(out, t, out=out)
+    np.add(out, v, out=out)
+
+def quaternion_from_rotation_vector(r, out, work):
+    '''
+    Quaternions representing rotations by the (N,3) rotation vectors `r`, written into `out`.
+    '''
+    angle, half_angle = work[:,0], work[:,1]
+    np.einsum('ij,ij->i', r, r, out=angle)
+    np.sqrt(angle, out=angle)
+    np.multiply(angle, .5, out=half_angle)
+    np.cos(half_angle, out=out[:,0])
+    np.sin(half_angle, out=half_angle)
+    # Null rotations have a null vector part, whatever the scaling factor
+    np.maximum(angle, tiny, out=angle)
+    np.divide(half_angle, angle, out=half_angle)
+    np.multiply(r, half_angle[:,None], out=out[:,1:])
+
+def quaternion_normalize(q, work):
+    '''
+    Normalizes quaternions `q` in place.
+    '''
+    norm = work[:,0]
+    np.einsum('ij,ij->i', q, q, out=norm)
+    np.sqrt(norm, out=norm)
+    np.divide(q, norm[:,None], out=q)
+
+def quaternion_cumulative_product(q, N, out, work):
+    '''
+    Cumulative Hamilton products over steps of S steps of N quaternions, in place: `q` is an (S*N,4) array where
+    row k*N+i is quaternion i of step k, which is replaced by q[i of step 0]*q[i of step 1]*...*q[i of step k].
+    `out` and `work` are work arrays of the same shape.
+    This is a parallel prefix scan: it takes log2(S) products of arrays of quaternions, instead of S products.
+    '''
+    d = N
+    while d < len(q):
+        quaternion_multiply(q[:-d], q[d:], out[d:], work[d:])
+        q[d:] = out[d:]
+        d *= 2
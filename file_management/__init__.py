@@ -6,3 +6,7 @@ from .configuration import *
 from .data_preparation import *
 from .load_model import *
 from .file_utils import *
+from .catalog import *
+from .pipeline import *
+from .frame_source import *
+from .image_stack import *
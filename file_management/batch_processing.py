@@ -1,6 +1,9 @@
 '''
 Batch processing: applies a script on multiple files recursively.
 
+`batch` runs each script in a new Python process. `pool_batch` runs scripts or functions in a pool of
+persistent processes, where heavy modules are imported once.
+
 Parallel running on cluster uses GNU Parallel.
 There must be a configuration file named `~/.parallel/cluster`.
 Example file:
@@ -11,15 +14,31 @@ Example file:
 -S slave3
 --progress
 --wd .
+
+Without this file (or without GNU Parallel), `cluster_batch` runs the jobs on a local pool of processes.
+Jobs are logged, so that an interrupted batch can be resumed (see `cluster_batch`).
 '''
 import os
+import sys
 import subprocess
 import time
+import runpy
+import importlib
+import warnings
+import traceback
+import json
+import shutil
+import shlex
+import tempfile
+import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from .configuration import *
+from .catalog import listing, subfolders
 import inspect
 
 __all__ = ['batch', 'cell_folders', 'protocol_folders', 'cluster_batch', 'one_protocol',
-           'run_this_on_all_cells', 'run_this_on_all_protocols', 'is_cell_folder', 'is_protocol_folder']
+           'run_this_on_all_cells', 'run_this_on_all_protocols', 'is_cell_folder', 'is_protocol_folder',
+           'scan_folders', 'pool_batch']
 
 def is_cell_folder(folder):
     '''
@@ -29,61 +48,74 @@ def is_cell_folder(folder):
     return ('Cell' in name) or ('cell' in name)
 
 def is_protocol_folder(folder):
-    found = False
-    for f in os.scandir(folder):
-        if (f.path[-13:] == 'experiment.py') or (f.name == 'protocol.yaml'):  # experimental script
-            found = True
-            break
-    return found
+    for name in listing(folder)[1]:
+        if (name[-13:] == 'experiment.py') or (name == 'protocol.yaml'):  # experimental script
+            return True
+    return False
 
-def cell_folders(*folders, recursive = False):
+def is_PIV_folder(folder):
+    name = os.path.split(folder)[1]
+    return (name == 'piv') or (name[-4:] == '_PIV')
+
+def scan_folders(*folders, recursive=True, max_depth=None):
     '''
-    Returns all cell folders in the paths given as arguments.
+    Walks through the paths given as arguments in a single pass, and yields (kind, folder)
+    for each folder as it is found, where kind is 'cell', 'protocol', 'images' or 'PIV'.
+
+    Cell folders are looked for in the paths and their subfolders (recursively if `recursive` is True,
+    down to `max_depth` levels if not None), but not within cell folders.
+    Protocol folders are the cell folders and their subfolders with an experimental script.
+    Image and PIV folders are subfolders of protocol folders.
+    Directory listings are read from the catalog when directories have not changed (see `catalog.py`).
     '''
-    cells = []
     for path in folders:
-        if is_cell_folder(path):
-            cells.append(path)
-        if recursive:
-            cells.extend(cell_folders(*[f.path for f in os.scandir(path) if os.path.isdir(f)\
-                                              and ('Cell' not in f.name) and ('cell' not in f.name)], recursive=True))
-        cells.extend(
-            [f.path for f in os.scandir(path) if os.path.isdir(f) and (('Cell' in f.name) or ('cell' in f.name))])
-    return cells
+        for entry in scan_folder(path, 0, recursive, max_depth):
+            yield entry
+
+def scan_folder(path, depth, recursive, max_depth):
+    if is_cell_folder(path):
+        yield 'cell', path
+        for folder in [path] + subfolders(path):
+            if is_protocol_folder(folder):
+                yield 'protocol', folder
+                for subfolder in subfolders(folder):
+                    if os.path.split(subfolder)[1] == 'images':
+                        yield 'images', subfolder
+                    elif is_PIV_folder(subfolder):
+                        yield 'PIV', subfolder
+        if depth > 0:
+            return
+    for folder in subfolders(path):
+        if is_cell_folder(folder) or (recursive and not is_cell_folder(path)
+                                      and ((max_depth is None) or (depth < max_depth))):
+            for entry in scan_folder(folder, depth+1, recursive, max_depth):
+                yield entry
+
+def cell_folders(*folders, recursive = False, max_depth = None):
+    '''
+    Returns all cell folders in the paths given as arguments.
+    '''
+    return [folder for kind, folder in scan_folders(*folders, recursive=recursive, max_depth=max_depth)
+            if kind == 'cell']
 
 def one_protocol(folder):
     '''
     Returns the path of one protocol in the cell folder.
     '''
-    for f in os.scandir(folder):
-        if os.path.exists(os.path.join(f.path, 'protocol.yaml')):
-            return f.path
+    for f in subfolders(folder):
+        if 'protocol.yaml' in listing(f)[1]:
+            return f
     return None
 
-def protocol_folders(*folders, recursive = False):
+def protocol_folders(*folders, recursive = False, max_depth = None):
     '''
     Returns all protocol folders in the paths given as arguments.
 
     First looks for cell folders, and protocols inside the folders.
     A protocol folder is a folder with a file ending with "experiment.py" or a "protocol.yaml" file.
     '''
-    cells = cell_folders(*folders, recursive=recursive)
-    protocol_folders = cells.copy()
-    for path in cells:
-        protocol_folders.extend([f.path for f in os.scandir(path) if os.path.isdir(f)])
-
-    # Check if there is an experimental script (...experiment.py)
-    selection = []
-    for folder in protocol_folders:
-        found = False
-        for f in os.scandir(folder):
-            if (f.path[-13:] == 'experiment.py') or (f.name == 'protocol.yaml'): # experimental script
-                found = True
-                break
-        if found: # it's a protocol folder
-            selection.append(folder)
-
-    return selection
+    return [folder for kind, folder in scan_folders(*folders, recursive=recursive, max_depth=max_depth)
+            if kind == 'protocol']
 
 def batch(script_name, folders, filter=None, n_processes = 5, verbose=True, recursive=False, args=[]):
     '''
@@ -141,16 +173,182 @@ def batch(script_name, folders, filter=None, n_processes = 5, verbose=True, recu
     #         process.wait()
     #     i += n_processes
 
-def cluster_batch(python, script_name, folders, verbose=True, args=[]):
+def initialize_worker(modules):
+    '''
+    Imports modules in a worker process of `pool_batch`.
+    '''
+    warnings.simplefilter('ignore') # as python -W ignore
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+def run_task(target, folder, args):
+    '''
+    Runs a script (as `python script folder args`) or calls a function on a folder, in a worker process.
+    Returns the status ('ok' or 'failed'), duration and error message.
+    '''
+    t0 = time.time()
+    status, error = 'ok', None
+    try:
+        if callable(target):
+            target(folder, *args)
+        else:
+            sys.argv = [target, folder] + list(args)
+            runpy.run_path(target, run_name='__main__')
+    except SystemExit as e: # e.g. exit(0) in run_this_on_all_cells
+        if e.code not in [None, 0]:
+            status, error = 'failed', 'exit code {}'.format(e.code)
+    except BaseException:
+        status, error = 'failed', traceback.format_exc()
+    if 'matplotlib.pyplot' in sys.modules: # figures are not shared between tasks
+        sys.modules['matplotlib.pyplot'].close('all')
+    return {'folder': folder, 'status': status, 'duration': time.time() - t0, 'error': error}
+
+def pool_batch(target, folders, filter=None, n_processes=5, verbose=True, recursive=False, args=[],
+               preload=('numpy', 'scipy', 'brian2', 'clampy', 'matplotlib.pyplot')):
+    '''
+    Runs `target` on each of the folders, as `batch`, in a pool of `n_processes` persistent processes.
+
+    `target` : the filename of a script, which is run as `python script folder args`,
+               or a function (defined at module level), which is called as `target(folder, *args)`
+    `preload` : modules imported once in each process
+
+    Scripts run one after the other in the same process: they should not rely on a fresh interpreter
+    (e.g. fitting scripts should be run with `batch`).
+    Returns a list of dictionaries with keys `folder`, `status` ('ok' or 'failed'), `duration` and `error`
+    (traceback), in the order of completion. If a worker process crashes, `duration` is the time since the start
+    of the batch.
+    '''
+    if filter is None:
+        filter = lambda d: True
+    if isinstance(folders,str):
+        folders = [folders]
+    if recursive:
+        folders = [os.path.join(root, dir) for folder in folders for root, dirs, _ in os.walk(folder) for dir in dirs]
+    valid_folders = [folder for folder in folders if filter(folder)]
+    print(len(valid_folders), 'folders')
+    if not callable(target):
+        target = os.path.abspath(target)
+
+    results = []
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=n_processes, initializer=initialize_worker,
+                             initargs=(preload,)) as executor:
+        futures = {executor.submit(run_task, target, folder, args): folder for folder in valid_folders}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception: # e.g. a worker process crashed (then all pending tasks fail)
+                result = {'folder': futures[future], 'status': 'failed', 'duration': time.time() - t0,
+                          'error': traceback.format_exc()}
+            results.append(result)
+            if verbose:
+                print('{} ({:.1f} s): {}'.format(result['status'], result['duration'], result['folder']))
+                if result['error'] is not None:
+                    print(result['error'])
+
+    n_successful = len([result for result in results if result['status'] == 'ok'])
+    print('Ran successfully on {} folders'.format(n_successful))
+    return results
+
+def read_job_logs(folders, joblog, stats_file):
+    '''
+    Returns the last exit code of each folder, from GNU parallel's job log and the statistics file
+    written by `job_wrapper.py`, and the statistics of each folder.
+    '''
+    folders = set(folders)
+    exit_codes, stats = {}, {}
+    if os.path.exists(joblog): # catches jobs killed before the wrapper could write statistics
+        with open(joblog, 'r') as f:
+            for line in f.readlines()[1:]: # Seq Host Starttime JobRuntime Send Receive Exitval Signal Command
+                columns = line.rstrip('\n').split('\t')
+                if len(columns) >= 9:
+                    try: # python job_wrapper.py stats_file python script folder [args...], shell-quoted
+                        command = shlex.split(columns[8])
+                        folder = command[[os.path.basename(arg) for arg in command].index('job_wrapper.py') + 4]
+                    except (ValueError, IndexError): # e.g. truncated line
+                        continue
+                    if folder in folders:
+                        exit_codes[folder] = int(columns[6])
+    if os.path.exists(stats_file):
+        with open(stats_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # interrupted while writing
+                    continue
+                exit_codes[entry['folder']] = entry['exit_code']
+                stats[entry['folder']] = entry
+    return exit_codes, stats
+
+def has_cluster():
+    '''
+    True if GNU parallel and the cluster profile (~/.parallel/cluster) are available.
+    '''
+    return os.path.exists(os.path.expanduser('~/.parallel/cluster')) and (shutil.which('parallel') is not None)
+
+def cluster_batch(python, script_name, folders, verbose=True, args=[], retries=1, n_processes=None):
     '''
     Calls `script_name` on each of the folders using parallel, on a cluster.
+    Without cluster profile, the script is run on a local pool of `n_processes` processes
+    (default: `jobs` in the configuration file).
+
+    Each job is run through `job_wrapper.py`, which records its exit code, runtime and peak memory.
+    Logs are kept in the current folder, in `<script>.joblog.txt` (GNU parallel) and `<script>.stats.jsonl`.
+    If the batch is interrupted or some folders fail, calling `cluster_batch` again skips folders that
+    have succeeded. Failed folders are run again up to `retries` times.
+    When all folders have succeeded, logs are renamed with the date, so that the next batch starts anew.
+
+    Returns a dictionary mapping folders to statistics (`exit_code`, `runtime` in s, `max_rss` in MB, `host`).
     '''
-    # First write the list of filenames to a file
-    with open('filenames.txt', 'w') as f:
-        f.write('\n'.join(folders))
+    name = os.path.splitext(os.path.basename(script_name))[0]
+    joblog, stats_file = os.path.abspath(name+'.joblog.txt'), os.path.abspath(name+'.stats.jsonl')
+    wrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_wrapper.py')
+    script_name = os.path.abspath(script_name)
+    cluster = has_cluster()
+    if n_processes is None:
+        n_processes = config.get('jobs', 5)
+
+    for attempt in range(retries + 1):
+        exit_codes, _ = read_job_logs(folders, joblog, stats_file)
+        remaining = [folder for folder in folders if exit_codes.get(folder, None) != 0]
+        if len(remaining) == 0:
+            break
+        if verbose:
+            print('{} folders to run ({} already done){}'.format(len(remaining), len(folders) - len(remaining),
+                                                               ', attempt {}'.format(attempt+1) if attempt>0 else ''))
+        if cluster:
+            with tempfile.TemporaryFile('w+', dir=os.path.dirname(joblog), prefix=name+'.',
+                                        suffix='.filenames.txt') as f: # deleted when closed
+                f.write('\n'.join(remaining))
+                f.seek(0)
+                subprocess.call(['parallel', '-Jcluster', '--joblog', '+'+joblog, python, wrapper, stats_file,
+                                 python, script_name, '{}'] + list(args), stdin=f)
+        else:
+            with ThreadPoolExecutor(max_workers=n_processes) as executor: # threads wait for the processes
+                list(executor.map(lambda folder: subprocess.call([sys.executable, wrapper, stats_file, python,
+                                                                  script_name, folder] + list(args)), remaining))
 
-    # Call parallel
-    os.system('cat filenames.txt | parallel -Jcluster --joblog joblog.txt '+python+' -W ignore '+script_name+' {} '+' '.join(args))
+    exit_codes, stats = read_job_logs(folders, joblog, stats_file)
+    stats = {folder: stats.get(folder, {'exit_code': exit_codes.get(folder, None)}) for folder in folders}
+    failed = [folder for folder in folders if stats[folder]['exit_code'] != 0]
+    if verbose:
+        print('Ran successfully on {} folders, {} failed'.format(len(folders) - len(failed), len(failed)))
+        for folder in failed:
+            print('Failed:', folder)
+        timed = sorted([folder for folder in folders if 'runtime' in stats[folder]],
+                       key=lambda folder: stats[folder]['runtime'], reverse=True)
+        for folder in timed[:5]:
+            print('{:.1f} s, {} MB: {}'.format(stats[folder]['runtime'], stats[folder]['max_rss'] and
+                                               int(stats[folder]['max_rss']), folder))
+    if len(failed) == 0: # start anew next time
+        suffix = datetime.datetime.now().strftime('.%Y-%m-%d %H.%M.%S')
+        for filename in [joblog, stats_file]:
+            if os.path.exists(filename):
+                os.rename(filename, filename + suffix)
+    return stats
 
 def run_this_on_all_cells(path):
     '''
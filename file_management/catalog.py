@@ -0,0 +1,206 @@
+'''
+Persistent catalog of data folders, in an SQLite database.
+
+The catalog stores the content of directories (subfolders and files) and information extracted from them
+(protocol type, lab notes...), so that the directory tree is not rescanned and files are not parsed again.
+Entries are refreshed incrementally: a directory is listed again only if its modification time has changed,
+and extracted information is recomputed only if the files it is extracted from have changed.
+Listings are also kept in memory, and checked against the modification time of the directory when they are
+used again. Directories are not checked at all if they were checked less than `catalog_max_age` seconds ago
+(configuration file, default 0).
+
+The database is `catalog` in the configuration file (default ~/.cache/paramecium_model_fitting/catalog.sqlite).
+It uses the default rollback journal (WAL does not work on network file systems); on a cluster with a shared
+home directory, `catalog` can be set to a node-local path.
+If it cannot be opened or a query fails (e.g. the database is locked), everything is read from the file system.
+
+`catalog_table` returns a table of all protocols with cell information (dates, protocol types, trials,
+lab notes, solutions, derived products). The database itself only memoizes directory listings and extracted
+information (pickled, keyed by path): the table is built from them, and is not stored.
+'''
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from .configuration import config
+
+__all__ = ['refresh_catalog', 'catalog_table']
+
+_local = threading.local()
+_checked = {} # (modification time, time of check, listing) of directories checked in this process
+
+def database():
+    '''
+    Returns the connection to the catalog (one per thread), or None if it cannot be opened.
+    '''
+    if not hasattr(_local, 'connection'):
+        filename = os.path.expanduser(config.get('catalog',
+                                                 '~/.cache/paramecium_model_fitting/catalog.sqlite'))
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            connection = sqlite3.connect(filename, timeout=60, isolation_level=None) # autocommit
+            try: # catalogs created in WAL mode are switched back to the rollback journal
+                connection.execute('PRAGMA journal_mode=DELETE')
+            except sqlite3.Error: # e.g. in use by another process
+                pass
+            connection.execute('''CREATE TABLE IF NOT EXISTS directories
+                                  (path TEXT PRIMARY KEY, mtime INTEGER, checked REAL, subdirs BLOB, files BLOB)''')
+            connection.execute('''CREATE TABLE IF NOT EXISTS information
+                                  (kind TEXT, path TEXT, stamp BLOB, value BLOB, PRIMARY KEY (kind, path))''')
+        except (OSError, sqlite3.Error):
+            connection = None
+        _local.connection = connection
+    return _local.connection
+
+def scan(folder):
+    subdirs, files = [], []
+    for f in os.scandir(folder):
+        if f.is_dir():
+            subdirs.append(f.name)
+        else:
+            files.append(f.name)
+    return sorted(subdirs), sorted(files)
+
+def query(sql, parameters):
+    '''
+    Executes a query on the catalog. Returns the cursor, or None if the catalog cannot be used.
+    '''
+    db = database()
+    if db is None:
+        return None
+    try:
+        return db.execute(sql, parameters)
+    except sqlite3.Error:
+        return None
+
+def folder_mtime(folder):
+    '''
+    Returns the modification time of `folder`, or None if it cannot be accessed (e.g. deleted or renamed).
+    '''
+    try:
+        return os.stat(folder).st_mtime_ns
+    except OSError:
+        return None
+
+def listing(folder):
+    '''
+    Returns the names of subfolders and files in `folder`, from the catalog if the folder has not changed.
+    '''
+    max_age = config.get('catalog_max_age', 0)
+    if folder in _checked:
+        mtime, checked, content = _checked[folder]
+        if (time.time() - checked < max_age) or (folder_mtime(folder) == mtime):
+            return content
+    cursor = query('SELECT mtime, checked, subdirs, files FROM directories WHERE path=?', (folder,))
+    row = None if cursor is None else cursor.fetchone()
+    if (row is not None) and (time.time() - row[1] < max_age):
+        content = pickle.loads(row[2]), pickle.loads(row[3])
+        _checked[folder] = row[0], row[1], content
+        return content
+    mtime = folder_mtime(folder)
+    if mtime is None: # stale entries are dropped, and the file system raises the error (e.g. FileNotFoundError)
+        forget(folder)
+        query('DELETE FROM directories WHERE path=?', (folder,))
+        return scan(folder)
+    if (row is not None) and (row[0] == mtime):
+        query('UPDATE directories SET checked=? WHERE path=?', (time.time(), folder))
+        content = pickle.loads(row[2]), pickle.loads(row[3])
+    else:
+        content = scan(folder)
+        if cursor is not None:
+            query('INSERT OR REPLACE INTO directories VALUES (?,?,?,?,?)',
+                  (folder, mtime, time.time(), pickle.dumps(content[0]), pickle.dumps(content[1])))
+    _checked[folder] = mtime, time.time(), content
+    return content
+
+def forget(folder):
+    '''
+    Forces `folder` to be checked again (e.g. after creating a subfolder).
+    '''
+    _checked.pop(folder, None)
+
+def subfolders(folder):
+    '''
+    Returns the paths of subfolders.
+    '''
+    return [os.path.join(folder, name) for name in listing(folder)[0]]
+
+def walk(folder):
+    '''
+    Walks through the folder tree, as `os.walk`, using the catalog.
+    '''
+    subdirs, files = listing(folder)
+    yield folder, subdirs, files
+    for name in subdirs:
+        for entry in walk(os.path.join(folder, name)):
+            yield entry
+
+def file_stamp(*filenames):
+    '''
+    Returns the modification times of files (None for missing files).
+    '''
+    stamp = []
+    for filename in filenames:
+        try:
+            stamp.append(os.stat(filename).st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+def cached_information(kind, folder, stamp, compute):
+    '''
+    Returns information of type `kind` about `folder`, from the catalog if `stamp` (e.g. modification times
+    of the files it is extracted from) has not changed, otherwise calls `compute()` and stores the result.
+    '''
+    stamp = pickle.dumps([folder, stamp])
+    cursor = query('SELECT stamp, value FROM information WHERE kind=? AND path=?', (kind, folder))
+    if cursor is None:
+        return compute()
+    row = cursor.fetchone()
+    if (row is not None) and (row[0] == stamp):
+        return pickle.loads(row[1])
+    value = compute()
+    query('INSERT OR REPLACE INTO information VALUES (?,?,?,?)', (kind, folder, stamp, pickle.dumps(value)))
+    return value
+
+def refresh_catalog(*folders):
+    '''
+    Updates the catalog for all cells and protocols in `folders` (recursively).
+    Returns the number of protocols.
+    '''
+    for path in [path for path in _checked if any([path.startswith(folder) for folder in folders])]:
+        del _checked[path] # check again
+    return len(catalog_table(*folders))
+
+def catalog_table(*folders):
+    '''
+    Returns a list of dictionaries, one per protocol folder in `folders` (recursively), with:
+    * `cell`, `protocol`: cell and protocol folders
+    * `date`: recording date of the cell
+    * `type`: protocol type (see `protocol`), `ntrials`: number of trials
+    * `products`: subfolders of the protocol folder (e.g. piv, piv_analysis, tracked_ends)
+    * `fits`: names of fits of the cell
+    * `PIV`: whether the cell has PIV data
+    * `notes`: the content of the cell's notes.yaml, if it exists
+    * and information extracted from lab notes (see `read_lab_notes`): keywords, solutions...
+    '''
+    from .batch_processing import cell_folders, is_protocol_folder
+    from .folder_information import read_lab_notes, recording_date, protocol, protocol_description, is_PIV, \
+        cell_notes
+    table = []
+    for cell in cell_folders(*folders, recursive=True):
+        subdirs, files = listing(cell)
+        cell_info = {'cell': cell, 'date': recording_date(cell), 'PIV': is_PIV(cell), 'notes': cell_notes(cell),
+                     'fits': sorted([name[:-5] for name in listing(os.path.join(cell, 'fits'))[1]
+                                     if name.endswith('.yaml')]) if 'fits' in subdirs else []}
+        cell_info.update(read_lab_notes(cell))
+        for folder in [cell] + [os.path.join(cell, name) for name in subdirs]:
+            if is_protocol_folder(folder):
+                description = protocol_description(folder)
+                row = dict(cell_info)
+                row.update({'protocol': folder, 'type': protocol(folder),
+                            'ntrials': None if description is None else description.get('ntrials', None),
+                            'products': listing(folder)[0]})
+                table.append(row)
+    return table
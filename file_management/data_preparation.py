@@ -3,29 +3,59 @@ Selection of data
 '''
 import yaml
 import os
-from brian2 import second
+from brian2 import second, Quantity
+from brian2.units.fundamentalunits import get_dimensions
 import numpy as np
+from scipy.signal import decimate
 from numpy import mean
 
-__all__ = ['trim_data', 'stimulus_time', 'amplitudes', 'select_trials', 'merge_data', 'align_traces', 'subsample']
+__all__ = ['trim_data', 'stimulus_time', 'amplitudes', 'select_trials', 'merge_data', 'align_traces', 'subsample',
+           'subsample_pyramid']
 
-def subsample(data, n):
+def subsample(data, n, filter=True):
     '''
-    Subsamples the data n times.
+    Subsamples the data n times (in place), for all variables and trials at once.
+    If `filter` is True, the traces are low-pass filtered before decimation to avoid aliasing
+    (zero-phase FIR filter, see `scipy.signal.decimate`).
+    Triggers are moved to the nearest earlier sample.
+    Returns the data.
     '''
+    n_steps = len(data['t'])
     data['t'] = data['t'][::n]
-    for var in data:
-        if (var != 't') & (var != 'trigger'):
-            data[var] = data[var][:,::n]
+
+    # All traces are stacked in a single array, filtered and decimated together
+    variables = [var for var in data if (var != 't') & (var != 'trigger')]
+    if len(variables) > 0:
+        shapes = [np.shape(data[var]) for var in variables]
+        traces = np.vstack([np.asarray(data[var], dtype=float).reshape((-1, n_steps)) for var in variables])
+        if filter and n > 1:
+            traces = decimate(traces, n, ftype='fir', axis=1, zero_phase=True)
+        else:
+            traces = traces[:, ::n]
+        i = 0
+        for var, shape in zip(variables, shapes):
+            n_traces = int(np.prod(shape[:-1]))
+            value = traces[i:i+n_traces].reshape(shape[:-1] + (traces.shape[1],))
+            data[var] = Quantity(value, dim=data[var].dim) if isinstance(data[var], Quantity) else value
+            i += n_traces
 
     # Triggers are more complicated!
-    ntrials = data['trigger'].shape[0]
-    new_trigger = np.zeros((ntrials,len(data['t'])))
-    for i in range(ntrials):
-        trigger_i = (data['trigger'][i]>0).nonzero()[0]
-        new_trigger[i,:] = np.zeros(len(data['t']))
-        new_trigger[i,(trigger_i/n).astype(int)] = 1
-    data['trigger'] = new_trigger
+    if 'trigger' in data:
+        new_trigger = np.zeros((data['trigger'].shape[0], len(data['t'])))
+        trial, trigger_i = (data['trigger'] > 0).nonzero()
+        new_trigger[trial, trigger_i // n] = 1
+        data['trigger'] = new_trigger
+    return data
+
+def subsample_pyramid(data, levels=3, n=4, filter=True):
+    '''
+    Returns a list of `levels` datasets, subsampled 1, n, n**2... times (e.g. full resolution, /4, /16).
+    Each level is subsampled from the previous one; `data` is not modified.
+    '''
+    pyramid = [data]
+    for _ in range(levels - 1):
+        pyramid.append(subsample(dict(pyramid[-1]), n, filter=filter))
+    return pyramid
 
 def align_traces(v, v0, selection):
     '''
@@ -39,14 +69,33 @@ def merge_data(data):
     '''
     Merges a list of data sets.
     `t` is taken from the last trial (thus, assumed identical in all trials).
+    2D arrays (trials x time) are concatenated along trials, in a single copy.
+    Raises ValueError if their shapes or units do not match.
     '''
     dataset = {}
+    values = {}
     for single_set in data:
         for x, value in single_set.items():
-            if (len(value.shape) == 1) or (x not in dataset):
+            if (len(value.shape) == 1):
                 dataset[x] = value
             else: # assuming 2
-                dataset[x] = np.vstack([dataset[x], value])
+                dataset.setdefault(x, None) # keeps the order of variables
+                values.setdefault(x, []).append(value)
+
+    for x, arrays in values.items():
+        shapes = set([value.shape[1:] for value in arrays])
+        if len(shapes) > 1:
+            raise ValueError('Cannot merge {}: shapes {} do not match'.format(x, [value.shape for value in arrays]))
+        dim = get_dimensions(arrays[0])
+        if any([get_dimensions(value) is not dim for value in arrays]):
+            raise ValueError('Cannot merge {}: units do not match'.format(x))
+        merged = np.empty((sum([len(value) for value in arrays]),) + arrays[0].shape[1:],
+                          dtype=np.result_type(*[np.asarray(value) for value in arrays]))
+        i = 0
+        for value in arrays:
+            merged[i:i+len(value)] = np.asarray(value)
+            i += len(value)
+        dataset[x] = Quantity(merged, dim=dim) if isinstance(arrays[0], Quantity) else merged
     return dataset
 
 def trim_data(data, t_end):
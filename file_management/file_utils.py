@@ -2,6 +2,7 @@
 Some tools for file management
 '''
 import os
+from .catalog import forget
 
 __all__ = ['up_dir', 'make_subdir']
 
@@ -12,4 +13,5 @@ def make_subdir(path, dir):
     folder = os.path.join(path, dir)
     if not os.path.exists(folder):
         os.mkdir(folder)
+        forget(path)
     return folder
@@ -2,6 +2,7 @@
 Information about cell folders
 
 This is only useful for data with old formats, except cell_orientation.
+Directory listings and extracted information are stored in the catalog (see `catalog.py`).
 '''
 import os
 import re
@@ -9,6 +10,7 @@ import datetime
 from clampy import *
 import yaml
 import numpy as np
+from .catalog import listing, subfolders, walk, file_stamp, cached_information
 
 __all__ = ['read_lab_notes', 'is_PIV', 'protocol', 'protocols', 'stimulus_time', 'protocol_description',
            'recording_date', 'cell_orientation']
@@ -53,13 +55,12 @@ def protocol_description(folder):
     # Look for yaml file
     name = None
 
-    for f in os.scandir(folder):
-        if ((f.path[-5:]=='.yaml') and (f.path[-23:]!='manual_measurement.yaml')) or (f.path[-5:]=='.info'):
-            name = f.path
+    for filename in listing(folder)[1]:
+        if ((filename[-5:]=='.yaml') and (filename[-23:]!='manual_measurement.yaml')) or (filename[-5:]=='.info'):
+            name = os.path.join(folder, filename)
             break
     if name is not None:
-        info = load_info(name)
-        return info
+        return cached_information('protocol_description', folder, [name, file_stamp(name)], lambda: load_info(name))
     else:
         return None
 
@@ -95,21 +96,38 @@ def recording_date(folder):
     except:
         # Look at protocol dates
         dates = []
-        for f in os.scandir(folder):
-            if f.is_dir():
-                date = recording_date(f.path)
-                if date is not None:
-                    dates.append(date)
+        for f in subfolders(folder):
+            date = recording_date(f)
+            if date is not None:
+                dates.append(date)
         if len(dates)>0:
             return min(dates)
         else:
             return None
 
+def lab_notes_file(folder):
+    '''
+    Returns the lab notes file, either directly in the folder or in a subfolder (None if there is none).
+    '''
+    if "lab_notes.txt" in listing(folder)[1]:
+        return os.path.join(folder,"lab_notes.txt")
+    for f in subfolders(folder):
+        if "lab_notes.txt" in listing(f)[1]:
+            return os.path.join(f,"lab_notes.txt")
+    return None
+
 def read_lab_notes(folder):
     '''
     Reads lab notes in a subfolder and extract information.
     '''
+    filename = lab_notes_file(folder)
+    return cached_information('lab_notes', folder, [filename, file_stamp(filename) if filename else None],
+                              lambda: parse_lab_notes(folder, filename))
 
+def parse_lab_notes(folder, filename):
+    '''
+    Extracts information from lab notes `filename` (None if there are no lab notes) of a cell folder.
+    '''
     info = {}
 
     # Extract date and time # !! this is the cell date, not the protocol date
@@ -130,18 +148,6 @@ def read_lab_notes(folder):
     info['extra KCl'] = 4.
     info['extra CaCl2'] = 1.
 
-    # Look for a folder with lab notes
-    # Either directly in the folder
-    filename = None
-    if os.path.exists(os.path.join(folder,"lab_notes.txt")):
-        filename = os.path.join(folder,"lab_notes.txt")
-    else:
-        # Or in a subfolder
-        for f in os.scandir(folder):
-            if os.path.isdir(f) and os.path.exists(os.path.join(f.path,"lab_notes.txt")):
-                filename = os.path.join(f.path,"lab_notes.txt")
-                break
-
     if filename is None:
         return info
 
@@ -209,10 +215,31 @@ def read_lab_notes(folder):
 
     return info
 
+def cell_notes(folder):
+    '''
+    Returns the content of notes.yaml in the cell folder (None if there is none).
+    '''
+    if 'notes.yaml' not in listing(folder)[1]:
+        return None
+    filename = os.path.join(folder, 'notes.yaml')
+    def load():
+        with open(filename, 'r') as fp:
+            return yaml.safe_load(fp)
+    return cached_information('notes', folder, file_stamp(filename), load)
+
 def protocol(folder):
     '''
     Returns protocol type for the folder.
     '''
+    info_files = [os.path.join(folder, filename) for filename in listing(folder)[1]
+                  if (filename[-5:]=='.yaml') or (filename[-5:]=='.info')]
+    return cached_information('protocol', folder, [info_files, file_stamp(*info_files)],
+                              lambda: protocol_type(folder))
+
+def protocol_type(folder):
+    '''
+    Determines protocol type from the folder name and protocol description.
+    '''
     name = os.path.split(folder)[1]
     if (('current_pulses' in name) or ('Current pulses' in name)):
         # Open info file
@@ -256,7 +283,7 @@ def protocols(folder):
     '''
     Returns list of protocols in the folder
     '''
-    results = [protocol(f.path) for f in os.scandir(folder) if os.path.isdir(f)]
+    results = [protocol(f) for f in subfolders(folder)]
     return [x for x in results if len(x)>0]
 
 def is_PIV(folder):
@@ -264,13 +291,11 @@ def is_PIV(folder):
     True if there is PIV data
     '''
     # Look into all folders to check if there is a PIV folder
-    PIV = False
-    for root, dirs, files in os.walk(folder):
+    for root, dirs, files in walk(folder):
         for dir in dirs:
             if dir[-4:]=='_PIV':
-                PIV = True
-                break
-    return PIV
+                return True
+    return False
 
 if __name__ == '__main__':
     folder = '/Volumes/Public/Paramecium/Electrophysiology/Session July-December 2020/5.11.2020 16.55.7 Cell_VC'
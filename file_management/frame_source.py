@@ -0,0 +1,288 @@
+'''
+Frame sources: the frames of a trial, read either from its folder of TIFF files (`protocol/images/NNN`)
+or from the compressed movie made by `make_movie.py` (`protocol/images/NNN.mp4`), so that TIFF files can be
+deleted once movies are made.
+
+Frames can be accessed by index (`source[i]`; `source[i:j]` returns an array) and iterated. During iteration,
+frames are read ahead, at most `prefetch` frames in advance (memory is bounded): TIFF files are decoded by a
+pool of `n_threads` threads, movies are decoded sequentially in a background thread.
+Frames can also be iterated as float32 arrays that are views of reused buffers (`float_frames`).
+Movie frames are 8-bit grayscale images (see `make_movie.py`). The size of the original images is stored
+with the movie (`protocol/images/NNN.yaml`); movies whose frames have a different size (e.g. resized by the codec)
+are refused, since image coordinates would not match.
+
+Missed frames (the camera repeats the previous frame) are identical images in TIFF files. Since compression does
+not preserve this exactly, they are stored with the movie by `make_movie.py`; for movies made without this
+information, frames differing from the previous one by at most `duplicate_tolerance` gray levels are considered
+missed (see `FrameSource.is_duplicate`).
+
+Example:
+    with open_frames(trial) as source:
+        reference = source[0]
+        for frame in source:
+            ...
+'''
+import os
+import threading
+import warnings
+import queue
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import imageio
+import yaml
+
+__all__ = ['trial_files', 'movie_filename', 'movie_metadata', 'FrameSource', 'TIFFSource', 'MovieSource',
+           'frame_files', 'is_movie', 'open_frames']
+
+duplicate_tolerance = 2 # in gray levels, for missed frames in movies without stored missed frames
+
+def trial_files(folder):
+    '''
+    Returns the sorted list of image files of a trial folder.
+    '''
+    files = [f.path for f in os.scandir(folder) if f.name[-5:]=='.tiff']
+    files.sort()
+    return files
+
+def movie_filename(trial):
+    '''
+    Returns the name of the movie of a trial (`images/NNN.mp4` for trial `images/NNN`).
+    '''
+    return os.path.normpath(trial) + '.mp4'
+
+def movie_metadata(trial):
+    '''
+    Returns the description of the images of the movie of `trial` written by `make_movie.py`
+    (`images/NNN.yaml`, with `width`, `height`, `frames`, `missed_frames`), or None if there is none.
+    '''
+    try:
+        with open(os.path.normpath(trial) + '.yaml', 'r') as fp:
+            return yaml.safe_load(fp)
+    except OSError:
+        return None
+
+class FrameSource(object):
+    '''
+    Frames of a trial. Subclasses implement `__len__`, `read` (one frame) and `frames` (sequential reading),
+    and define `files` (the files that frames are read from). If `parallel` is True, `read` can be called
+    from several threads, and frames are decoded ahead by a pool of `n_threads` threads.
+    '''
+    parallel = False
+
+    def __init__(self, prefetch=8, n_threads=1):
+        self.prefetch = prefetch
+        self.n_threads = n_threads
+        if len(self) > 0:
+            first = self.read(0)
+            self.shape, self.dtype = (len(self),) + first.shape, first.dtype
+        else:
+            self.shape, self.dtype = (0,), None
+
+    def read(self, i):
+        raise NotImplementedError
+
+    def frames(self, start, stop):
+        raise NotImplementedError
+
+    def is_duplicate(self, i, frame, previous):
+        '''
+        True if frame `i` repeats the previous frame (a missed frame).
+        '''
+        return np.array_equal(frame, previous)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if (step != 1) or (start >= stop):
+                return np.array([self.read(i) for i in range(start, stop, step)]).reshape((-1,) + self.shape[1:])
+            return np.array(list(self.frames(start, stop)))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame index out of range')
+        return self.read(index)
+
+    def __iter__(self):
+        return self.prefetched(0, len(self))
+
+    def prefetched(self, start, stop):
+        '''
+        Yields frames `start` to `stop`-1, read ahead in a background thread (or a pool of threads).
+        '''
+        if self.prefetch == 0:
+            yield from self.frames(start, stop)
+            return
+        if self.parallel and (self.n_threads > 1):
+            yield from self.decoded(start, stop)
+            return
+        frames = queue.Queue(self.prefetch)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def read():
+            reader = self.frames(start, stop)
+            try:
+                for frame in reader:
+                    put((True, frame))
+                    if stopped.is_set():
+                        return
+                put((False, None))
+            except Exception as error:
+                put((False, error))
+            finally:
+                reader.close()
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+        try:
+            while True:
+                ok, frame = frames.get()
+                if not ok:
+                    if frame is not None:
+                        raise frame
+                    return
+                yield frame
+        finally:
+            stopped.set()
+            thread.join()
+
+    def decoded(self, start, stop):
+        '''
+        Yields frames `start` to `stop`-1, decoded ahead by a pool of threads.
+        '''
+        indexes = iter(range(start, min(stop, len(self))))
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            pending = deque([executor.submit(self.read, i) for i in islice(indexes, self.prefetch)])
+            try:
+                while len(pending) > 0:
+                    frame = pending.popleft().result()
+                    i = next(indexes, None)
+                    if i is not None:
+                        pending.append(executor.submit(self.read, i))
+                    yield frame
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def float_frames(self, start=0, stop=None, buffers=2):
+        '''
+        Yields frames `start` to `stop`-1 as float32 arrays, which are views of `buffers` reused buffers:
+        a frame is overwritten `buffers` frames later (copy frames to keep them longer).
+        '''
+        buffer = np.empty((buffers,) + self.shape[1:], dtype=np.float32)
+        for i, frame in enumerate(self.prefetched(start, len(self) if stop is None else stop)):
+            view = buffer[i % buffers]
+            view[:] = frame
+            yield view
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TIFFSource(FrameSource):
+    '''
+    Frames of a trial folder of TIFF files (listed once), or of a list of image files.
+    '''
+    parallel = True
+
+    def __init__(self, folder, prefetch=8, n_threads=4):
+        self.files = list(folder) if isinstance(folder, (list, tuple)) else trial_files(folder)
+        FrameSource.__init__(self, prefetch, n_threads)
+
+    def __len__(self):
+        return len(self.files)
+
+    def read(self, i):
+        return imageio.imread(self.files[i])
+
+    def frames(self, start, stop):
+        for filename in self.files[start:stop]:
+            yield imageio.imread(filename)
+
+class MovieSource(FrameSource):
+    '''
+    Frames of a trial movie (grayscale; the first channel of decoded frames).
+    Frames are decoded sequentially; random access seeks in the movie.
+    The movie is refused if its frames do not have the size of the original images (see `movie_metadata`).
+    '''
+    def __init__(self, filename, prefetch=8, n_threads=1):
+        self.files = [filename]
+        self.reader = imageio.get_reader(filename, 'ffmpeg')
+        self.n_frames = self.reader.count_frames()
+        self.lock = threading.Lock()
+        self.metadata = movie_metadata(filename[:-4])
+        FrameSource.__init__(self, prefetch, n_threads)
+        if self.metadata is None:
+            warnings.warn('{}: no image size stored with the movie, frame coordinates cannot be checked'.
+                          format(filename))
+        elif self.shape[1:] != (self.metadata['height'], self.metadata['width']):
+            self.close()
+            raise ValueError('{}: frames are {}x{} pixels, images were {}x{} (remake the movie with make_movie.py)'.
+                             format(filename, self.shape[2], self.shape[1], self.metadata['width'],
+                                    self.metadata['height']))
+
+    def __len__(self):
+        return self.n_frames
+
+    def read(self, i):
+        with self.lock:
+            return self.reader.get_data(i)[..., 0].copy()
+
+    def frames(self, start, stop):
+        reader = imageio.get_reader(self.files[0], 'ffmpeg') # independent from random access
+        try:
+            for i in range(start, min(stop, self.n_frames)):
+                yield reader.get_data(i)[..., 0].copy()
+        finally:
+            reader.close()
+
+    def is_duplicate(self, i, frame, previous):
+        if (self.metadata is not None) and ('missed_frames' in self.metadata): # found in the TIFF files
+            return i in self.metadata['missed_frames']
+        return np.abs(frame.astype(np.int16) - previous).max() <= duplicate_tolerance
+
+    def close(self):
+        self.reader.close()
+
+def frame_files(trial):
+    '''
+    Returns the files that the frames of `trial` are read from: its TIFF files if there are any,
+    otherwise its movie.
+    '''
+    files = trial_files(trial) if os.path.isdir(trial) else []
+    if (len(files) == 0) and os.path.exists(movie_filename(trial)):
+        files = [movie_filename(trial)]
+    return files
+
+def is_movie(trial):
+    '''
+    True if the frames of `trial` are read from its movie (there are no TIFF files).
+    '''
+    files = frame_files(trial)
+    return (len(files) > 0) and (files[0][-4:] == '.mp4')
+
+def open_frames(trial, prefetch=8, n_threads=4):
+    '''
+    Returns the frame source of `trial` (`protocol/images/NNN`), from its TIFF files if there are any,
+    otherwise from its movie. TIFF files are decoded by `n_threads` threads, up to `prefetch` frames ahead.
+    '''
+    files = frame_files(trial)
+    if len(files) == 0:
+        raise FileNotFoundError('No images for trial {}'.format(trial))
+    if files[0][-4:] == '.mp4':
+        return MovieSource(files[0], prefetch)
+    return TIFFSource(files, prefetch, n_threads)
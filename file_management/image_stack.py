@@ -0,0 +1,231 @@
+'''
+Image stacks of trials (folders `protocol/images/NNN` of TIFF files, or movies `protocol/images/NNN.mp4`,
+see `frame_source.py`), with a cache of preprocessed stacks.
+
+The mean image of each trial (background) is stored in the cache folder `protocol/images/.NNN.cache`,
+with the list of missed frames (frames repeating the previous one).
+Background-subtracted stacks filtered with a double Gaussian (`preprocessed_stack`) are stored in the same
+folder, one file per filter width (float32, memory-mapped). Raw frames are not cached: TIFF files are read once,
+and the background and filtered frames are calculated in the same pass (the filter is linear, so the filtered
+background is subtracted at the end).
+For movies, only the background is cached: filtered frames are calculated from the movie as they are iterated
+(a second pass), since the filtered stack would be many times larger than the compressed movie. The same applies
+if the cache folder cannot be written.
+The cache is invalidated when the TIFF files or the movie change (names, sizes and modification times).
+Cache folders can be deleted to save space.
+
+Example:
+    for trial in image_trials(path):
+        background, filtered = preprocessed_stack(trial, sigma)
+        for frame in filtered:
+            ...
+'''
+import os
+import shutil
+import hashlib
+import tempfile
+import yaml
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from .frame_source import frame_files, is_movie, open_frames
+
+__all__ = ['image_trials', 'dog_filter', 'load_background', 'missed_frames', 'FilteredFrames', 'preprocessed_stack']
+
+def image_trials(path):
+    '''
+    Returns the sorted list of trials (image folders `images/NNN`, or movies `images/NNN.mp4` without
+    the extension) of protocol folder `path`.
+    '''
+    trials = set()
+    for f in os.scandir(os.path.join(path, 'images')):
+        name, extension = os.path.splitext(f.name)
+        if name.isnumeric() and (extension in ['', '.mp4']):
+            trials.add(os.path.join(path, 'images', name))
+    return sorted(trials)
+
+def dog_filter(image, sigma):
+    '''
+    Double Gaussian filter, to enhance particles of size `sigma` (in pixels; sigma of the inner Gaussian).
+    '''
+    return (gaussian_filter(image, sigma, truncate=2) - gaussian_filter(image, sigma * 1.6, truncate=2)) * 1.3 * sigma
+
+def stack_cache_folder(folder):
+    parent, name = os.path.split(os.path.normpath(folder))
+    return os.path.join(parent, '.'+name+'.cache')
+
+def stack_signature(files):
+    '''
+    Returns a hash of the names, sizes and modification times of files.
+    '''
+    description = []
+    for filename in files:
+        stat = os.stat(filename)
+        description.append('{} {} {}'.format(os.path.basename(filename), stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1('\n'.join(description).encode()).hexdigest()
+
+def read_background_cache(folder, signature):
+    '''
+    Returns the background, number of frames and missed frames of trial `folder` from its cache,
+    or None if there is no valid cache.
+    '''
+    cache = stack_cache_folder(folder)
+    try:
+        with open(os.path.join(cache, 'signature.yaml'), 'r') as fp:
+            description = yaml.safe_load(fp)
+        if description['files'] != signature:
+            return None
+        return np.load(os.path.join(cache, 'background.npy')), description['frames'], description['missed_frames']
+    except (OSError, KeyError, TypeError, ValueError):
+        return None
+
+def read_trial(source, sigma=None, filtered=None):
+    '''
+    Reads all frames of `source` once. Returns the mean image (background) and the list of missed frames
+    (see `missed_frames`). If `filtered` is not None, frames after background subtraction and double Gaussian
+    filtering with width `sigma` are written into it: since the filter is linear, frames are filtered as they
+    are read, and the filtered background is subtracted at the end.
+    '''
+    background = np.zeros(source.shape[1:])
+    missed, previous = [], None
+    for i, frame in enumerate(source):
+        background += frame
+        if (previous is not None) and source.is_duplicate(i, frame, previous):
+            missed.append(i)
+        previous = frame
+        if filtered is not None:
+            filtered[i] = dog_filter(frame.astype(np.float64), sigma)
+    background = background/len(source)
+    if filtered is not None:
+        filtered_background = dog_filter(background, sigma)
+        for i in range(len(filtered)):
+            filtered[i] -= filtered_background
+    return background, missed
+
+def new_cache_folder(folder):
+    '''
+    Creates a temporary folder next to the cache folder of trial `folder`, which replaces it when complete
+    (see `publish_cache_folder`). Raises OSError if the folder cannot be written.
+    '''
+    parent, name = os.path.split(stack_cache_folder(folder))
+    return tempfile.mkdtemp(prefix=name+'.new', dir=parent)
+
+def publish_cache_folder(folder, new_folder, signature, background, n_frames, missed):
+    '''
+    Writes the background, number of frames and missed frames of trial `folder` in `new_folder`,
+    which then replaces the cache folder.
+    '''
+    np.save(os.path.join(new_folder, 'background.npy'), background)
+    with open(os.path.join(new_folder, 'signature.yaml'), 'w') as fp:
+        yaml.dump({'files': signature, 'frames': n_frames, 'missed_frames': missed}, fp)
+    cache_folder = stack_cache_folder(folder)
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    os.rename(new_folder, cache_folder)
+
+def cached_background(folder, cache=True, n_threads=4):
+    '''
+    Returns the mean image (background) of trial `folder`, its number of frames, the list of missed frames
+    (see `missed_frames`), and whether the cache folder is valid. These are read from the cache if it is valid,
+    otherwise calculated from the TIFF files (decoded by `n_threads` threads) or the movie, and cached.
+    '''
+    if cache:
+        signature = stack_signature(frame_files(folder))
+        cached = read_background_cache(folder, signature)
+        if cached is not None:
+            return cached + (True,)
+
+    with open_frames(folder, n_threads=n_threads) as source:
+        background, missed = read_trial(source)
+        n_frames = len(source)
+
+    if cache:
+        new_folder = None
+        try:
+            new_folder = new_cache_folder(folder)
+            publish_cache_folder(folder, new_folder, signature, background, n_frames, missed)
+            return background, n_frames, missed, True
+        except OSError: # read-only folder, or written simultaneously by another process
+            if new_folder is not None:
+                shutil.rmtree(new_folder, ignore_errors=True)
+    return background, n_frames, missed, False
+
+def load_background(folder, cache=True, n_threads=4):
+    '''
+    Returns the mean image (background) of trial `folder`, from the cache if it is valid.
+    '''
+    return cached_background(folder, cache=cache, n_threads=n_threads)[0]
+
+def missed_frames(folder, cache=True, n_threads=4):
+    '''
+    Returns the list of missed frames of trial `folder`: frames that repeat the previous one (the camera
+    missed a frame), as found when reading the TIFF files or recorded by `make_movie.py` (see `frame_source.py`).
+    '''
+    return cached_background(folder, cache=cache, n_threads=n_threads)[2]
+
+class FilteredFrames(object):
+    '''
+    Frames of trial `folder` after subtraction of `background` and double Gaussian filtering with width `sigma`
+    (float32), calculated as they are iterated (frames are read ahead by `n_threads` threads).
+    '''
+    def __init__(self, folder, background, sigma, n_frames, n_threads=4):
+        self.folder = folder
+        self.background = background
+        self.sigma = sigma
+        self.n_threads = n_threads
+        self.shape = (n_frames,) + background.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        with open_frames(self.folder, n_threads=self.n_threads) as source:
+            for frame in source:
+                yield dog_filter(frame - self.background, self.sigma).astype(np.float32)
+
+def preprocessed_stack(folder, sigma, cache=True, n_threads=4):
+    '''
+    Returns the background of trial `folder` and the stack after background subtraction and double Gaussian
+    filtering with width `sigma` (see `dog_filter`), in float32.
+    The filtered stack is cached (one file per value of `sigma`) and memory-mapped; frames are read once to
+    calculate both the background and the filtered stack. For movies, or if it cannot be cached, filtered frames
+    are calculated as they are iterated (`FilteredFrames`), so that memory use is bounded.
+    '''
+    if cache and not is_movie(folder): # for movies, the float32 stack would be much larger than the movie
+        signature = stack_signature(frame_files(folder))
+        cache_folder = stack_cache_folder(folder)
+        name = 'dog_sigma{}.npy'.format(sigma)
+        cached = read_background_cache(folder, signature)
+        if cached is not None:
+            try:
+                return cached[0], np.load(os.path.join(cache_folder, name), mmap_mode='r')
+            except (OSError, ValueError):
+                pass
+
+        new_folder, temporary_filename = None, None
+        try:
+            if cached is None: # the background is calculated in the same pass, in a new cache folder
+                new_folder = new_cache_folder(folder)
+                temporary_filename = os.path.join(new_folder, name)
+            else:
+                temporary_filename = os.path.join(cache_folder, name + '.{}.tmp'.format(os.getpid()))
+            with open_frames(folder, n_threads=n_threads) as source:
+                filtered = np.lib.format.open_memmap(temporary_filename, mode='w+', dtype=np.float32,
+                                                     shape=source.shape)
+                background, missed = read_trial(source, sigma, filtered)
+            filtered.flush()
+            del filtered
+            if new_folder is not None:
+                publish_cache_folder(folder, new_folder, signature, background, len(source), missed)
+                new_folder = None
+            else:
+                os.replace(temporary_filename, os.path.join(cache_folder, name))
+            return background, np.load(os.path.join(cache_folder, name), mmap_mode='r')
+        except OSError: # read-only folder, or the cache was replaced by another process
+            pass
+        finally:
+            if new_folder is not None:
+                shutil.rmtree(new_folder, ignore_errors=True)
+            elif (temporary_filename is not None) and os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+
+    background, n_frames, _, _ = cached_background(folder, cache=cache, n_threads=n_threads)
+    return background, FilteredFrames(folder, background, sigma, n_frames, n_threads=n_threads)
@@ -0,0 +1,33 @@
+'''
+Runs a job of `cluster_batch` and records its exit code, runtime and peak memory.
+
+Usage: python job_wrapper.py stats_file python script folder [args...]
+
+This is run by path (not imported), so that it starts quickly.
+A line is appended to `stats_file` (JSON), and the exit code is that of the script.
+'''
+import sys
+import os
+import json
+import time
+import socket
+import subprocess
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+if __name__ == '__main__':
+    stats_file, command = sys.argv[1], sys.argv[2:]
+    folder = command[2]
+    t0 = time.time()
+    code = subprocess.call(command[:1] + ['-W', 'ignore'] + command[1:])
+    runtime = time.time() - t0
+    max_rss = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        max_rss = max_rss/2**20 if sys.platform == 'darwin' else max_rss/2**10 # in MB (bytes on macOS, kB on Linux)
+    with open(stats_file, 'a') as f:
+        f.write(json.dumps({'folder': folder, 'exit_code': code, 'runtime': runtime, 'max_rss': max_rss,
+                            'host': socket.gethostname(), 'end': time.time()}) + '\n')
+    sys.exit(code)
@@ -1,29 +1,116 @@
 '''
 Loads data sets
 
+load_multiple_data: loads the datasets of all protocols of a cell, with a binary cache.
 magic_load_data: only useful for data with old formats.
 '''
 from brian2 import *
+from brian2.units.fundamentalunits import get_or_create_dimension
 from clampy import *
 import os
+import shutil
+import tempfile
+import yaml
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from .data_preparation import merge_data
 from .file_utils import up_dir
 
-__all__ = ['rename_electrophysiology_data', 'magic_load_data', 'load_multiple_data']
+__all__ = ['rename_electrophysiology_data', 'magic_load_data', 'load_multiple_data', 'load_cached_dataset',
+           'cache_statistics']
 
-def load_multiple_data(path, name):
+# Number of datasets read from the binary cache (hits) and parsed from the data files (misses)
+cache_statistics = {'hits': 0, 'misses': 0}
+
+def dataset_signature(name):
+    '''
+    Returns the names, sizes and modification times of the files of dataset `name`
+    (files in the dataset folder starting with the dataset name).
+    '''
+    folder, base = os.path.split(name)
+    return sorted([[f.name, f.stat().st_size, f.stat().st_mtime_ns] for f in os.scandir(folder)
+                   if f.is_file() and f.name.startswith(base)])
+
+def cache_folder(name):
+    folder, base = os.path.split(name)
+    return os.path.join(folder, '.'+base+'.cache')
+
+def read_cache(name, signature):
+    '''
+    Returns the dataset `name` from its cache, or None if there is no valid cache.
+    Arrays are memory-mapped (copy on write).
+    '''
+    folder = cache_folder(name)
+    try:
+        with open(os.path.join(folder, 'signature.yaml'), 'r') as fp:
+            description = yaml.safe_load(fp)
+        if description['files'] != signature:
+            return None
+        data = {}
+        for var, dims in description['dimensions'].items():
+            value = np.load(os.path.join(folder, var+'.npy'), mmap_mode='c')
+            data[var] = value if dims is None else Quantity(value, dim=get_or_create_dimension(dims))
+        return data
+    except (OSError, KeyError, TypeError, ValueError):
+        return None
+
+def write_cache(name, signature, data):
+    '''
+    Writes the cache of dataset `name`, if possible (arrays only, writable folder).
+    '''
+    if not all([isinstance(value, np.ndarray) and value.dtype != object for value in data.values()]):
+        return
+    folder = cache_folder(name)
+    new_folder = None
+    try:
+        new_folder = tempfile.mkdtemp(prefix=os.path.split(folder)[1]+'.new', dir=os.path.split(folder)[0])
+        dimensions = {}
+        for var, value in data.items():
+            np.save(os.path.join(new_folder, var+'.npy'), np.asarray(value))
+            dimensions[var] = list(value.dim._dims) if isinstance(value, Quantity) else None
+        with open(os.path.join(new_folder, 'signature.yaml'), 'w') as fp:
+            yaml.dump({'files': signature, 'dimensions': dimensions}, fp)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.rename(new_folder, folder)
+    except OSError: # e.g. read-only folder, or written simultaneously by another process
+        if new_folder is not None:
+            shutil.rmtree(new_folder, ignore_errors=True)
+
+def load_cached_dataset(name, cache=True):
+    '''
+    Loads dataset `name` with `load_dataset`, through a binary cache next to the data files
+    (a folder `.xxx.cache` for dataset `xxx`), which is invalidated when the data files change.
+    Returns the data and whether it was read from the cache.
+    '''
+    if cache:
+        signature = dataset_signature(name)
+        data = read_cache(name, signature)
+        if data is not None:
+            return data, True
+    data = load_dataset(name)
+    if cache and (data is not None):
+        write_cache(name, signature, data)
+    return data, False
+
+def load_multiple_data(path, name, cache=True, n_threads=8):
     '''
     Loads multiple datasets of the type path/xxx/name
     where name is yyy/zzz (e.g. electrophysiology/data)
+
+    Datasets are loaded in parallel by `n_threads` threads, and cached in binary form (see `load_cached_dataset`).
     '''
     subfolder = up_dir(name)
     folders = [f.path for f in os.scandir(path) if os.path.exists(os.path.join(f.path, subfolder))]
     folders.sort()
-    datasets = []
-    for folder in folders:
-        data = load_dataset(os.path.join(folder, name))
-        if data is not None:
-            datasets.append(data)
+    with ThreadPoolExecutor(max_workers=max(1, min(n_threads, len(folders)))) as executor:
+        loaded = list(executor.map(lambda folder: load_cached_dataset(os.path.join(folder, name), cache=cache),
+                                   folders))
+    datasets = [data for data, _ in loaded if data is not None]
+    hits = len([data for data, cached in loaded if (data is not None) and cached])
+    cache_statistics['hits'] += hits
+    cache_statistics['misses'] += len(datasets) - hits
+    print('{}: {} datasets, {} from cache, {} loaded'.format(os.path.join(path, name), len(datasets),
+                                                           hits, len(datasets) - hits))
     return merge_data(datasets)
 
 def rename_electrophysiology_data(data):
@@ -0,0 +1,352 @@
+'''
+Dependency-aware pipeline for the processing chain (image analysis, fitting, tables), run make-style.
+
+Each stage is a script run on folders of one level: trial image folders (`protocol/images/NNN`),
+protocol folders, cell folders, or the root folder given to the pipeline.
+A stage declares (as glob patterns relative to the folder):
+* `where`: data that must exist for the stage to apply to a folder (e.g. 'images/*')
+* `inputs`: files that the script reads
+* `outputs`: files that the script writes
+and the stages that must be run before (`after`), on the same folder, or on folders containing it or contained
+in it (e.g. a cell stage after a protocol stage waits for all protocols of the cell).
+
+A task (stage, folder) is run only if its outputs are missing or its inputs have changed (names, sizes and
+modification times) since its last successful run, as recorded in the job log (`.pipeline_log.jsonl` in the
+root folder). Tasks are run as soon as the tasks they depend on are done, on a local process pool,
+or in waves on the cluster with GNU parallel (see `batch_processing.py`). Failed tasks are retried.
+
+Example:
+    run_pipeline('~/Paramecium data/Ciliated with PIV', stages=['piv', 'piv_analysis'])
+'''
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .batch_processing import scan_folders, run_task, initialize_worker
+from .image_stack import image_trials
+from .configuration import python_binary
+
+__all__ = ['Stage', 'default_stages', 'run_pipeline']
+
+scripts_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+class Stage(object):
+    '''
+    A processing stage: `script` (relative to the scripts folder) is run on each folder of `level`
+    ('trial', 'protocol', 'cell' or 'root') where the `where` patterns match.
+    Patterns can use the fields {cell}, {protocol} and {root}, e.g. '{cell}/morphology.yaml'.
+    If `fresh` is True, the script is run in a new Python process rather than in a worker of the pool
+    (e.g. fitting scripts).
+    '''
+    def __init__(self, name, script, level, inputs, outputs, where=(), after=(), fresh=False):
+        self.name = name
+        self.script = os.path.join(scripts_folder, script)
+        self.level = level
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.where = list(where)
+        self.after = list(after)
+        self.fresh = fresh
+
+def fit_stage(name, inputs=(), where=(), after=()):
+    '''
+    Stage of a fitting script (scripts/fitting/name.py), which writes fits/name.yaml in the cell folder.
+    '''
+    return Stage(name, os.path.join('fitting', name+'.py'), 'cell',
+                 inputs=['*/electrophysiology/data*'] + list(inputs), outputs=['fits/'+name+'.yaml'],
+                 where=['*/electrophysiology'] + list(where), after=after, fresh=True)
+
+def default_stages():
+    '''
+    Returns the stages of the processing chain.
+    '''
+    return [Stage('preprocess_images', os.path.join('image_analysis', 'preprocess_images.py'), 'protocol',
+                  inputs=['images/*/*.tiff', 'images/*.mp4', 'protocol.yaml'],
+                  outputs=['images/.*.cache/signature.yaml'],
+                  where=['images/*']),
+            Stage('piv', os.path.join('image_analysis', 'piv.py'), 'trial',
+                  inputs=['*.tiff', '{protocol}/images/{name}.mp4'], outputs=['{protocol}/piv/{name}/velocity.npy'],
+                  where=['{protocol}/images/{name}*'],
+                  after=['preprocess_images']),
+            Stage('piv_analysis', os.path.join('image_analysis', 'piv_analysis.py'), 'protocol',
+                  inputs=['piv/*/velocity.npy', 'piv/*/valid.npy'], outputs=['piv_analysis/analysis*.txt.gz'],
+                  where=['images/*'], after=['piv']),
+            Stage('piv_density', os.path.join('image_analysis', 'piv_density.py'), 'protocol',
+                  inputs=['images/*/*.tiff', 'images/*.mp4', 'protocol.yaml'],
+                  outputs=['piv_density/piv_density*.txt.gz'],
+                  where=['images/*'], after=['preprocess_images']),
+            Stage('fix_positions', os.path.join('image_analysis', 'fix_positions.py'), 'cell',
+                  inputs=['*/piv_analysis/analysis*.txt.gz'], outputs=['morphology.yaml'],
+                  where=['morphology.yaml', '*/images'], after=['piv_analysis']),
+            Stage('local_piv_analysis', os.path.join('image_analysis', 'local_piv_analysis.py'), 'protocol',
+                  inputs=['piv/*/velocity.npy', 'piv/*/valid.npy', '{cell}/morphology.yaml'],
+                  outputs=['local_piv_analysis/analysis*.txt.gz'],
+                  where=['images/*', '{cell}/morphology.yaml'], after=['piv', 'fix_positions']),
+            Stage('track_ends', os.path.join('image_analysis', 'track_ends.py'), 'protocol',
+                  inputs=['images/*/*.tiff', 'images/*.mp4', '{cell}/morphology.yaml'],
+                  outputs=['tracked_ends/tracked_ends*.txt.gz'],
+                  where=['images/*', '{cell}/morphology.yaml'], after=['preprocess_images', 'fix_positions']),
+            fit_stage('electrode_and_RC'),
+            fit_stage('ciliated', inputs=['*/piv_analysis/analysis*.txt.gz', 'morphology.yaml',
+                                          'fits/electrode_and_RC.yaml'],
+                      where=['*/images'], after=['electrode_and_RC', 'piv_analysis', 'fix_positions']),
+            Stage('make_tables', os.path.join('data_preparation', 'make_tables.py'), 'root',
+                  inputs=['*/fits/*.yaml'], outputs=['tables/*.csv'], after=['electrode_and_RC', 'ciliated']),
+            # this script reads the tables in the configured root folder ('Ciliated with PIV')
+            Stage('selection_ciliated', os.path.join('analysis', 'selection_ciliated.py'), 'root',
+                  inputs=['tables/ciliated.csv'], outputs=['tables/selection_ciliated.csv'], after=['make_tables'])]
+
+def folder_fields(folder, level, root):
+    '''
+    Returns the fields used in patterns (escaped for glob).
+    '''
+    protocol = {'trial': os.path.dirname(os.path.dirname(folder)), 'protocol': folder}.get(level, '')
+    cell = {'cell': folder, 'root': ''}.get(level, os.path.dirname(protocol))
+    fields = {'cell': cell, 'protocol': protocol, 'root': root, 'name': os.path.basename(folder)}
+    return {key: glob.escape(value) for key, value in fields.items()}
+
+def matching_files(folder, patterns, fields):
+    files = []
+    for pattern in patterns:
+        files.extend(glob.glob(os.path.join(glob.escape(folder), pattern.format(**fields)), recursive=True))
+    return sorted(set(files))
+
+def all_match(folder, patterns, fields):
+    return all([len(matching_files(folder, [pattern], fields)) > 0 for pattern in patterns])
+
+def input_signature(files):
+    '''
+    Returns a hash of the names, sizes and modification times of files.
+    '''
+    description = []
+    for filename in files:
+        stat = os.stat(filename)
+        description.append('{} {} {}'.format(filename, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1('\n'.join(description).encode()).hexdigest()
+
+class Task(object):
+    def __init__(self, stage, folder, root):
+        self.stage = stage
+        self.folder = folder
+        self.fields = folder_fields(folder, stage.level, root)
+        self.dependencies = []
+        self.state = 'waiting' # then 'running', 'done', 'up to date', 'failed', 'blocked' or 'no input'
+        self.attempts = 0
+
+    def key(self):
+        return self.stage.name + ':' + self.folder
+
+    def signature(self):
+        return input_signature(matching_files(self.folder, self.stage.inputs, self.fields))
+
+    def up_to_date(self, log):
+        entry = log.get(self.key(), None)
+        return (entry is not None) and (entry['status'] == 'ok') and (entry['signature'] == self.signature()) \
+               and all_match(self.folder, self.stage.outputs, self.fields)
+
+def stage_folders(root, level):
+    '''
+    Returns the folders of a level below `root`.
+    '''
+    if level == 'root':
+        return [root]
+    folders = {'cell': [], 'protocol': [], 'images': []}
+    for kind, folder in scan_folders(root, recursive=True):
+        if kind in folders:
+            folders[kind].append(folder)
+    if level == 'trial': # trial folders or movies (images/NNN.mp4 gives trial images/NNN)
+        return [trial for folder in folders['images'] for trial in image_trials(os.path.dirname(folder))]
+    return folders[level]
+
+def related(folder1, folder2):
+    '''
+    True if the folders are identical or one contains the other.
+    '''
+    return (folder1 == folder2) or folder1.startswith(folder2 + os.sep) or folder2.startswith(folder1 + os.sep)
+
+def make_tasks(root, stages):
+    '''
+    Returns the list of tasks, with their dependencies.
+    '''
+    names = [stage.name for stage in stages]
+    tasks, by_stage = [], {}
+    for stage in stages:
+        by_stage[stage.name] = []
+        for folder in stage_folders(root, stage.level):
+            task = Task(stage, folder, root)
+            if all_match(folder, stage.where, task.fields):
+                by_stage[stage.name].append(task)
+                tasks.append(task)
+    for task in tasks:
+        for name in task.stage.after:
+            if name in names:
+                task.dependencies.extend([other for other in by_stage[name] if related(task.folder, other.folder)])
+    return tasks
+
+def read_log(filename):
+    '''
+    Returns the last entry of each task in the job log.
+    '''
+    log = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # interrupted while writing
+                    continue
+                log[entry['stage'] + ':' + entry['folder']] = entry
+    return log
+
+def run_fresh(script, folder):
+    '''
+    Runs a script in a new Python process, as `run_task` does in a worker.
+    '''
+    t0 = time.time()
+    process = subprocess.run([sys.executable, '-W', 'ignore', script, folder],
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    status = 'ok' if process.returncode == 0 else 'failed'
+    return {'folder': folder, 'status': status, 'duration': time.time() - t0,
+            'error': None if status == 'ok' else process.stderr}
+
+def run_on_cluster(script, folders):
+    '''
+    Runs a script on folders with GNU parallel on the cluster (see `cluster_batch`).
+    Returns the results, as `run_task`.
+    '''
+    with tempfile.TemporaryDirectory(dir='.') as directory:
+        with open(os.path.join(directory, 'filenames.txt'), 'w') as f:
+            f.write('\n'.join(folders))
+        joblog = os.path.join(directory, 'joblog.txt')
+        t0 = time.time()
+        with open(os.path.join(directory, 'filenames.txt'), 'r') as f:
+            subprocess.run(['parallel', '-Jcluster', '--joblog', joblog, python_binary(), '-W', 'ignore', script, '{}'],
+                           stdin=f)
+        exit_codes = {}
+        if os.path.exists(joblog):
+            with open(joblog, 'r') as f:
+                for line in f.readlines()[1:]: # Seq Host Starttime JobRuntime Send Receive Exitval Signal Command
+                    columns = line.split('\t')
+                    exit_codes[int(columns[0]) - 1] = (int(columns[6]), float(columns[3]))
+    results = []
+    for i, folder in enumerate(folders):
+        code, duration = exit_codes.get(i, (None, time.time() - t0))
+        results.append({'folder': folder, 'status': 'ok' if code == 0 else 'failed', 'duration': duration,
+                        'error': None if code == 0 else 'exit code {}'.format(code)})
+    return results
+
+def run_pipeline(root, stages=None, n_processes=5, cluster=False, retries=1, dry_run=False, log=None,
+                 preload=('numpy', 'scipy', 'brian2', 'clampy', 'matplotlib.pyplot')):
+    '''
+    Runs the stale tasks of the pipeline on all folders below `root`.
+
+    `stages` : list of `Stage` objects or names of default stages (default: all default stages)
+    `n_processes` : number of local processes
+    `cluster` : if True, tasks are run on the cluster with GNU parallel, in waves of ready tasks
+    `retries` : number of times a failed task is run again
+    `dry_run` : if True, only prints the tasks that would be run
+    `log` : filename of the job log (default: root/.pipeline_log.jsonl)
+
+    Returns a dictionary mapping each task ('stage:folder') to its final state.
+    '''
+    root = os.path.abspath(os.path.expanduser(root))
+    if stages is None:
+        stages = default_stages()
+    stages = [stage if isinstance(stage, Stage) else {s.name: s for s in default_stages()}[stage]
+              for stage in stages]
+    if log is None:
+        log = os.path.join(root, '.pipeline_log.jsonl')
+    history = read_log(log)
+    tasks = make_tasks(root, stages)
+    print('{} tasks'.format(len(tasks)))
+
+    def record(task, result):
+        task.attempts += 1
+        if result['status'] == 'ok':
+            task.state = 'done'
+        elif task.attempts > retries:
+            task.state = 'failed'
+        else:
+            task.state = 'waiting' # retry
+        print('{} {} ({:.1f} s): {}'.format(task.stage.name, result['status'], result['duration'], task.folder))
+        if result['error'] is not None:
+            print(result['error'])
+        entry = {'stage': task.stage.name, 'folder': task.folder, 'status': result['status'],
+                 'signature': task.signature() if result['status'] == 'ok' else None,
+                 'duration': result['duration'], 'time': time.time(), 'error': result['error']}
+        with open(log, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def ready_tasks():
+        '''
+        Updates the state of waiting tasks and returns those that must be run now.
+        '''
+        ready = []
+        for task in tasks:
+            if task.state != 'waiting':
+                continue
+            states = [dependency.state for dependency in task.dependencies]
+            if any([state in ['failed', 'blocked'] for state in states]):
+                task.state = 'blocked'
+            elif all([state in ['done', 'up to date', 'no input'] for state in states]):
+                if task.stage.inputs and len(matching_files(task.folder, task.stage.inputs, task.fields)) == 0:
+                    task.state = 'no input'
+                elif (task.attempts == 0) and task.up_to_date(history):
+                    task.state = 'up to date'
+                else:
+                    ready.append(task)
+        return ready
+
+    if dry_run:
+        # Dependencies are assumed to produce their outputs
+        for task in tasks:
+            stale = not task.up_to_date(history) or any([dependency.state == 'stale'
+                                                         for dependency in task.dependencies])
+            task.state = 'stale' if stale else 'up to date'
+            if stale:
+                print('{}: {}'.format(task.stage.name, task.folder))
+        return {task.key(): task.state for task in tasks}
+
+    if cluster:
+        while True:
+            ready = ready_tasks()
+            if len(ready) == 0:
+                break
+            for stage in stages: # one call to parallel per stage
+                stage_tasks = [task for task in ready if task.stage is stage]
+                if len(stage_tasks) > 0:
+                    for task, result in zip(stage_tasks, run_on_cluster(stage.script,
+                                                                        [task.folder for task in stage_tasks])):
+                        record(task, result)
+    else:
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=initialize_worker,
+                                 initargs=(preload,)) as executor:
+            running = {}
+            while True:
+                for task in ready_tasks():
+                    task.state = 'running'
+                    if task.stage.fresh:
+                        future = executor.submit(run_fresh, task.stage.script, task.folder)
+                    else:
+                        future = executor.submit(run_task, task.stage.script, task.folder, [])
+                    running[future] = task
+                if len(running) == 0:
+                    break
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e: # e.g. a worker process crashed
+                        result = {'folder': task.folder, 'status': 'failed', 'duration': 0., 'error': repr(e)}
+                    record(task, result)
+
+    states = {task.key(): task.state for task in tasks}
+    for state in sorted(set(states.values())):
+        print('{}: {} tasks'.format(state, list(states.values()).count(state)))
+    return states
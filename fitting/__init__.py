@@ -1,3 +1,6 @@
 from .fitting import *
 from .piv import *
-from .run_model import *
\ No newline at end of file
+from .run_model import *
+from .model_cache import *
+from .multi_fitting import *
+from .fit_store import *
@@ -0,0 +1,145 @@
+'''
+Storage of fitted traces.
+
+All trials and variables of a fit are stored in a single compressed file `fits/<name>.npz`
+in the cell folder, next to the fit results file `fits/<name>.yaml`.
+Each trace (one variable, one trial) is a separate compressed chunk, named `<variable>/<trial>`,
+so that reading a trace does not decompress the others. Values are stored in SI units with their
+original dtype, and the dimensions of each variable are stored with the trial indices.
+
+Example:
+    save_fits(fits, path, name='ciliated', trials=[0, 2, 5])
+    fits = load_fits(path, 'ciliated') # all variables and trials, as returned by two_stage_fit
+    with open_fits(path, 'ciliated') as f:
+        v = f.trace('v', 2) # only this trace is read
+
+Fits saved by earlier versions (one text file `fits/<name>/fitsNNN.txt.gz` per trial) can be converted
+with `convert_fit_folder`.
+'''
+import os
+import inspect
+import gzip
+import numpy as np
+from brian2 import Quantity
+from brian2.units.fundamentalunits import get_dimensions, get_or_create_dimension
+
+__all__ = ['save_fits', 'load_fits', 'open_fits', 'convert_fit_folder']
+
+def fit_filename(path, name):
+    return os.path.join(path, 'fits', name+'.npz')
+
+def save_fits(fits, path, name=None, trials=None):
+    '''
+    Save fits to disk.
+    `fits` is a dictionary of (trials, time) arrays, as returned by `two_stage_fit`.
+    `trials` (optionally) gives the list of trial indices.
+    '''
+    if name is None: # Get name from calling script
+        frame = inspect.stack()[1]
+        module = inspect.getmodule(frame[0])
+        name = os.path.splitext(os.path.split(module.__file__)[1])[0]
+    os.makedirs(os.path.join(path, 'fits'), exist_ok=True)
+
+    variables = list(fits.keys())
+    ntrials = len(fits[variables[0]])
+    if trials is None:
+        trials = range(ntrials)
+    trials = np.array(trials, dtype=int)
+    chunks = {'__trials__': trials,
+              '__variables__': np.array(variables),
+              '__dimensions__': np.array([get_dimensions(fits[var])._dims for var in variables], dtype=int)}
+    for var in variables:
+        values = np.asarray(fits[var])
+        for i, trial in enumerate(trials):
+            chunks['{}/{}'.format(var, trial)] = values[i]
+
+    filename = fit_filename(path, name)
+    np.savez_compressed(filename+'.tmp.npz', **chunks)
+    os.replace(filename+'.tmp.npz', filename) # a partially written file never replaces a complete one
+
+class FitFile(object):
+    '''
+    A fit file opened for reading. Traces are read on demand.
+    '''
+    def __init__(self, filename):
+        self.file = np.load(filename, allow_pickle=False)
+        self.trials = [int(trial) for trial in self.file['__trials__']]
+        self.variables = list(self.file['__variables__'])
+        self.dimensions = {var: get_or_create_dimension(dims)
+                           for var, dims in zip(self.variables, self.file['__dimensions__'])}
+
+    def trace(self, var, trial):
+        '''
+        Returns the fitted trace of variable `var` for trial `trial` (a trial index, not a position).
+        '''
+        return Quantity(self.file['{}/{}'.format(var, trial)], dim=self.dimensions[var])
+
+    def __getitem__(self, var):
+        '''
+        Returns the (trials, time) array of variable `var`.
+        '''
+        return self.load([var])[var]
+
+    def load(self, variables=None, trials=None):
+        '''
+        Returns a dictionary of (trials, time) arrays, for the selected variables and trials
+        (all by default).
+        '''
+        if variables is None:
+            variables = self.variables
+        if trials is None:
+            trials = self.trials
+        return {var: Quantity(np.array([self.file['{}/{}'.format(var, trial)] for trial in trials]),
+                              dim=self.dimensions[var])
+                for var in variables}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_fits(path, name):
+    '''
+    Opens the fits of fit `name` in cell folder `path`, for lazy reading (see `FitFile`).
+    '''
+    return FitFile(fit_filename(path, name))
+
+def load_fits(path, name, variables=None, trials=None):
+    '''
+    Loads the fits of fit `name` in cell folder `path`, as a dictionary of (trials, time) arrays.
+    Only the selected variables and trials are read (all by default).
+    '''
+    with open_fits(path, name) as f:
+        return f.load(variables, trials)
+
+def convert_fit_folder(path, name, remove=False):
+    '''
+    Converts fits saved as text files (`fits/<name>/fitsNNN.txt.gz`) to the binary format.
+    Text files do not store units: values are in SI units and are loaded as dimensionless.
+    If `remove` is True, the text files are deleted after conversion.
+    Returns the list of converted trials.
+    '''
+    folder = os.path.join(path, 'fits', name)
+    filenames = sorted([filename for filename in os.listdir(folder)
+                        if filename.startswith('fits') and filename.endswith('.txt.gz')])
+    if len(filenames) == 0:
+        return []
+    trials, traces = [], []
+    for filename in filenames:
+        trials.append(int(filename[4:-7]))
+        traces.append(np.loadtxt(os.path.join(folder, filename), skiprows=1, ndmin=2))
+    with gzip.open(os.path.join(folder, filenames[0]), 'rt') as f:
+        variables = f.readline().split()
+    fits = {var: np.array([M[:, j] for M in traces]) for j, var in enumerate(variables)}
+    save_fits(fits, path, name=name, trials=trials)
+
+    if remove:
+        for filename in filenames:
+            os.remove(os.path.join(folder, filename))
+        if len(os.listdir(folder)) == 0:
+            os.rmdir(folder)
+    return trials
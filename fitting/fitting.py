@@ -10,13 +10,18 @@ from brian2modelfitting import *
 import os
 import inspect
 import datetime
+import pickle
+import csv
+import copy
 from time import time
 import sys
 from brian2.units.constants import faraday_constant as F
 from brian2.units.constants import gas_constant as R
+from .model_cache import *
+from .fit_store import save_fits
 
 __all__ = ['global_error', 'local_error', "write_fit_file", 'two_stage_fit', 'fit_arguments', 'constants_from_file',
-           'save_fits']
+           'checkpoint_file', 'fitted_parameters', 'table_parameters']
 
 set_device('cpp_standalone', directory=None)
 
@@ -35,14 +40,35 @@ def fit_arguments(default=None):
 
 def two_stage_fit(model=None, data=None, metrics=None,
                   n_samples=50, n_rounds=100, n_refine_rounds=2000,
-                  input_vars=['I'], **fitting_parameters):
+                  input_vars=['I'], cache=True, checkpoint=None, checkpoint_every=10,
+                  stop_rounds=None, stop_tolerance=1e-3, init_population=None, jitter=0.05, skip_DE=False,
+                  coarse=1, **fitting_parameters):
     '''
     Runs fitting procedure in two stages: differential evolution followed by gradient descent.
+    If `cache` is True, compiled projects are taken from and stored in the model cache (see `model_cache.py`).
+
+    `checkpoint` : name of a checkpoint file (see `checkpoint_file`), where the state of the optimization is
+                   saved every `checkpoint_every` rounds (or refine evaluations). If the file exists, the fit
+                   resumes from it. The file is deleted at the end of the fit.
+    `stop_rounds`, `stop_tolerance` : differential evolution stops when the relative improvement of the error
+                   over `stop_rounds` rounds is below `stop_tolerance` (if `stop_rounds` is not None).
+    `init_population` : list of parameter dictionaries (e.g. from `fitted_parameters` or `table_parameters`),
+                   used to seed the initial population of differential evolution, with Gaussian jitter
+                   (standard deviation = `jitter` times the width of the bounds).
+    `skip_DE` : if True, gradient descent starts directly from the first parameter set of `init_population`.
+    `coarse` : subsampling factor of the data for differential evolution (multi-resolution fit).
+                   Differential evolution runs on decimated data (see `coarse_grained_data` and
+                   `coarse_grained_metrics`), with a `coarse` times larger time step,
+                   then gradient descent runs on the full-resolution data. The time step must remain small
+                   compared to the fastest time constant of the model (e.g. the electrode).
     '''
     # Build model
 
     eqs, init, bounds = build_model(model)
-    fitting_parameters.update({'n_samples': n_samples, 'n_rounds': n_rounds, 'n_refine_rounds': n_refine_rounds})
+    fitting_parameters.update({'n_samples': n_samples, 'n_rounds': n_rounds, 'n_refine_rounds': n_refine_rounds,
+                               'stop_rounds': stop_rounds, 'stop_tolerance': stop_tolerance,
+                               'n_seeds': 0 if init_population is None else len(init_population),
+                               'jitter': jitter, 'skip_DE': skip_DE, 'coarse': coarse})
 
     # Split bounds
     bounds_DE = {} # for differential evolution
@@ -63,29 +89,118 @@ def two_stage_fit(model=None, data=None, metrics=None,
                          input={var: data[var] for var in input_vars}, dt=t[1] - t[0],
                          n_samples=n_samples, param_init=init, method='euler')
 
+    # Fitter for differential evolution, on subsampled data
+    if coarse > 1:
+        coarse_data = coarse_grained_data(data, coarse, input_vars, output_vars)
+        DE_metrics = coarse_grained_metrics(metrics, coarse)
+        DE_fitter = TraceFitter(model=eqs, output={key: coarse_data[key] for key in output_vars},
+                                input={var: coarse_data[var] for var in input_vars}, dt=(t[1] - t[0])*coarse,
+                                n_samples=n_samples, param_init=init, method='euler')
+    else:
+        DE_metrics, DE_fitter = metrics, fitter
+
+    # Compiled projects, one for each phase
+    key = model_hash(eqs, 'euler', t[1] - t[0], input_vars, output_vars)
+    DE_key = model_hash(eqs, 'euler', (t[1] - t[0])*coarse, input_vars, output_vars)
+    compilation = {}
+    project = lambda phase: cached_project((DE_key if phase == 'fit' else key)+'-'+phase if cache else None)
+
+    # Optimization state, possibly from a previous run
+    fit_key = (key, n_samples, repr(sorted(bounds.items())), coarse)
+    state = load_checkpoint(checkpoint, fit_key)
+    if state is None:
+        state = {'key': fit_key, 'phase': 'DE', 'round': 0, 'history': [],
+                 'optimizer': NevergradOptimizer(method='TwoPointsDE')}
+        if init_population is not None:
+            if skip_DE:
+                best_params = seed_parameters(init_population[0], fitter.parameter_names, bounds_DE)
+                state.update({'phase': 'refine', 'evaluations': 0,
+                              'best_params': dict(zip(fitter.parameter_names, best_params))})
+            else:
+                initialize_optimizer(state['optimizer'], fitter.parameter_names, n_samples, n_rounds, bounds_DE)
+                seed_population(state['optimizer'], fitter.parameter_names, bounds_DE, init_population,
+                                n_samples, jitter)
+                DE_fitter.optimizer = state['optimizer'] # so that it is not initialized again
+    optimizer = state['optimizer']
+
     t1 = time()
     print("*** Phase 1: differential evolution ***")
-    _, error = fitter.fit(n_rounds=n_rounds, optimizer=NevergradOptimizer(method='TwoPointsDE'),
-                          metric=metrics, callback='text', **bounds_DE)
-    print('Error (phase 1) = {} mV'.format(error ** .5))
+    if state['phase'] == 'DE':
+        if state['round'] > 0:
+            print('Resuming from round {}'.format(state['round']))
+            DE_fitter.optimizer = optimizer # so that it is not initialized again
+            DE_fitter.iteration = state['round']
+
+        def DE_callback(parameters, errors, best_parameters, best_error, index):
+            state['round'] += 1
+            state['history'].append(float(best_error))
+            print('Round {}: best error = {}'.format(state['round'], float(best_error)))
+            return converged(state['history'], stop_rounds, stop_tolerance)
+
+        with project('fit') as compilation['fit']:
+            while state['round'] < n_rounds and not converged(state['history'], stop_rounds, stop_tolerance):
+                DE_fitter.fit(n_rounds=min(checkpoint_every, n_rounds - state['round']), optimizer=optimizer,
+                              metric=DE_metrics, callback=DE_callback, **bounds_DE)
+                save_checkpoint(checkpoint, state)
+        if state['round'] < n_rounds:
+            print('Converged after {} rounds'.format(state['round']))
+        best_params = DE_fitter.best_params
+        if best_params is None: # all rounds were done before resuming
+            best_params = dict(zip(fitter.parameter_names, optimizer.recommend()))
+        state.update({'phase': 'refine', 'evaluations': 0, 'best_params': best_params})
+        save_checkpoint(checkpoint, state)
+    fitter.metric = metrics # used by refine
+    if len(state['history']) > 0:
+        print('Error (phase 1{}) = {} mV'.format(', subsampled {} times'.format(coarse) if coarse > 1 else '',
+                                                 state['history'][-1] ** .5))
+    t_DE = time()
+    print('Phase 1 took {} s'.format(t_DE - t1))
     print()
 
     # Refine
     print("*** Phase 2: gradient descent ***")
-    best_params, result = fitter.refine(maxfev=n_refine_rounds, calc_gradient=True,
-                                        **bounds_refine)  # nan_policy = 'omit'
+    if state['phase'] == 'refine':
+        if state['evaluations'] > 0:
+            print('Resuming after {} evaluations'.format(state['evaluations']))
+
+        def refine_callback(parameters, errors, best_parameters, best_error, index):
+            state['evaluations'] += 1
+            state['best_params'] = best_parameters
+            state['error'] = float(best_error) ** .5
+            print('Evaluation {}: best error = {}'.format(state['evaluations'], state['error']))
+            if state['evaluations'] % checkpoint_every == 0:
+                save_checkpoint(checkpoint, state)
+
+        if state['evaluations'] < n_refine_rounds:
+            with project('refine') as compilation['refine']:
+                state['best_params'], result = fitter.refine(params=state['best_params'],
+                                                             maxfev=n_refine_rounds - state['evaluations'],
+                                                             calc_gradient=True, callback=refine_callback,
+                                                             **bounds_refine)  # nan_policy = 'omit'
+            state['error'] = global_error(result)
+        state['phase'] = 'done'
+        save_checkpoint(checkpoint, state)
+    best_params = state['best_params']
+    if 'error' in state:
+        error = state['error']
+    elif len(state['history']) > 0: # no refinement: error of differential evolution
+        error = state['history'][-1] ** .5
+    else: # neither differential evolution nor refinement
+        error = np.nan
     t2 = time()
+    print('Phase 2 took {} s'.format(t2 - t_DE))
     print('Fitting took {} s'.format(t2 - t1))
-    error = global_error(result)
     print('Error = {} mV'.format(error))
 
     # Traces
-    fits = fitter.generate_traces(params=best_params)
+    with project('generate') as compilation['generate']:
+        fits = fitter.generate_traces(params=best_params)
     if len(output_vars) == 1:
         fits = {output_vars[0]: fits}
 
-    # Clean up
-    device.delete()
+    compile_time = sum([info['compile_time'] for info in compilation.values()])
+    print('Compilation took {} s ({} cached projects out of {})'.format(compile_time,
+                    sum([info['cached'] for info in compilation.values()]), len(compilation)))
 
     # Produce information dictionary
     fitting_start = metrics[list(metrics.keys())[0]].t_start
@@ -103,10 +218,154 @@ def two_stage_fit(model=None, data=None, metrics=None,
 
     # Results
     results['error'] = float(error)
+    results['compile_time'] = float(compile_time)
+    results['fitting_time'] = float(t2 - t1)
+    results['rounds_done'] = state['round']
     results['errors'] = local_error(data, fits, output_vars, fitting_start)
 
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
     return fits, best_params, results
 
+def coarse_grained_data(data, n, input_vars, output_vars):
+    '''
+    Returns the data subsampled `n` times, for differential evolution.
+    Outputs are low-pass filtered before decimation; inputs (e.g. current steps) are sampled without filtering.
+    '''
+    outputs = subsample({'t': data['t'], **{var: data[var] for var in output_vars}}, n)
+    inputs = subsample({'t': data['t'], **{var: data[var] for var in input_vars}}, n, filter=False)
+    outputs.update(inputs)
+    return outputs
+
+def coarse_grained_metrics(metrics, n):
+    '''
+    Returns copies of the metrics for data subsampled `n` times.
+    Time weights are subsampled; `t_start` is a time and is unchanged.
+    '''
+    coarse_metrics = {}
+    for var, metric in metrics.items():
+        coarse_metrics[var] = copy.copy(metric)
+        t_weights = getattr(metric, 't_weights', None)
+        if t_weights is not None:
+            coarse_metrics[var].t_weights = t_weights[::n]/np.mean(t_weights[::n])
+    return coarse_metrics
+
+def initialize_optimizer(optimizer, parameter_names, n_samples, n_rounds, bounds):
+    '''
+    Initializes the optimizer as `TraceFitter.fit` does.
+    '''
+    if 'rounds' in inspect.signature(optimizer.initialize).parameters: # recent versions of brian2modelfitting
+        optimizer.initialize(parameter_names, popsize=n_samples, rounds=n_rounds, **bounds)
+    else:
+        optimizer.initialize(parameter_names, popsize=n_samples, **bounds)
+
+def seed_parameters(seed, parameter_names, bounds, jitter=0.):
+    '''
+    Returns the list of parameter values (floats) of a seed dictionary, in the order of `parameter_names`,
+    with Gaussian jitter, clipped to the bounds.
+    Missing parameters are drawn uniformly within the bounds.
+    '''
+    values = []
+    for name in parameter_names:
+        low, high = float(bounds[name][0]), float(bounds[name][1])
+        if name in seed:
+            value = float(seed[name]) + jitter*(high-low)*np.random.randn()
+        else:
+            value = np.random.uniform(low, high)
+        values.append(min(max(value, low), high))
+    return values
+
+def seed_population(optimizer, parameter_names, bounds, population, n_samples, jitter):
+    '''
+    Suggests `n_samples` candidates to the (initialized) Nevergrad optimizer, taken from
+    `population` in turn, with jitter except for the first occurrence of each seed.
+    '''
+    for i in range(n_samples):
+        seed = population[i % len(population)]
+        optimizer.optim.suggest(*seed_parameters(seed, parameter_names, bounds,
+                                                 jitter if i >= len(population) else 0.))
+
+def fitted_parameters(path, name=None):
+    '''
+    Returns the parameters of a previous fit (path/fits/name.yaml) as a dictionary.
+    By default, name is the name of the calling script.
+    '''
+    if name is None:
+        frame = inspect.stack()[1]
+        module = inspect.getmodule(frame[0])
+        name = os.path.splitext(os.path.split(module.__file__)[1])[0]
+    with open(os.path.join(path, 'fits/'+name+'.yaml'), 'r') as fp:
+        fit_results = yaml.safe_load(fp)
+    constants = fit_results['model']['constants']
+    return dictionary_str_to_number({var: value for var, value in constants.items() if isinstance(value, str)})
+
+def table_parameters(filename, exclude=None):
+    '''
+    Returns the parameters of all cells in a table, as a list of dictionaries of floats (SI units).
+    The table is either produced by `make_tables.py`, or as `models/full_models/ciliated.csv`.
+    Cells named `exclude` (e.g. the fitted cell) are skipped.
+    '''
+    with open(filename, encoding='utf-8-sig') as f:
+        delimiter = ';' if ';' in f.readline() else ','
+        f.seek(0)
+        rows = list(csv.DictReader(f, delimiter=delimiter))
+    population = []
+    for row in rows:
+        if (exclude is not None) and (row.get('name', None) == exclude):
+            continue
+        parameters = {}
+        for key, value in row.items():
+            try:
+                parameters[key] = float(value)
+            except (ValueError, TypeError):
+                pass
+        if len(parameters) > 0 and row.get('name', '') != '': # not a units row
+            population.append(parameters)
+    return population
+
+def converged(history, rounds, tolerance):
+    '''
+    Returns True if the relative improvement of the error over the last `rounds` rounds is below `tolerance`.
+    '''
+    if rounds is None or len(history) <= rounds:
+        return False
+    return history[-rounds-1] - history[-1] <= tolerance*history[-rounds-1]
+
+def checkpoint_file(path, name=None):
+    '''
+    Returns the name of the checkpoint file path/fits/name.checkpoint.
+    By default, name is the name of the calling script.
+    '''
+    if name is None:
+        frame = inspect.stack()[1]
+        module = inspect.getmodule(frame[0])
+        name = os.path.splitext(os.path.split(module.__file__)[1])[0]
+    return os.path.join(make_subdir(path, 'fits'), name+'.checkpoint')
+
+def save_checkpoint(filename, state):
+    '''
+    Saves the optimization state (replacing the previous checkpoint only when completely written).
+    '''
+    if filename is None:
+        return
+    with open(filename+'.tmp', 'wb') as fp:
+        pickle.dump(state, fp)
+    os.replace(filename+'.tmp', filename)
+
+def load_checkpoint(filename, key):
+    '''
+    Loads the optimization state, if there is a checkpoint for the same fit.
+    '''
+    if filename is None or not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as fp:
+        state = pickle.load(fp)
+    if state['key'] != key:
+        print('Checkpoint {} is for a different fit, starting from scratch'.format(filename))
+        return None
+    return state
+
 def global_error(result):
     '''
     Returns the error of the fit, using weights and normalization.
@@ -142,27 +401,6 @@ def write_fit_file(info, path, name=None):
     with open(output_name, 'w') as fp:
         yaml.dump(info, fp)
 
-def save_fits(fits, path, name=None, trials=None):
-    '''
-    Save fits to disk.
-    `trials` (optionally) gives the list of trial indices.
-    '''
-    if name is None: # Get name from calling script
-        frame = inspect.stack()[1]
-        module = inspect.getmodule(frame[0])
-        name = os.path.splitext(os.path.split(module.__file__)[1])[0]
-    data_folder = make_subdir(os.path.join(path,'fits'), name)
-
-    # Saving: could be refactored in clampy
-    variables = list(fits.keys())
-    header = ' '.join(variables)
-    ntrials = fits[variables[0]].shape[0]
-    if trials is None:
-        trials = range(ntrials)
-    for i in range(ntrials):
-        M = np.vstack([value[i] for value in fits.values()]).T
-        np.savetxt(os.path.join(data_folder, 'fits{:03d}.txt.gz'.format(trials[i])), M, header=header, comments='')
-
 def constants_from_file(*vars, path=None, name=None):
     '''
     Gets constants from a fit results file, and evaluates them.
@@ -0,0 +1,132 @@
+'''
+Persistent cache of compiled standalone projects.
+
+With `set_device('cpp_standalone', directory=None)`, each fit generates and compiles the C++ project
+in a temporary directory. Here compiled projects are kept in a cache folder (`model_cache` in the
+configuration file, default ~/.cache/paramecium_model_fitting), keyed by a hash of the model
+(equations, method, dt, input and output variables).
+A cached project is copied to a private working directory, where Brian 2 only rewrites the source files
+that have changed, and make only recompiles those. Simultaneous jobs thus never write in the same project.
+When the cache exceeds `model_cache_size` (in GB, default 5), least recently used projects are deleted.
+'''
+import os
+import shutil
+import tempfile
+import hashlib
+import time
+from contextlib import contextmanager
+import brian2
+from brian2 import get_device
+from file_management import config
+try:
+    import fcntl
+except ImportError: # Windows: no file locking
+    fcntl = None
+
+__all__ = ['model_hash', 'cached_project', 'clean_model_cache']
+
+def cache_folder():
+    return os.path.expanduser(config.get('model_cache', '~/.cache/paramecium_model_fitting'))
+
+def model_hash(eqs, method, dt, input_vars, output_vars):
+    '''
+    Returns a hash of the model, used as a key in the cache.
+    '''
+    description = '\n'.join([str(eqs), method, repr(float(dt)),
+                             ' '.join(sorted(input_vars)), ' '.join(sorted(output_vars)),
+                             brian2.__version__])
+    return hashlib.sha1(description.encode()).hexdigest()
+
+@contextmanager
+def lock(entry, exclusive=True, blocking=True):
+    '''
+    Locks a cache entry (shared or exclusive lock).
+    In non-blocking mode, raises BlockingIOError if the entry is already locked.
+    '''
+    with open(entry+'.lock', 'a') as f:
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            fcntl.flock(f, flags)
+        yield # the lock is released when the file is closed
+
+def folder_size(folder):
+    return sum([os.path.getsize(os.path.join(root, filename))
+                for root, _, filenames in os.walk(folder) for filename in filenames])
+
+def clean_model_cache(max_size=None):
+    '''
+    Deletes the least recently used projects, until the cache is smaller than `max_size` (in GB).
+    '''
+    if max_size is None:
+        max_size = config.get('model_cache_size', 5)
+    root = cache_folder()
+    if not os.path.exists(root):
+        return
+    entries = [os.path.join(root, name) for name in os.listdir(root)
+               if ('.' not in name) and os.path.isdir(os.path.join(root, name))]
+    entries.sort(key=os.path.getmtime, reverse=True) # most recently used first
+    total_size = 0
+    for entry in entries:
+        total_size += folder_size(entry)
+        if total_size > max_size*1e9:
+            try:
+                with lock(entry, blocking=False):
+                    shutil.rmtree(entry, ignore_errors=True)
+            except BlockingIOError: # in use
+                pass
+
+def store_project(directory, entry):
+    '''
+    Copies the project in `directory` to the cache entry (without data).
+    '''
+    root, key = os.path.split(entry)
+    new_entry = tempfile.mkdtemp(prefix=key+'.new', dir=root)
+    shutil.copytree(directory, new_entry, ignore=shutil.ignore_patterns('results', 'static_arrays'),
+                    dirs_exist_ok=True)
+    old_entry = None
+    with lock(entry):
+        if os.path.exists(entry):
+            old_entry = tempfile.mkdtemp(prefix=key+'.old', dir=root)
+            os.rename(entry, os.path.join(old_entry, key))
+        os.rename(new_entry, entry)
+    if old_entry is not None:
+        shutil.rmtree(old_entry, ignore_errors=True)
+
+@contextmanager
+def cached_project(key=None):
+    '''
+    Context manager in which the standalone device builds in a private copy of the cached project `key`.
+    If the project is compiled, it is stored back in the cache on exit.
+    If `key` is None, the project is built in an empty temporary directory and not cached.
+    Yields a dictionary, which is filled on exit with:
+    * `cached`: whether the project was found in the cache
+    * `compile_time`: compilation time, in second
+    '''
+    directory = tempfile.mkdtemp(prefix='brian_project_')
+    info = {'cached': False}
+    if key is not None:
+        root = cache_folder()
+        os.makedirs(root, exist_ok=True)
+        entry = os.path.join(root, key)
+        with lock(entry, exclusive=False):
+            info['cached'] = os.path.exists(entry)
+            if info['cached']:
+                shutil.copytree(entry, directory, dirs_exist_ok=True) # this keeps modification times, for make
+                os.utime(entry) # last use
+
+    previous_directory = get_device().build_options.get('directory', None)
+    get_device().build_options['directory'] = directory
+    start = time.time()
+    try:
+        yield info
+        compile_time = getattr(get_device(), 'timers', {}).get('compile', {}).get('make', None) # not with runtime
+        info['compile_time'] = compile_time if compile_time is not None else 0.
+        binary = os.path.join(directory, 'main.exe' if os.name == 'nt' else 'main')
+        if (key is not None) and os.path.exists(binary) and os.path.getmtime(binary) >= start: # compiled
+            store_project(directory, entry)
+            clean_model_cache()
+    finally:
+        get_device().build_options['directory'] = previous_directory
+        shutil.rmtree(directory, ignore_errors=True)
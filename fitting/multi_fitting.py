@@ -0,0 +1,171 @@
+'''
+Fitting many cells at once, in a single simulation.
+
+The trials of all cells are stacked into one neuron group, with n_samples candidate parameter sets
+for each cell. Each cell has its own optimizer, and therefore its own parameter values for each sample,
+and its own metrics. In each round of differential evolution, a single compiled simulation
+evaluates the populations of all cells.
+Errors are calculated online (during the simulation), so that traces are not recorded.
+
+Only differential evolution is run: results are not refined by gradient descent. To refine them,
+each cell is fitted separately with `two_stage_fit`, starting from its best parameters.
+
+Example:
+    datasets = [data_cell1, data_cell2, ...] # as for `two_stage_fit`
+    metrics = [metrics_cell1, metrics_cell2, ...] # or one dictionary of metrics for all cells
+    best_params, results = multi_cell_fit(model, datasets, metrics, n_samples=100, n_rounds=100)
+    for path, result in zip(cell_paths, results):
+        write_fit_file(result, path)
+    # Refinement, cell by cell
+    for params, data, cell_metrics in zip(best_params, datasets, metrics):
+        refined_params, result = two_stage_fit(model, data, cell_metrics, init_population=[params], skip_DE=True)
+'''
+import numpy as np
+from brian2 import *
+from brian2.units.fundamentalunits import DIMENSIONLESS
+from brian2modelfitting import NevergradOptimizer
+from brian2modelfitting.fitter import setup_fit
+from file_management import build_model, dictionary_units_to_str
+from .model_cache import *
+from .fitting import initialize_optimizer
+from time import time
+
+__all__ = ['multi_cell_fit']
+
+def online_error_weights(metric, n_steps, length, dt):
+    '''
+    Weights of squared errors at each time step, for one cell whose traces have `length` time steps,
+    padded to `n_steps`. The error of a trace is the weighted sum of squared errors.
+    '''
+    weights = np.zeros(n_steps)
+    t_weights = getattr(metric, 't_weights', None)
+    if t_weights is not None:
+        weights[:length] = t_weights
+    else:
+        weights[int(round(float(metric.t_start/dt))):length] = 1.
+    return weights/np.sum(weights) * float(metric.normalization)**2 # metric.normalization is the inverse
+
+def multi_cell_fit(model=None, datasets=None, metrics=None, n_samples=50, n_rounds=100,
+                   input_vars=['I'], method='TwoPointsDE', cache=True, **fitting_parameters):
+    '''
+    Fits a model to several cells with differential evolution, in a single simulation.
+    Results are not refined by gradient descent (see `two_stage_fit` with `skip_DE`).
+
+    `datasets` : list of data dictionaries, one per cell (same dt; traces can have different durations)
+    `metrics` : dictionary of metrics (MSEMetric), or list of such dictionaries (one per cell)
+
+    Returns the list of best parameters of each cell, and the list of result dictionaries
+    (as returned by `two_stage_fit`).
+    '''
+    eqs, init, bounds = build_model(model)
+    fitting_parameters.update({'n_samples': n_samples, 'n_rounds': n_rounds})
+    bounds_DE = {var: value if len(value)==2 else [value[1], value[2]] for var, value in bounds.items()}
+    parameter_names = sorted(bounds_DE.keys())
+
+    n_cells = len(datasets)
+    if isinstance(metrics, dict):
+        metrics = [metrics]*n_cells
+    output_vars = list(metrics[0].keys())
+    dt = datasets[0]['t'][1] - datasets[0]['t'][0]
+    for data in datasets:
+        if abs(float(data['t'][1] - data['t'][0] - dt)) > 1e-6*float(dt):
+            raise ValueError('All cells must have the same sampling step')
+
+    ## Stacking traces: column j of the input/target arrays is trace j
+    n_traces = [len(data[output_vars[0]]) for data in datasets]
+    lengths = [len(data['t']) for data in datasets]
+    n_steps = max(lengths)
+    first_trace = np.cumsum([0]+n_traces)
+    namespace = {}
+    extra_equations = '''
+    trace : integer (constant)
+    error : 1
+    iteration : integer (constant, shared)
+    '''
+    for var in input_vars:
+        dim = get_dimensions(datasets[0][var])
+        unit = get_unit(dim)
+        values = np.zeros((n_steps, first_trace[-1]))
+        for c, data in enumerate(datasets):
+            values[:lengths[c], first_trace[c]:first_trace[c+1]] = np.asarray(data[var]).T
+        namespace['input_'+var] = TimedArray(values*unit, dt=dt)
+        extra_equations += '{var} = input_{var}(t, trace) : {dim}\n'.format(var=var,
+                                                    dim='1' if dim is DIMENSIONLESS else repr(dim))
+    error_terms = []
+    for var in output_vars:
+        unit = get_unit(eqs[var].dim)
+        targets = np.zeros((n_steps, first_trace[-1]))
+        weights = np.zeros((n_steps, first_trace[-1]))
+        for c, data in enumerate(datasets):
+            targets[:lengths[c], first_trace[c]:first_trace[c+1]] = np.asarray(data[var]).T
+            weights[:, first_trace[c]:first_trace[c+1]] = online_error_weights(metrics[c][var], n_steps,
+                                                                               lengths[c], dt)[:,None]
+        namespace['target_'+var] = TimedArray(targets*unit, dt=dt)
+        namespace['weight_'+var] = TimedArray(weights/unit**2, dt=dt)
+        error_terms.append('weight_{var}(t, trace)*({var} - target_{var}(t, trace))**2'.format(var=var))
+
+    ## Neurons: for each cell, n_samples blocks of its traces
+    cell, sample, trace = [], [], []
+    for c in range(n_cells):
+        for s in range(n_samples):
+            cell.extend([c]*n_traces[c])
+            sample.extend([s]*n_traces[c])
+            trace.extend(range(first_trace[c], first_trace[c+1]))
+    cell, sample, trace = np.array(cell), np.array(sample), np.array(trace)
+
+    simulator = setup_fit()
+    neurons = NeuronGroup(len(trace), eqs + Equations(extra_equations), method='euler',
+                          name='neurons', namespace=namespace, dt=dt) # the time step of the data
+    neurons.trace = trace
+    neurons.run_regularly('error += '+' + '.join(error_terms), when='start')
+    monitor = StateMonitor(neurons, 'error', record=False, name='statemonitor', dt=dt) # nothing recorded
+    simulator.initialize(Network(neurons, monitor), init, name='multi_fit')
+
+    optimizers = []
+    for c in range(n_cells):
+        optimizer = NevergradOptimizer(method=method)
+        initialize_optimizer(optimizer, parameter_names, n_samples, n_rounds, bounds_DE)
+        optimizers.append(optimizer)
+
+    ## Differential evolution
+    key = model_hash(eqs, 'euler', dt, input_vars, output_vars)
+    t1 = time()
+    with cached_project(key+'-multi' if cache else None) as compilation:
+        for i in range(n_rounds):
+            candidates = [optimizer.ask(n_samples=n_samples) for optimizer in optimizers]
+            values = np.array([candidates[c][s] for c, s in zip(cell, sample)]) # neuron x parameter
+            params = {name: values[:, k] for k, name in enumerate(parameter_names)}
+            simulator.run(n_steps*dt, params, parameter_names, iteration=i, name='multi_fit')
+
+            # Error of each sample = mean error over the cell's traces
+            trace_errors = np.array(neurons.error_)
+            best_errors = []
+            for c, optimizer in enumerate(optimizers):
+                errors = np.bincount(sample[cell == c], weights=trace_errors[cell == c],
+                                     minlength=n_samples)/n_traces[c]
+                optimizer.tell(candidates[c], errors)
+                best_errors.append(np.nanmin(optimizer.errors))
+            print('Round {}: best error = {} (median over cells), {} (worst cell)'.format(i, np.median(best_errors),
+                                                                                       np.max(best_errors)))
+    print('Fitting took {} s (compilation: {} s)'.format(time() - t1, compilation['compile_time']))
+
+    ## Results
+    all_best_params, all_results = [], []
+    for c, optimizer in enumerate(optimizers):
+        best_params = {name: Quantity(value, dim=eqs[name].dim)
+                       for name, value in zip(parameter_names, optimizer.recommend())}
+        t = datasets[c]['t']
+        results = {'fitting_start': float(metrics[c][output_vars[0]].t_start), 'fitting_end': float(t[-1])}
+        results.update(fitting_parameters)
+        cell_model = dict(model)
+        cell_model['constants'] = dict(model.get('constants', {}))
+        cell_model['constants'].update(best_params)
+        cell_model['constants'] = dictionary_units_to_str(cell_model['constants'])
+        cell_model.pop('bounds', None)
+        results['model'] = cell_model
+        results['error'] = float(np.nanmin(optimizer.errors))**.5
+        results['compile_time'] = float(compilation['compile_time'])
+        all_best_params.append(best_params)
+        all_results.append(results)
+
+    return all_best_params, all_results
@@ -7,15 +7,17 @@ from brian2.units.constants import faraday_constant as F
 from brian2.units.constants import gas_constant as R
 from brian2modelfitting import *
 from file_management import build_model
+from .model_cache import *
 
 set_device('cpp_standalone', directory=None)
 
 __all__ = ['run_model']
 
-def run_model(description=None, data=None):
+def run_model(description=None, data=None, cache=True):
     '''
     Runs an optimized model on the data.
     Returns all variables as a dictionary.
+    If `cache` is True, the compiled project is taken from and stored in the model cache.
     '''
     eqs, init, _ = build_model(description)
 
@@ -33,6 +35,9 @@ def run_model(description=None, data=None):
                          param_init=init,
                          method='euler')
 
-    fits = fitter.generate(params={}, output_var=eqs.eq_names) # all state variables
+    key = model_hash(eqs, 'euler', dt, ['I'], eqs.eq_names)
+    with cached_project(key+'-run' if cache else None) as compilation:
+        fits = fitter.generate(params={}, output_var=eqs.eq_names) # all state variables
+    print('Compilation took {} s'.format(compilation['compile_time']))
 
     return fits
@@ -0,0 +1,4 @@
+from .piv_engine import *
+from .piv_store import *
+from .piv_statistics import *
+from .tracking import *
@@ -0,0 +1,187 @@
+'''
+PIV engine: cross-correlation of interrogation windows with search areas, calculated with FFTs in batch.
+
+This reproduces `extended_search_area_piv` of OpenPIV 0.21.2 (interrogation windows of the first frame,
+larger search areas of the second frame centered on them and zero-padded outside the image, correlation
+zero-padded to twice the search area, Gaussian sub-pixel peak, peak-to-peak signal-to-noise ratio).
+All windows of a frame are transformed at once, and the transforms of each frame are calculated once for
+the two pairs it belongs to. Transforms are calculated in single precision by default (`dtype`), with a size
+that is fast for FFTs and just large enough to contain the linear correlation (the rest of the zero-padded
+correlation of OpenPIV is 0).
+
+Grid coordinates are window centers in pixels, with y increasing downwards (row index), and velocities
+follow OpenPIV 0.21.2: u is along x, v is along -y.
+
+Example:
+    engine = PIVEngine(frames[0].shape, window_size=280, overlap=186, search_area_size=354, dt=1/30.)
+    x, y = engine.grid()
+    for u, v, sig2noise in engine.stack(frames):
+        ...
+'''
+import numpy as np
+import scipy.fft
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['PIVEngine', 'cross_correlation_piv']
+
+class PIVEngine(object):
+    '''
+    Calculates PIV vector fields for frames of shape `image_shape`.
+    `n_threads` threads are used for FFTs and correlations (by batches of `batch_size` windows).
+    '''
+    def __init__(self, image_shape, window_size, overlap=0, search_area_size=0, dt=1., width=2,
+                 n_threads=1, batch_size=16, dtype=np.float32):
+        if search_area_size == 0:
+            search_area_size = window_size
+        if overlap >= window_size:
+            raise ValueError('Overlap has to be smaller than the window_size')
+        if search_area_size < window_size:
+            raise ValueError('Search size cannot be smaller than the window_size')
+        if (window_size > image_shape[0]) or (window_size > image_shape[1]):
+            raise ValueError('window size cannot be larger than the image')
+        self.image_shape = tuple(image_shape)
+        self.window_size = window_size
+        self.search_area_size = search_area_size
+        self.step = window_size - overlap
+        self.shape = ((image_shape[0] - window_size)//self.step + 1, (image_shape[1] - window_size)//self.step + 1)
+        self.offset = window_size//2 - search_area_size//2 # position of search areas relative to windows
+        self.nfft = 2*search_area_size # size of the correlation in OpenPIV
+        self.size = scipy.fft.next_fast_len(search_area_size + window_size + width, real=True) # size of FFTs
+        self.dt = dt
+        self.width = width # half size of the region around the first peak excluded for the second peak
+        self.n_threads = n_threads
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.executor = ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+
+    def grid(self):
+        '''
+        Returns the x, y coordinates of window centers (2D arrays, in pixels).
+        '''
+        x = np.arange(self.shape[1])*self.step + self.window_size/2.
+        y = np.arange(self.shape[0])*self.step + self.window_size/2.
+        return np.meshgrid(x, y)
+
+    def windows(self, frame):
+        '''
+        Returns the interrogation windows of a frame, as an (n_windows, window_size, window_size) array.
+        '''
+        W = self.window_size
+        views = sliding_window_view(frame, (W, W))[::self.step, ::self.step][:self.shape[0], :self.shape[1]]
+        return views.reshape((-1, W, W))
+
+    def search_areas(self, frame):
+        '''
+        Returns the search areas of a frame, as an (n_windows, search_area_size, search_area_size) array.
+        Pixels outside the frame are 0.
+        '''
+        S = self.search_area_size
+        padded = np.zeros((frame.shape[0] + 2*S, frame.shape[1] + 2*S), dtype=frame.dtype)
+        padded[S:S+frame.shape[0], S:S+frame.shape[1]] = frame
+        start = S + self.offset
+        views = sliding_window_view(padded, (S, S))[start::self.step, start::self.step][:self.shape[0], :self.shape[1]]
+        return views.reshape((-1, S, S))
+
+    def transform(self, windows):
+        # 2D FFT of mean-subtracted windows, zero-padded (padded rows are not transformed along the last axis)
+        windows = (windows - windows.mean(axis=(1, 2), keepdims=True)).astype(self.dtype)
+        spectrum = scipy.fft.rfft(windows, n=self.size, axis=-1, workers=self.n_threads)
+        return scipy.fft.fft(spectrum, n=self.size, axis=-2, workers=self.n_threads)
+
+    def spectra(self, frame):
+        '''
+        Returns the FFTs of interrogation windows and search areas of a frame, and which windows are empty (all 0).
+        '''
+        windows = self.windows(frame)
+        return self.transform(windows), self.transform(self.search_areas(frame)), ~windows.any(axis=(1, 2))
+
+    def peaks(self, product):
+        '''
+        Returns the sub-pixel peak positions (rows, columns) and signal-to-noise ratios of correlations,
+        given the products of spectra. Positions are in the shifted correlation (zero displacement at the center).
+        '''
+        N, M, S = self.nfft, self.size, self.search_area_size
+        corr = scipy.fft.irfft2(product, s=(M, M), workers=1) # circular, entry k is the shift k (modulo M)
+        n = len(corr)
+        flat = corr.reshape((n, -1))
+        index = flat.argmax(axis=1)
+        corr_max = flat[np.arange(n), index]
+        i, j = index // M, index % M
+        i, j = np.where(i > S, i - M, i) + N//2, np.where(j > S, j - M, j) + N//2 # in the shifted correlation
+
+        def value(rows, columns): # values at positions in the shifted correlation
+            return corr[np.arange(n), (rows - N//2) % M, (columns - N//2) % M]
+
+        # Sub-pixel peak: Gaussian, or centroid if some values are negative
+        c, cl, cr, cd, cu = corr_max, value(i-1, j), value(i+1, j), value(i, j-1), value(i, j+1)
+        neighbors = np.array([c, cl, cr, cd, cu])
+        integer = (i == N-1) | (j == N-1) | np.isnan(neighbors).any(axis=0) | (neighbors == 0).all(axis=0)
+        centroid = (neighbors < 0).any(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            i_gaussian = i + (np.log(cl) - np.log(cr)) / (2*np.log(cl) - 4*np.log(c) + 2*np.log(cr))
+            j_gaussian = j + (np.log(cd) - np.log(cu)) / (2*np.log(cd) - 4*np.log(c) + 2*np.log(cu))
+            i_centroid = ((i-1)*cl + i*c + (i+1)*cr) / (cl + c + cr)
+            j_centroid = ((j-1)*cd + j*c + (j+1)*cu) / (cd + c + cu)
+        i_peak = np.where(integer, i, np.where(centroid, i_centroid, i_gaussian))
+        j_peak = np.where(integer, j, np.where(centroid, j_centroid, j_gaussian))
+
+        # Peak-to-peak signal-to-noise ratio: the second peak is outside a box around the first peak
+        box = np.arange(-self.width, self.width+1)
+        rows = np.clip(i[:, None, None] + box[None, :, None], 0, N-1)
+        columns = np.clip(j[:, None, None] + box[None, None, :], 0, N-1)
+        corr[np.arange(n)[:, None, None], (rows - N//2) % M, (columns - N//2) % M] = -np.inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sig2noise = corr_max / flat.max(axis=1)
+        sig2noise[(corr_max < 1e-3) | (i == 0) | (j == 0)] = 0.
+
+        return i_peak, j_peak, sig2noise
+
+    def correlate(self, spectra_a, spectra_b):
+        '''
+        Returns the u, v velocity fields and signal-to-noise ratios, from the spectra of two frames
+        (see `spectra`).
+        '''
+        window_fft, _, empty = spectra_a
+        search_fft = spectra_b[1]
+        batches = [slice(k, k + self.batch_size) for k in range(0, len(empty), self.batch_size)]
+        function = lambda batch: self.peaks(search_fft[batch] * np.conj(window_fft[batch]))
+        if self.executor is None:
+            results = [function(batch) for batch in batches]
+        else:
+            results = list(self.executor.map(function, batches))
+        i_peak, j_peak, sig2noise = [np.concatenate(x) for x in zip(*results)]
+
+        S, W, N = self.search_area_size, self.window_size, self.nfft
+        v = -((i_peak - N/2) - (S-W)/2) / self.dt
+        u = ((j_peak - N/2) - (S-W)/2) / self.dt
+        u[empty], v[empty], sig2noise[empty] = 0., 0., np.inf
+
+        return u.reshape(self.shape), v.reshape(self.shape), sig2noise.reshape(self.shape)
+
+    def __call__(self, frame_a, frame_b):
+        '''
+        Returns the u, v velocity fields and signal-to-noise ratios for a pair of frames.
+        '''
+        return self.correlate(self.spectra(frame_a), self.spectra(frame_b))
+
+    def stack(self, frames):
+        '''
+        Yields u, v and signal-to-noise ratios for each pair of consecutive frames.
+        '''
+        previous = None
+        for frame in frames:
+            spectra = self.spectra(frame)
+            if previous is not None:
+                yield self.correlate(previous, spectra)
+            previous = spectra
+
+def cross_correlation_piv(frame_a, frame_b, window_size, overlap=0, dt=1., search_area_size=0, width=2,
+                          n_threads=1, dtype=np.float64):
+    '''
+    Returns u, v and signal-to-noise ratios for a pair of frames, as `extended_search_area_piv` of
+    OpenPIV 0.21.2 (with `sig2noise_method='peak2peak'`).
+    '''
+    engine = PIVEngine(frame_a.shape, window_size, overlap=overlap, search_area_size=search_area_size, dt=dt,
+                       width=width, n_threads=n_threads, dtype=dtype)
+    return engine(frame_a, frame_b)
@@ -0,0 +1,64 @@
+'''
+Frame-by-frame statistics of PIV vector fields, calculated on whole trials at once.
+
+Vector fields are (frames, rows, columns) arrays of u, v (see `piv_store.py`); invalid frames are NaN and
+give NaN statistics. Circular statistics follow `scipy.stats.circmean` and `circvar` (SciPy >= 1.8:
+the variance is 1 - R), calculated on the angle of vectors.
+
+Example:
+    piv = load_piv(trial)
+    anterior, posterior = half_planes(piv['x'], piv['y'], (x1, y1), (x2, y2))
+    statistics = piv_statistics(piv['u'], piv['v'], cell_angle, selections={'anterior': anterior,
+                                                                            'posterior': posterior})
+'''
+import numpy as np
+
+__all__ = ['circular_statistics', 'half_planes', 'piv_statistics']
+
+def circular_statistics(sin_angle, cos_angle, axis=-1):
+    '''
+    Returns the circular mean (in [0, 2*pi)) and variance of angles along `axis`,
+    given their sine and cosine.
+    '''
+    if sin_angle.shape[axis] == 0:
+        shape = np.delete(sin_angle.shape, axis)
+        return np.full(shape, np.nan), np.full(shape, np.nan)
+    S, C = sin_angle.mean(axis=axis), cos_angle.mean(axis=axis)
+    mean = np.arctan2(S, C) % (2*np.pi)
+    variance = 1. - np.clip(np.sqrt(S**2 + C**2), None, 1.)
+    return mean, variance
+
+def half_planes(x, y, anterior, posterior):
+    '''
+    Returns the selections (boolean (rows, columns) arrays) of grid points beyond the anterior end and
+    beyond the posterior end, on the main axis. `x`, `y` are grid coordinates, `anterior` and `posterior`
+    are the positions (x, y) of the ends (in pixels).
+    '''
+    x, y = np.meshgrid(x, y)
+    x1, y1 = anterior
+    x2, y2 = posterior
+    ux, uy = (x1-x2), (y1-y2)
+    return ((x-x1)*ux + (y-y1)*uy) > 0, ((x-x2)*ux + (y-y2)*uy) < 0
+
+def piv_statistics(u, v, cell_angle=None, selections={}):
+    '''
+    Returns per-frame statistics of vector fields `u`, `v` ((frames, rows, columns) arrays), as a dictionary:
+    * `angle_mean`, `angle_var`: circular mean and variance of the angle (relative to the field of view)
+    * `median_velocity`: median velocity along the cell axis (projection), if `cell_angle` is given
+    * `angle_mean_<name>`: circular mean of the angle on each selection of grid points
+      (dictionary of boolean (rows, columns) arrays)
+    '''
+    u, v = np.asarray(u, dtype=float), np.asarray(v, dtype=float)
+    n_frames = len(u)
+    angle = np.arctan2(v, u).reshape((n_frames, -1))
+    sin_angle, cos_angle = np.sin(angle), np.cos(angle)
+
+    statistics = {}
+    statistics['angle_mean'], statistics['angle_var'] = circular_statistics(sin_angle, cos_angle)
+    if cell_angle is not None:
+        velocity = np.sqrt(u*u + v*v).reshape((n_frames, -1))
+        statistics['median_velocity'] = np.median(velocity * np.cos(angle - cell_angle), axis=1)
+    for name, selection in selections.items():
+        selection = selection.flatten()
+        statistics['angle_mean_'+name], _ = circular_statistics(sin_angle[:, selection], cos_angle[:, selection])
+    return statistics
@@ -0,0 +1,140 @@
+'''
+Storage of PIV vector fields.
+
+The vector fields of a trial are stored in the trial folder `protocol/piv/NNN`, as NumPy files that can be
+memory-mapped:
+* `velocity.npy`: (frames, rows, columns, 2) float32 array of u, v (in um/s), NaN for invalid frames
+* `valid.npy`: (frames,) boolean array, False for invalid frames (missed frames)
+* `x.npy`, `y.npy`: grid coordinates (window centers, in pixels), with y = 0 at the top
+Frame k is the displacement between images k and k+1. PIV parameters are in `piv.yaml`.
+
+Trials saved by earlier versions (text files `velocity_uNNNNN.txt.gz`, `velocity_vNNNNN.txt.gz` per frame,
+empty files `velocity_uNNNNN_invalid.txt.gz` for invalid frames, `grid.txt.gz`) can be read with `load_piv`,
+and converted with `convert_piv_folder`.
+
+Example:
+    for trial in piv_trials(path):
+        piv = load_piv(trial)
+        u, v = piv['u'][piv['valid']], piv['v'][piv['valid']] # (frames, rows, columns)
+'''
+import os
+import numpy as np
+
+__all__ = ['piv_trials', 'PIVWriter', 'save_piv', 'load_piv', 'convert_piv_folder']
+
+def piv_trials(path):
+    '''
+    Returns the sorted list of PIV trial folders of protocol folder `path`.
+    '''
+    trials = [f.path for f in os.scandir(os.path.join(path, 'piv')) if f.name.isnumeric()]
+    trials.sort()
+    return trials
+
+class PIVWriter(object):
+    '''
+    Writes the vector fields of a trial frame by frame, into a memory-mapped file.
+    The files appear in `folder` when the writer is closed. Used as a context manager, the writer is closed
+    at the end of the block, or aborted if an exception was raised.
+    '''
+    def __init__(self, folder, n_frames, x, y):
+        self.folder = folder
+        self.temporary_filename = os.path.join(folder, 'velocity.{}.tmp'.format(os.getpid()))
+        self.velocity = np.lib.format.open_memmap(self.temporary_filename, mode='w+', dtype=np.float32,
+                                                  shape=(n_frames, len(y), len(x), 2))
+        self.velocity[:] = np.nan
+        self.valid = np.zeros(n_frames, dtype=bool)
+        np.save(os.path.join(folder, 'x.npy'), np.asarray(x))
+        np.save(os.path.join(folder, 'y.npy'), np.asarray(y))
+
+    def write(self, frame, u, v):
+        '''
+        Writes the vector field of frame `frame`.
+        '''
+        self.velocity[frame, :, :, 0] = u
+        self.velocity[frame, :, :, 1] = v
+        self.valid[frame] = True
+
+    def close(self):
+        self.velocity.flush()
+        del self.velocity
+        np.save(os.path.join(self.folder, 'valid.npy'), self.valid)
+        os.replace(self.temporary_filename, os.path.join(self.folder, 'velocity.npy'))
+
+    def abort(self):
+        '''
+        Deletes the temporary file, without writing the vector fields.
+        '''
+        del self.velocity
+        if os.path.exists(self.temporary_filename):
+            os.remove(self.temporary_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def save_piv(folder, u, v, valid, x, y):
+    '''
+    Saves the vector fields of a trial.
+    `u`, `v` are (frames, rows, columns) arrays, `valid` a boolean array, `x`, `y` the grid coordinates.
+    '''
+    with PIVWriter(folder, len(valid), x, y) as writer:
+        for frame in np.nonzero(valid)[0]:
+            writer.write(frame, u[frame], v[frame])
+
+def load_text_piv(folder):
+    '''
+    Loads the vector fields of a trial saved as text files.
+    '''
+    x, y = np.loadtxt(os.path.join(folder, 'grid.txt.gz')).T
+    filenames = sorted([name for name in os.listdir(folder) if name[:10] == 'velocity_u'])
+    n_frames = max([int(name[10:15]) for name in filenames]) if len(filenames) > 0 else 0 # first frame is 1
+    velocity = np.full((n_frames, len(y), len(x), 2), np.nan, dtype=np.float32)
+    valid = np.zeros(n_frames, dtype=bool)
+    for name in filenames:
+        if 'invalid' not in name:
+            frame = int(name[10:15]) - 1
+            velocity[frame, :, :, 0] = np.loadtxt(os.path.join(folder, name))
+            velocity[frame, :, :, 1] = np.loadtxt(os.path.join(folder, 'velocity_v' + name[10:]))
+            valid[frame] = True
+    return {'velocity': velocity, 'valid': valid, 'x': x, 'y': y}
+
+def load_piv(folder, mmap=True):
+    '''
+    Loads the vector fields of a trial, as a dictionary with `velocity`, `u`, `v` ((frames, rows, columns)
+    views of `velocity`), `valid`, `x`, `y` (see module documentation).
+    Velocities are memory-mapped (read-only) if `mmap` is True.
+    Trials saved as text files are read from the text files.
+    '''
+    if os.path.exists(os.path.join(folder, 'velocity.npy')):
+        piv = {'velocity': np.load(os.path.join(folder, 'velocity.npy'), mmap_mode='r' if mmap else None),
+               'valid': np.load(os.path.join(folder, 'valid.npy'))}
+        for name in ['x', 'y']:
+            piv[name] = np.load(os.path.join(folder, name+'.npy'))
+    else:
+        piv = load_text_piv(folder)
+    piv['u'], piv['v'] = piv['velocity'][..., 0], piv['velocity'][..., 1]
+    return piv
+
+def convert_piv_folder(folder, remove=False):
+    '''
+    Converts the vector fields of a trial saved as text files to the binary format.
+    If `remove` is True, the text files are deleted after conversion.
+    Returns the number of frames (0 if there is nothing to convert).
+    '''
+    filenames = [name for name in os.listdir(folder) if name[:9] == 'velocity_' and name[-7:] == '.txt.gz']
+    if (len(filenames) == 0) or not os.path.exists(os.path.join(folder, 'grid.txt.gz')):
+        return 0
+    piv = load_text_piv(folder)
+    with PIVWriter(folder, len(piv['valid']), piv['x'], piv['y']) as writer:
+        writer.velocity[:] = piv['velocity']
+        writer.valid[:] = piv['valid']
+
+    if remove:
+        for name in filenames + ['grid.txt.gz']:
+            os.remove(os.path.join(folder, name))
+    return len(piv['valid'])
@@ -0,0 +1,124 @@
+'''
+Tracking of image patches by phase cross-correlation, on whole stacks of frames.
+
+This reproduces `skimage.registration.phase_cross_correlation` (with `upsample_factor` and phase normalization)
+applied to patches of a reference image and of each frame, but the spectra of reference patches are calculated
+once, only the patches of frames are filtered, and all frames are correlated in batch (including the upsampled
+refinement of the peak).
+
+Example:
+    tracker = PatchTracker(stack[0], [(x1, y1), (x2, y2)], size=112, sigma=8)
+    shifts = tracker.track(stack[1:]) # (frames, patches, 2) array of (x, y) shifts, in pixels
+'''
+import numpy as np
+import scipy.fft
+from scipy.ndimage import gaussian_filter
+
+__all__ = ['PatchTracker']
+
+def upsampled_dft(data, upsampled_region_size, upsample_factor, offsets):
+    '''
+    Upsampled DFT of (frames, rows, columns) arrays `data` around (frames, 2) `offsets`,
+    as `_upsampled_dft` in scikit-image.
+    '''
+    n_rows, n_columns = data.shape[1:]
+    region = np.arange(upsampled_region_size)
+
+    def kernels(n, offset): # (frames, upsampled_region_size, n), separated as region and offset terms
+        frequencies = scipy.fft.fftfreq(n, upsample_factor)
+        return np.exp(-2j*np.pi * region[None, :, None] * frequencies[None, None, :]) * \
+               np.exp(2j*np.pi * offset[:, None, None] * frequencies[None, None, :])
+
+    data = np.matmul(data, kernels(n_columns, offsets[:, 1]).transpose((0, 2, 1)))
+    return np.matmul(kernels(n_rows, offsets[:, 0]), data)
+
+class PatchTracker(object):
+    '''
+    Tracks patches of `reference_image` of size `size` centered on `positions` ((x, y) in pixels).
+    Frames are filtered with a Gaussian of width `sigma` (no filtering if None); only the patches are filtered,
+    with the same result as filtering the whole frame.
+    '''
+    def __init__(self, reference_image, positions, size, sigma=None, truncate=2., upsample_factor=100,
+                 normalization='phase', batch_size=256):
+        self.image_shape = reference_image.shape
+        self.slices = [(slice(int(y - size / 2), int(y + size / 2)), slice(int(x - size / 2), int(x + size / 2)))
+                       for x, y in positions]
+        self.spectra = [scipy.fft.fft2(reference_image[rows, columns]) for rows, columns in self.slices]
+        self.sigma = sigma
+        margin = 0 if sigma is None else int(truncate * sigma + 0.5) # radius of the filter
+        self.regions = [((max(rows.start - margin, 0), min(rows.stop + margin, self.image_shape[0])),
+                         (max(columns.start - margin, 0), min(columns.stop + margin, self.image_shape[1])))
+                        for rows, columns in self.slices]
+        self.truncate = truncate
+        self.upsample_factor = upsample_factor
+        self.normalization = normalization
+        self.batch_size = batch_size
+
+    def crops(self, frame):
+        '''
+        Returns the regions of a frame needed for the patches (with a margin for the filter, except at the
+        image borders, where the filter reflects the image).
+        '''
+        return [np.array(frame[r0:r1, c0:c1]) for (r0, r1), (c0, c1) in self.regions]
+
+    def patches(self, crops, k):
+        '''
+        Returns patch `k` of frames, filtered, given the (frames, rows, columns) array of its regions.
+        '''
+        if self.sigma is None:
+            return crops
+        rows, columns = self.slices[k]
+        (r0, _), (c0, _) = self.regions[k]
+        filtered = gaussian_filter(crops, (0, self.sigma, self.sigma), truncate=self.truncate)
+        return filtered[:, rows.start-r0:rows.stop-r0, columns.start-c0:columns.stop-c0]
+
+    def shifts(self, crops, k):
+        '''
+        Returns the (row, column) shifts of patch `k` in frames, as a (frames, 2) array,
+        given the (frames, rows, columns) array of its regions (see `crops`).
+        '''
+        product = self.spectra[k][None, :, :] * np.conj(scipy.fft.fft2(self.patches(crops, k)))
+        if self.normalization == 'phase':
+            product /= np.maximum(np.abs(product), 100 * np.finfo(product.real.dtype).eps)
+        correlation = np.abs(scipy.fft.ifft2(product))
+
+        # Peak at pixel precision
+        n, shape = len(crops), np.array(product.shape[1:])
+        maxima = np.array(np.unravel_index(correlation.reshape((n, -1)).argmax(axis=1), tuple(shape))).T
+        shift = maxima.astype(float)
+        shift = np.where(shift > np.trunc(shape / 2), shift - shape, shift)
+
+        # Refinement with an upsampled DFT around the peak
+        if self.upsample_factor > 1:
+            upsample_factor = float(self.upsample_factor)
+            shift = np.round(shift * upsample_factor) / upsample_factor
+            upsampled_region_size = np.ceil(upsample_factor * 1.5)
+            dftshift = np.trunc(upsampled_region_size / 2.)
+            correlation = np.abs(upsampled_dft(product.conj(), int(upsampled_region_size), upsample_factor,
+                                               dftshift - shift * upsample_factor))
+            maxima = np.array(np.unravel_index(correlation.reshape((n, -1)).argmax(axis=1), correlation.shape[1:])).T
+            shift = shift + (maxima - dftshift) / upsample_factor
+        shift[:, shape == 1] = 0
+        return shift
+
+    def track(self, frames):
+        '''
+        Returns the (x, y) shifts of all patches in `frames` (any iterable of frames), as a (frames, patches, 2)
+        array. Only the patch regions of `batch_size` frames are held in memory.
+        '''
+        shifts, batch = [], []
+
+        def process(batch):
+            crops = [np.array(regions) for regions in zip(*batch)]
+            shifts.append(np.stack([self.shifts(crops[k], k)[:, ::-1] for k in range(len(self.slices))], axis=1))
+
+        for frame in frames:
+            batch.append(self.crops(frame))
+            if len(batch) == self.batch_size:
+                process(batch)
+                batch = []
+        if len(batch) > 0:
+            process(batch)
+        if len(shifts) == 0:
+            return np.zeros((0, len(self.slices), 2))
+        return np.concatenate(shifts)
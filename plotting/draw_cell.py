@@ -4,7 +4,7 @@ Plotting cell and cilia movement
 import numpy as np
 from skimage.draw import polygon, circle
 
-__all__ = ['cell_border', 'plot_cell', 'cell_mask', 'cell_indices']
+__all__ = ['cell_border', 'plot_cell', 'cell_mask', 'cell_indices', 'cell_fraction']
 
 cell_length = 120.
 cell_width = 35.
@@ -60,6 +60,17 @@ def cell_indices(x, y, image, pixel_size=1., theta = 0.):
 
     return rr, cc
 
+def cell_fraction(inside, x, y, theta=0., resolution=1.):
+    '''
+    Returns the fraction of the cell area where `inside(X, Y)` is True (X, Y: arrays of coordinates in um),
+    for a cell at position (`x`, `y`) (in um; arrays are broadcast) and angle `theta`.
+    The cell area is sampled on a grid of `resolution` um.
+    '''
+    xshape, yshape = cell_border(theta)
+    rr, cc = polygon((yshape - yshape.min())/resolution, (xshape - xshape.min())/resolution)
+    X, Y = xshape.min() + cc*resolution, yshape.min() + rr*resolution
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    return np.mean(inside(x[..., None] + X, y[..., None] + Y), axis=-1)
 
 def plot_cell(ax, x,y,scale, theta = 0., **kwds):
     '''
@@ -0,0 +1,27 @@
+'''
+Converts fitted traces saved as text files (`fits/<name>/fitsNNN.txt.gz`) to binary files (`fits/<name>.npz`),
+for all cells in a folder.
+
+Usage: python convert_fits.py folder [--remove]
+With --remove, the text files are deleted after conversion.
+'''
+import sys
+import os
+from os.path import join, split
+from file_management import *
+from fitting.fit_store import convert_fit_folder
+
+### Command line arguments: path, remove flag
+path = sys.argv[1]
+remove = '--remove' in sys.argv[2:]
+
+### Go through all cells
+for folder in cell_folders(path):
+    fit_folder = join(folder, 'fits')
+    if not os.path.exists(fit_folder):
+        continue
+    for fit in os.scandir(fit_folder):
+        if fit.is_dir():
+            trials = convert_fit_folder(folder, fit.name, remove=remove)
+            if len(trials) > 0:
+                print(split(folder)[1], fit.name, '{} trials'.format(len(trials)))
@@ -0,0 +1,27 @@
+'''
+Converts PIV vector fields saved as text files (`piv/NNN/velocity_uNNNNN.txt.gz`...) to binary files
+(`piv/NNN/velocity.npy`...), for all protocols in a folder.
+
+Usage: python convert_piv.py folder [--remove]
+With --remove, the text files are deleted after conversion.
+'''
+import sys
+import os
+from os.path import split
+from file_management import *
+from image_analysis.piv_store import piv_trials, convert_piv_folder
+
+### Command line arguments: path, remove flag
+path = sys.argv[1]
+remove = '--remove' in sys.argv[2:]
+
+### Go through all protocols
+for folder in protocol_folders(path, recursive=True):
+    if not os.path.exists(os.path.join(folder, 'piv')):
+        continue
+    n_trials = 0
+    for trial in piv_trials(folder):
+        if convert_piv_folder(trial, remove=remove) > 0:
+            n_trials += 1
+    if n_trials > 0:
+        print(split(folder)[1], '{} trials'.format(n_trials))
@@ -2,6 +2,11 @@
 Makes a high quality compressed mp4 movie from a tiff sequence (4 MB/s).
 Runs recursively on a cluster using `parallel`.
 
+Movies have the size of the images (no resizing to multiples of 16 pixels), so that image analysis scripts
+can read frames from movies instead of TIFF files (see `file_management/frame_source.py`).
+The size of the images and the missed frames (frames identical to the previous one, which compression does not
+preserve exactly) are stored with the movie, in `images/NNN.yaml`: movies of other sizes are refused.
+
 Argument: folder name
 '''
 import imageio
@@ -10,8 +15,10 @@ import os
 import yaml
 from file_management.batch_processing import *
 from file_management.configuration import *
+from file_management.frame_source import *
 
 default_fps = 30.
+decode_threads = 4 # threads for reading images (hides I/O latency)
 
 ### Command line argument: path
 path = sys.argv[1]
@@ -26,16 +33,21 @@ if os.path.exists(protocol_filename):
         fps = yaml.load(f).get('framerate', default_fps)
 
     ### Write file
-    new_filename = path+'.mp4'
-
-    file_list = [f.path for f in os.scandir(path) if f.name[-5:]=='.tiff']
-    file_list.sort()
+    new_filename = movie_filename(path)
 
-    writer = imageio.get_writer(new_filename, fps=fps, quality=None, bitrate=4000000*8) # 4 MB/s seems acceptable
-    for file in file_list:
-        image = imageio.imread(file)
-        writer.append_data(image)
+    # macro_block_size=2: even sizes are kept, as required by the codec
+    writer = imageio.get_writer(new_filename, fps=fps, quality=None, bitrate=4000000*8, macro_block_size=2) # 4 MB/s seems acceptable
+    with TIFFSource(path, n_threads=decode_threads) as source: # images are decoded ahead by a pool of threads
+        missed, previous = [], None
+        for i, image in enumerate(source):
+            writer.append_data(image)
+            if (previous is not None) and source.is_duplicate(i, image, previous):
+                missed.append(i)
+            previous = image
+        n_frames, height, width = source.shape[:3]
     writer.close()
+    with open(os.path.normpath(path)+'.yaml', 'w') as f: # description of the images, checked when frames are read
+        yaml.dump({'width': int(width), 'height': int(height), 'frames': int(n_frames), 'missed_frames': missed}, f)
 else: # Not an image folder: look recursively for protocol folders
     ### Look for all protocol folders
     folders = protocol_folders(path, recursive=True)
@@ -0,0 +1,19 @@
+'''
+Runs the processing pipeline (see `file_management/pipeline.py`) on all cells in a folder:
+only stages whose outputs are missing or whose inputs have changed are run.
+
+Usage: python run_pipeline.py folder [stage ...] [--dry-run]
+Stages are names of default stages (e.g. piv piv_analysis fix_positions); by default, all stages.
+Tasks are run on the cluster if `cluster` is True in the configuration file, otherwise with `jobs` local processes.
+'''
+import sys
+from file_management.configuration import *
+from file_management.pipeline import run_pipeline
+
+### Command line arguments: path, stages, dry run flag
+path = sys.argv[1]
+stages = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+dry_run = '--dry-run' in sys.argv[2:]
+
+run_pipeline(path, stages=stages if len(stages) > 0 else None, n_processes=config.get('jobs', 5),
+             cluster=config.get('cluster', False), dry_run=dry_run)
@@ -23,18 +23,12 @@ C = paramecium_constants()['C']
 x_wall = 1*mm
 I0 = 5*nA
 
-cell = PlaneMovingCell((1000, 1000), theta=pi / 2)
-cell.dt = float(1*ms)
-
 eqs= paramecium_equations() + Equations('''
 dv/dt = (IL+ICa_cilia+IK+IKir+IKCa_cilia+I)/C : volt
 I = I0*stim : amp # (x>x_wall) : amp
 stim : 1
-x : meter
-y : meter
-orientation : 1
 angle : 1
-''')
+''') + kinematic_equations()
 
 neuron = NeuronGroup(1, eqs)
 neuron.v = paramecium_constants()['EL']
@@ -42,29 +36,25 @@ neuron.x = 0*mm
 neuron.y = 1*mm
 M = StateMonitor(neuron, ('x', 'y', 'orientation', 'angle', 'v', 'I', 'Cai_cilia', 'velocity', 'theta', 'stim'), record = True, dt = .1*ms)
 
-@network_operation(dt=1*ms)
-def update_position():
-    cell.set_velocity(1e6*float(neuron.velocity[0]))
-    cell.set_rotation_angle(float(neuron.theta[0]), spin=neuron.omega[0])
-    cell.x = array([neuron.x[0]/um, neuron.y[0]/um,0.])
-    axis = cell.spiral_axis()[:2]
-    neuron.angle = np.arctan2(axis[1], axis[0])
-
-    cell.integrate()
-    x, y, _ = cell.x
-    neuron.x[0], neuron.y[0] = x*um, y*um
-    neuron.orientation[0] = cell.orientation()
-
-    # Stimulus calculation
-    if x<x_wall/um-60: # not on obstacle
-        neuron.stim[0] = 0
-    elif x>x_wall/um+60: # fully in obstacle
-        neuron.stim[0] = 1
-    else:
-        rr, cc = cell_indices(x, y, image, pixel_size=1, theta=neuron.orientation[0])
-        if len(cc)>0:
-            stimulus = sum(1*cc>x_wall/um) / len(cc)
-            neuron.stim[0] = stimulus
+set_plane_orientation(neuron, pi/2)
+
+# Stimulus: fraction of the cell beyond the wall, tabulated as a function of the distance to the wall
+# (x - x_wall, 1 um bins from -60 to 60 um) and orientation (1 degree bins)
+distances = arange(-60, 61) + .5 # in um
+angles = (arange(360) + .5)*pi/180 - pi
+wall_table = TimedArray(array([cell_fraction(lambda X, Y: X > 0, distances, 0, angle) for angle in angles]).T,
+                        dt=1*second) # the distance index is passed as time
+
+# Angle of the spiral axis (before the kinematic step)
+neuron.run_regularly('''
+spiral_x = -omega*((1 - 2*(qy**2 + qz**2))*sin(theta) + 2*(qx*qz + qw*qy)*cos(theta))*second
+spiral_y = -omega*(2*(qx*qy + qw*qz)*sin(theta) + 2*(qy*qz - qw*qx)*cos(theta))*second
+angle = arctan2(spiral_y, spiral_x)
+''', dt=1*ms, when='start', order=0)
+add_kinematics(neuron, dt=1*ms, beta=0*Hz, exact_correction=True, when='start', order=1) # as PlaneMovingCell
+neuron.run_regularly('''
+stim = int(x > x_wall + 60*um) + int(abs(x - x_wall) <= 60*um)*wall_table((x - x_wall + 60*um)/um*second, int((orientation + pi)*180/pi) % 360)
+''', dt=1*ms, when='start', order=2)
 
 run(4*second)
 
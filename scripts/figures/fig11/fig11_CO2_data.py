@@ -55,11 +55,7 @@ I = I0*(m-h) : amp
 dm/dt = (stim-m)/tau_stim : 1 # ON pathway
 dh/dt = (stim-h)/tau_adapt : 1 # OFF pathway
 stim : 1
-x : meter
-y : meter
-z : meter
-orientation : 1
-''')
+''') + kinematic_equations()
 
 neuron = NeuronGroup(N, eqs, threshold='velocity<0*meter/second', refractory='velocity<=0*meter/second')
 neuron.v = paramecium_constants()['EL']
@@ -71,28 +67,18 @@ neuron.h = xinit/x0
 M = StateMonitor(neuron, ('x', 'y', 'z', 'orientation'), record = True, dt = 33*ms)
 S = SpikeMonitor(neuron)
 
-cells = PlaneMovingCells(N)
-cells.dt = float(2 * ms)
-cells.set_orientation(rand(N)*2*pi)
-neuron.orientation = cells.orientation()
-
-@network_operation(dt=2*ms, when='end')
-def update_position():
-    cells.set_velocity(neuron.velocity_[:] * 1e6)
-    cells.set_rotation_angle(neuron.theta_[:], spin=8*np.pi) # very fast
-
-    cells.x[:,0] = neuron.x_*1e6
-    cells.x[:,1] = neuron.y_*1e6
-    cells.x[:,2] = neuron.z_*1e6
-    cells.integrate()
-    x, y, z = cells.x.T
-
-    # Torus topology
-    x, y = x % size, y % size
-    neuron.x, neuron.y, neuron.z = x*um, y*um, z*um
-    neuron.orientation = cells.orientation()
-
-    # Stimulation
+set_plane_orientation(neuron, rand(N)*2*pi)
+spin = 8*pi/second # very fast
+add_kinematics(neuron, dt=2*ms, omega='spin')
+neuron.run_regularly('''
+x = x % (size*um) # Torus topology
+y = y % (size*um)
+''', dt=2*ms, when='end', order=1)
+
+# The CO2 field is calculated in Python: the stimulus is read from it by a network operation
+@network_operation(dt=2*ms, when='end', order=2)
+def stimulation():
+    x, y = neuron.x_[:]*1e6, neuron.y_[:]*1e6
     neuron.stim = CO2[size_pix-1 - (y/pixel_size).astype(int), (x/pixel_size).astype(int)]
 
 if movie:
@@ -103,13 +89,12 @@ if movie:
 cycle_length = 5 # number of diffusion time steps per movie frame
 cycle = cycle_length-1
 
-@network_operation(dt=33*ms/cycle_length, when='end')
+@network_operation(dt=33*ms/cycle_length, when='end', order=3)
 def diffusion():
     global CO2, cycle
 
     # CO2 production
-    x, y, _ = cells.x.T
-    x, y = x % size, y % size
+    x, y = neuron.x_[:]*1e6, neuron.y_[:]*1e6
     # note that if two cells are exactly at the same place (unlikely), they are counted just once
     CO2[size_pix-1 - (y/pixel_size).astype(int), (x/pixel_size).astype(int)] += CO2_rate*(33*ms)
 
@@ -5,7 +5,7 @@ Produces a movie and saves trajectories to file, with physiology data for 10 cel
 from brian2 import *
 from behavior import *
 import imageio
-from plotting import cell_mask, cell_indices
+from plotting import cell_indices, cell_fraction
 
 C = paramecium_constants()['C']
 N = 100
@@ -16,7 +16,6 @@ size = 4000 # in um
 # Central obstacle
 radius = 1000
 obstacle = zeros((int(size), int(size)))
-cell_area = sum(cell_mask(size/2, size/2, obstacle, pixel_size=1, theta=0))
 y, x = mgrid[0:size,0:size]
 obstacle[((x-size/2)**2+(y-size/2)**2<radius**2)] = 1
 
@@ -34,11 +33,7 @@ I = I0*(m-h) : amp
 dm/dt = (stim-m)/tau_stim : 1 # ON pathway
 dh/dt = (stim-h)/tau_adapt : 1 # OFF pathway
 stim : 1
-x : meter
-y : meter
-z : meter
-orientation : 1
-''')
+''') + kinematic_equations()
 
 neuron = NeuronGroup(N, eqs, threshold='velocity<0*meter/second', refractory='velocity<=0*meter/second')
 neuron.v = paramecium_constants()['EL']
@@ -48,38 +43,23 @@ M = StateMonitor(neuron, ('x', 'y', 'z', 'orientation'), record = True, dt = 33*
 M2 = StateMonitor(neuron, ('v', 'I', 'Cai_cilia'), record = True, dt = .1*ms)
 S = SpikeMonitor(neuron)
 
-cells = PlaneMovingCells(N)
-cells.dt = float(1 * ms)
-cells.set_orientation(rand(N)*2*pi)
-neuron.orientation = cells.orientation()
-
-@network_operation(dt=1*ms, when='end')
-def update_position():
-    cells.set_velocity(neuron.velocity_[:] * 1e6)
-    cells.set_rotation_angle(neuron.theta_[:], spin=neuron.omega_[:])
-
-    cells.x[:,0] = neuron.x_*1e6
-    cells.x[:,1] = neuron.y_*1e6
-    cells.x[:,2] = neuron.z_*1e6
-    cells.integrate()
-    x, y, z = cells.x.T
-
-    # Torus topology
-    x, y = x % size, y % size
-    neuron.x, neuron.y, neuron.z = x*um, y*um, z*um
-    neuron.orientation = cells.orientation()
-
-    # Stimulus calculation
-    for i in range(N):
-        d2 = ((x[i]-size/2)**2+(y[i]-size/2)**2)
-        if d2>(radius+60)**2: # not on obstacle
-            neuron.stim[i] = 0
-        elif d2<(radius-60)**2: # fully in obstacle
-            neuron.stim[i] = 1
-        else:
-            rr, cc = cell_indices(x[i], y[i], obstacle, pixel_size=1, theta=neuron.orientation[i])
-            stimulus = sum(obstacle[rr, cc]) / cell_area
-            neuron.stim[i] = stimulus
+set_plane_orientation(neuron, rand(N)*2*pi)
+
+# Stimulus: fraction of the cell on the stimulus, tabulated as a function of the distance to the center
+# (1 um bins from radius-60 to radius+60 um) and orientation relative to the radial direction (1 degree bins)
+distances = radius - 60 + arange(121) + .5 # in um
+angles = (arange(360) + .5)*pi/180 - pi
+stimulus_table = TimedArray(array([cell_fraction(lambda X, Y: X**2 + Y**2 < radius**2, distances, 0, angle)
+                                   for angle in angles]).T, dt=1*second) # the distance index is passed as time
+
+add_kinematics(neuron, dt=1*ms)
+neuron.run_regularly('''
+x = x % (size*um) # Torus topology
+y = y % (size*um)
+r_center = sqrt((x - size/2*um)**2 + (y - size/2*um)**2)
+angle_center = (orientation - arctan2((y - size/2*um)/um, (x - size/2*um)/um) + 3*pi) % (2*pi) # relative angle + pi
+stim = int(r_center < (radius - 60)*um) + int(abs(r_center - radius*um) <= 60*um)*stimulus_table((r_center/um - radius + 60)*second, int(angle_center*180/pi) % 360)
+''', dt=1*ms, when='end', order=1)
 
 run(duration, report='text')
 
@@ -36,11 +36,7 @@ I = I0*(m-h) : amp
 dm/dt = (stim-m)/tau_stim : 1 # ON pathway
 dh/dt = (stim-h)/tau_adapt : 1 # OFF pathway
 stim = x/x0 : 1
-x : meter
-y : meter
-z : meter
-orientation : 1
-''')
+''') + kinematic_equations()
 
 neuron = NeuronGroup(N, eqs, threshold='velocity<0*meter/second', refractory='velocity<=0*meter/second')
 neuron.v = paramecium_constants()['EL']
@@ -52,26 +48,9 @@ neuron.h = xinit/x0
 M = StateMonitor(neuron, ('x', 'y', 'z', 'orientation'), record = True, dt = 33*ms)
 S = SpikeMonitor(neuron)
 
-cells = PlaneMovingCells(N)
-cells.dt = float(2 * ms)
-cells.set_orientation(rand(N)*2*pi)
-neuron.orientation = cells.orientation()
-
-@network_operation(dt=2*ms, when='end')
-def update_position():
-    cells.set_velocity(neuron.velocity_[:] * 1e6)
-    cells.set_rotation_angle(neuron.theta_[:], spin=neuron.omega_[:]) # very fast
-
-    cells.x[:,0] = neuron.x_*1e6
-    cells.x[:,1] = neuron.y_*1e6
-    cells.x[:,2] = neuron.z_*1e6
-    cells.integrate()
-    x, y, z = cells.x.T
-
-    # Torus topology
-    y = y % height
-    neuron.x, neuron.y, neuron.z = x*um, y*um, z*um
-    neuron.orientation = cells.orientation()
+set_plane_orientation(neuron, rand(N)*2*pi)
+add_kinematics(neuron, dt=2*ms)
+neuron.run_regularly('y = y % (height*um)', dt=2*ms, when='end', order=1) # Torus topology
 
 run(duration, report='text')
 
@@ -27,34 +27,25 @@ def lift(x):
     cycles[1:][diff(x)>pi] = -2*pi # removing one cycle
     return x+cumsum(cycles)
 
-C = paramecium_constants['C']
+C = paramecium_constants()['C']
 
 
-eqs= paramecium_equations + Equations('''
+eqs= paramecium_equations() + Equations('''
 dv/dt = (IL+ICa_cilia+IK+IKCa_cilia+I)/C : volt
-I = I0*(t>t1)*(t<t2) : amp
+I = I0*int(t>t1)*int(t<t2) : amp
 I0 : amp
-orientation : 1
-''')
+''') + kinematic_equations()
 
 neuron = NeuronGroup(N, eqs, threshold='velocity>0*meter/second', refractory='velocity>=0*meter/second')
-neuron.v = paramecium_constants['EL']
+neuron.v = paramecium_constants()['EL']
 currents = exp(linspace(log(0.01),log(10),halfN))*nA
 neuron.I0[:halfN] = currents
 neuron.I0[halfN:] = currents
 M = StateMonitor(neuron, 'orientation', record = True, dt = 1*ms)
 S = SpikeMonitor(neuron) # records the end time of backward swimming
 
-cells = PlaneMovingCells(N, theta=[0*pi/2]*halfN + [-pi/2]*halfN)
-cells.dt = float(1 * ms)
-neuron.orientation = cells.orientation()
-
-@network_operation(dt=1*ms, when='end')
-def update_position():
-    cells.set_velocity(neuron.velocity_[:] * 1e6)
-    cells.set_rotation_angle(neuron.theta_[:], spin=neuron.omega_[:])
-    cells.integrate()
-    neuron.orientation = cells.orientation()
+set_plane_orientation(neuron, [0*pi/2]*halfN + [-pi/2]*halfN)
+add_kinematics(neuron, dt=1*ms)
 
 run(3*second, report='text')
 
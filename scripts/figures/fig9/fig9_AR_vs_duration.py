@@ -27,38 +27,33 @@ def lift(x):
     cycles[1:][diff(x)>pi] = -2*pi # removing one cycle
     return x+cumsum(cycles)
 
-C = paramecium_constants['C']
+C = paramecium_constants()['C']
 
 
-eqs= paramecium_equations + Equations('''
+eqs= paramecium_equations() + Equations('''
 dv/dt = (IL+ICa_cilia+IK+IKCa_cilia+I)/C : volt
 I = I0*(t>t1)*(t<t1+T) : amp
 T : second
-orientation : 1
 ''')
 
 neuron = NeuronGroup(N, eqs, threshold='velocity>0*meter/second', refractory='velocity>=0*meter/second')
-neuron.v = paramecium_constants['EL']
+neuron.v = paramecium_constants()['EL']
 neuron.T = linspace(0,100,N)*ms
-M = StateMonitor(neuron, 'orientation', record = True, dt = 1*ms)
+# Kinematics does not feed back on the neuron: it is integrated after the simulation
+M = StateMonitor(neuron, ('velocity', 'theta', 'omega'), record = True, dt = 1*ms, when='end')
 S = SpikeMonitor(neuron) # records the end time of backward swimming
 
-cells = PlaneMovingCells(N, theta=0*pi/2)
-cells.dt = float(1 * ms)
-neuron.orientation = cells.orientation()
-
-@network_operation(dt=1*ms, when='end')
-def update_position():
-    cells.set_velocity(neuron.velocity_[:] * 1e6)
-    cells.set_rotation_angle(neuron.theta_[:], spin=neuron.omega_[:])
-    cells.integrate()
-    neuron.orientation = cells.orientation()
-
 run(3*second, report='text')
 
+cells = PlaneMovingCells(N, theta=0*pi/2)
+_, orientation = cells.integrate_n(len(M.t), velocity=M.velocity_.T * 1e6, theta=M.theta_.T, omega=M.omega_.T,
+                                   dt=float(1 * ms))
+orientation = orientation.T
+t = M.t + 1*ms # orientation is recorded after each step
+
 ## Calculate angles
-orientation_start = circmean(M.orientation[:,M.t<1*second], axis=1)
-orientation_end = circmean(M.orientation[:,M.t>2*second], axis=1)
+orientation_start = circmean(orientation[:,t<1*second], axis=1)
+orientation_end = circmean(orientation[:,t>2*second], axis=1)
 orientation_end = lift(orientation_end)
 angle = orientation_end - orientation_start
 
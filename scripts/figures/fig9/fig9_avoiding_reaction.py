@@ -13,36 +13,19 @@ t1 = 500*ms
 x0, y0 = 500, 800 # in um
 all_I0 = array([0.3,.5,5])*nA
 
-C = paramecium_constants['C']
+C = paramecium_constants()['C']
 
-cells = PlaneMovingCells(1, theta=pi / 4)
-cells.dt = float(1*ms)
-
-eqs= paramecium_equations + Equations('''
+eqs= paramecium_equations() + Equations('''
 dv/dt = (IL+ICa_cilia+IK+IKir+IKCa_cilia+I)/C : volt
-I = I0*((t>t1)*(t<t1+2*ms)) : amp
-x : meter
-y : meter
-orientation : 1
-''')
+I = I0*int(t>t1)*int(t<t1+2*ms) : amp
+''') + kinematic_equations()
 
 neuron = NeuronGroup(1, eqs)
-neuron.v = paramecium_constants['EL']
-neuron.orientation = cells.orientation()
+neuron.v = paramecium_constants()['EL']
+set_plane_orientation(neuron, pi / 4)
+add_kinematics(neuron, dt=1*ms)
 M = StateMonitor(neuron, ('x', 'y', 'orientation'), record = True, dt = 1*ms)
 
-@network_operation(dt=1*ms, when='end')
-def update_position():
-    cells.set_velocity(neuron.velocity_[:] * 1e6)
-    cells.set_rotation_angle(neuron.theta_[:], spin=neuron.omega_[:])
-
-    cells.x[:,0] = neuron.x_*1e6
-    cells.x[:,1] = neuron.y_*1e6
-    cells.integrate()
-    x, y, _ = cells.x.T
-    neuron.x, neuron.y = x*um, y*um
-    neuron.orientation = cells.orientation()
-
 for I0 in all_I0:
     run(1*second)
     t1 += 1*second
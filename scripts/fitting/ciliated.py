@@ -14,6 +14,7 @@ from brian2.units.constants import faraday_constant as F
 from brian2.units.constants import gas_constant as R
 
 savefits = False
+warm_start = False # start from the previous fit of the cell
 
 path, display = fit_arguments(default='~/hodgkin/Paramecium/Electrophysiology/Selection - AP Model/Ciliated with PIV/2020-10-12 16.08.21 cell')
 
@@ -22,7 +23,8 @@ run_this_on_all_cells(path)
 ### Parameters
 fitting_parameters = {'n_rounds': 100,
                       'n_samples': 100, # not too large for memory reasons
-                      'n_refine_rounds': 2000}
+                      'n_refine_rounds': 2000,
+                      'coarse': 1} # subsampling factor for differential evolution (e.g. 4 for 10 kHz)
 
 ### Model
 model = load_models('Ie', 'IL', 'IV_K_ohmic', 'IK_bell_simple', 'IV_Ca_GHK', 'ICa_cilia_pCa',
@@ -81,7 +83,11 @@ metrics = {'v': MSEMetric(t_weights=weights_v, normalization=1*mV),
            'cos_angle': MSEMetric(t_start=stimulus_start-100*ms, normalization=1),
            'sin_angle': MSEMetric(t_start=stimulus_start-100*ms, normalization=1)}
 
-fits, best_params, results = two_stage_fit(model=model, data=data, metrics=metrics, **fitting_parameters)
+if warm_start:
+    fitting_parameters['init_population'] = [fitted_parameters(path)]
+
+fits, best_params, results = two_stage_fit(model=model, data=data, metrics=metrics,
+                                           checkpoint=checkpoint_file(path), **fitting_parameters)
 
 # Write to file
 write_fit_file(results, path)
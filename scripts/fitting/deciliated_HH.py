@@ -16,7 +16,8 @@ run_this_on_all_cells(path)
 ### Parameters
 fitting_parameters = {'n_rounds' : 150,
                       'n_samples' : 100,
-                      'n_refine_rounds' : 2000}
+                      'n_refine_rounds' : 2000,
+                      'coarse' : 1} # subsampling factor for differential evolution (e.g. 4 for 10 kHz)
 
 ### Model
 model = load_models('Ie', 'IL', 'IV_K_ohmic', 'IK_HH')
@@ -7,11 +7,12 @@ import numpy as np
 from file_management.batch_processing import *
 from file_management.configuration import *
 import sys
-from scipy.stats import circmean, circvar
 from file_management.folder_information import cell_orientation
 from os.path import join, split
 import yaml
 from scipy.ndimage import median_filter
+from image_analysis.piv_store import *
+from image_analysis.piv_statistics import *
 
 args = sys.argv
 try:
@@ -41,48 +42,21 @@ x1, y1 = d['anterior']
 x2, y2 = d['posterior']
 
 ### Get all trials folders
-trials = [f.path for f in os.scandir(piv_folder) if f.name.isnumeric()]
-trials.sort()
+trials = piv_trials(path)
 
 ### Get grid coordinates
-x, y = np.loadtxt(os.path.join(trials[0],'grid.txt.gz')).T # in pixels
-x, y = np.meshgrid(x, y)
+piv = load_piv(trials[0])
 # Select zones beyond ends
-ux, uy = (x1-x2), (y1-y2)
-selection1 = ((x-x1)*ux + (y-y1)*uy)>0
-selection2 = ((x-x2)*ux + (y-y2)*uy)<0
+selection1, selection2 = half_planes(piv['x'], piv['y'], (x1, y1), (x2, y2))
 
 ### Go through all trials
 all1 = []
 all2 = []
 for i,trial in enumerate(trials):
-    ### Get filenames
-    u_files = [f.path for f in os.scandir(trial) if f.name[:10] == 'velocity_u']
-    u_files.sort()
-    v_files = [f.path for f in os.scandir(trial) if f.name[:10] == 'velocity_v']
-    v_files.sort()
-
-    ### Go through all frames
-    angle_mean1, angle_mean2 = [], []
-    for u_file, v_file in zip(u_files, v_files):
-        if 'invalid' in u_file:
-            angle_mean1.append(np.nan)
-            angle_mean2.append(np.nan)
-        else:
-            # Load data
-            u, v = np.loadtxt(u_file), np.loadtxt(v_file)
-
-            # Smooth the field
-            #u = median_filter(u, size=3)  # Median filter does *not* take nan correctly into account
-            #v = median_filter(v, size=3)
-
-            # Circular statistics
-            angle1 = np.arctan2(v[selection1], u[selection1])
-            angle_mean1.append(circmean(angle1))
-            angle2 = np.arctan2(v[selection2], u[selection2])
-            angle_mean2.append(circmean(angle2))
-
-    angle_mean1, angle_mean2 = np.array(angle_mean1), np.array(angle_mean2)
+    ### Load vector fields and calculate statistics on all frames
+    piv = load_piv(trial)
+    statistics = piv_statistics(piv['u'], piv['v'], selections={'anterior': selection1, 'posterior': selection2})
+    angle_mean1, angle_mean2 = statistics['angle_mean_anterior'], statistics['angle_mean_posterior']
     all1.append(angle_mean1)
     all2.append(angle_mean2)
 
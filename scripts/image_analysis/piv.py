@@ -3,24 +3,23 @@ PIV analysis
 (Particle Image Velocimetry)
 
 Calculates PIV vector fields from images.
-Data are saved as .txt.gz files.
+Data are saved in binary files, one per trial (see `image_analysis/piv_store.py`).
 If the piv folder exists, skips.
 
-Uses openpiv 0.21.2 (doesn't seem to be working with the newest version!)
+Uses the PIV engine of `image_analysis/piv_engine.py`, which reproduces openpiv 0.21.2
+(extended_search_area_piv) with batched FFTs. Newer versions of openpiv give different results (y is not flipped).
 
-!!! Note: in openpiv 0.21.2, y is flipped (y[::-1]), in later versions it's not...
-
-TODO:
-- Analysis from mp4 movies instead of TIFF
-- could be refactored with make_movie
+Images are read from the TIFF files of the trial, or from its movie (`images/NNN.mp4`, see
+`file_management/frame_source.py`), and preprocessed (background subtraction and double Gaussian filtering)
+through the cache of `file_management/image_stack.py`, shared with other image analysis scripts.
 '''
-import openpiv.process
 import os
-import imageio
 import numpy as np
-from scipy.ndimage import gaussian_filter
 import yaml
 from file_management.batch_processing import *
+from file_management.image_stack import *
+from image_analysis.piv_engine import *
+from image_analysis.piv_store import *
 from file_management.configuration import *
 import sys
 
@@ -35,11 +34,8 @@ max_velocity = 200. # in um/s, particle velocity
 particle_size = 1. # in um, for preprocessing (filtering particles based on size; this is the sigma of the inner Gaussian)
 default_pixel_size = 0.178 # in um
 default_fps = 30.
-
-#### Openpiv version check
-# 0.21.8 is new, 0.21.2 is old ; the old version inverts the y axis, not the new one
-y = openpiv.process.get_coordinates(image_size=(2,1), window_size=1, overlap=0)[1]
-openpiv_is_old = (y[0] == 1.5) # should be 0.5 if recent
+n_threads = 1 # threads for FFTs (trials are already processed in parallel)
+decode_threads = 4 # threads for reading images (hides I/O latency)
 
 ### Check whether this is an image file in a protocol
 parent = os.path.split(os.path.split(path)[0])[0]
@@ -88,15 +84,15 @@ if os.path.exists(protocol_file):
     searchsize = winsize + 2 * max_displacement
     overlap = int(winsize * 2 / 3)  # pixels
 
-    #### Ordered list of all files
-    files = [f.path for f in os.scandir(path) if f.name[-5:]=='.tiff']
-    files.sort()
+    #### Read images, calculate background and preprocess (cached)
+    # Preprocessing: remove background, filter particles with double Gaussian
+    background, filtered_stack = preprocessed_stack(path, sigma, n_threads=decode_threads)
+    missed = set(missed_frames(path, n_threads=decode_threads)) # frames repeating the previous one
 
     #### Calculate grid
-    image = imageio.imread(files[0])*1.
-    x, y = openpiv.process.get_coordinates(image_size=image.shape, window_size=winsize, overlap=overlap)
-    if openpiv_is_old:
-        y = y[::-1]
+    engine = PIVEngine(background.shape, winsize, overlap=overlap, search_area_size=searchsize, dt=dt,
+                       n_threads=n_threads)
+    x, y = engine.grid()
 
     #### Write parameters
     d = {"window_size" : window_size,
@@ -107,62 +103,44 @@ if os.path.exists(protocol_file):
     with open(os.path.join(target,'piv.yaml'), 'w') as f:
         yaml.dump(d, f)
 
-    #### Save x, y
-    np.savetxt(os.path.join(target,'grid.txt.gz'), np.vstack([x[0,:],y[:,0]]).T)
-
-    #### Calculate background
-    for f in files[1:]:
-        image += imageio.imread(f)*1.
-    background = image/len(files)
-
-    #### Compute vector fields on image pairs
-    previous_frame = None
-    nrows, ncols = x.shape
-    frame_i = 0
-    previous_missed, invalid = False, False
-    for file in files:
-        frame = imageio.imread(file)
-        # Preprocessing: remove background, filter particles with double Gaussian
-        subtracted = frame - background
-        filtered = (gaussian_filter(subtracted, sigma, truncate=2) - gaussian_filter(subtracted, sigma * 1.6, truncate=2)) * 1.3 * sigma
-
-        # Turn to int (apparently necessary for the PIV algorithm)
-        frame = (filtered * 32768).astype('int32')
-
-        # Check missed frame
-        if (frame == previous_frame).all():
-            #print('Missed frame') # This frame is invalid and the next one as well
-            # In principle we could use the next one, but then the calculated displacement would correspond to a larger time interval
-            invalid = True
-            previous_missed = True
-        elif previous_missed:
-            invalid = True
-            previous_missed = False
-        else:
-            invalid = False
-            previous_missed = False
-
-        if previous_frame is not None:
-            if invalid:
-                # Creates empty file
-                f = open(os.path.join(target, 'velocity_u{:05}_invalid.txt.gz'.format(frame_i)),'w')
-                f.close()
-                f = open(os.path.join(target, 'velocity_v{:05}_invalid.txt.gz'.format(frame_i)),'w')
-                f.close()
+    #### Output file (x, y are saved)
+    with PIVWriter(target, len(filtered_stack)-1, x[0,:], y[:,0]) as writer: # not saved if interrupted
+        #### Compute vector fields on image pairs
+        previous_frame, previous_spectra = None, None
+        nrows, ncols = x.shape
+        frame_i = 0
+        previous_missed, invalid = False, False
+        for filtered in filtered_stack:
+            # Turn to int (apparently necessary for the PIV algorithm)
+            frame = (filtered * 32768).astype('int32')
+
+            # Check missed frame (found on raw images, see file_management/frame_source.py)
+            if frame_i in missed:
+                #print('Missed frame') # This frame is invalid and the next one as well
+                # In principle we could use the next one, but then the calculated displacement would correspond to a larger time interval
+                invalid = True
+                previous_missed = True
+            elif previous_missed:
+                invalid = True
+                previous_missed = False
             else:
+                invalid = False
+                previous_missed = False
+
+            # FFTs of the frame's windows, used for the pairs (previous frame, frame) and (frame, next frame)
+            spectra = engine.spectra(frame)
+
+            if (previous_frame is not None) and not invalid: # invalid frames are NaN
                 # Calculate vector field by cross-correlation
-                u, v, sig2noise = openpiv.process.extended_search_area_piv(previous_frame, frame, window_size=winsize,
-                                                                           overlap=overlap, dt=dt, search_area_size=searchsize,
-                                                                           sig2noise_method='peak2peak')
+                u, v, sig2noise = engine.correlate(previous_spectra, spectra)
                 # Scaling to um/s
                 u, v = u * pixel_size, v * pixel_size
 
-                # Save to file
-                np.savetxt(os.path.join(target, 'velocity_u{:05}.txt.gz'.format(frame_i)), u)
-                np.savetxt(os.path.join(target, 'velocity_v{:05}.txt.gz'.format(frame_i)), v)
+                # Save to file (frame_i-1 is the displacement between frames frame_i-1 and frame_i)
+                writer.write(frame_i-1, u, v)
 
-        previous_frame = frame.copy()
-        frame_i += 1
+            previous_frame, previous_spectra = frame.copy(), spectra
+            frame_i += 1
 else:  # Not an image folder: look recursively for protocol folders
     ### Look for all protocol folders
     folders = protocol_folders(path, recursive=True)
@@ -173,7 +151,7 @@ else:  # Not an image folder: look recursively for protocol folders
         image_folder = os.path.join(folder,'images')
         piv_folder = os.path.join(folder,'piv')
         if os.path.exists(image_folder) and not (os.path.exists(piv_folder)):
-            trial_folders.extend([f.path for f in os.scandir(image_folder) if f.name.isnumeric()])
+            trial_folders.extend(image_trials(folder))
 
     python = python_binary()  # I suppose it could be obtained otherwise
 
@@ -11,8 +11,9 @@ import numpy as np
 from file_management.batch_processing import *
 from file_management.configuration import *
 import sys
-from scipy.stats import circmean, circvar
 from file_management.folder_information import cell_orientation
+from image_analysis.piv_store import *
+from image_analysis.piv_statistics import *
 
 # Parse command line arguments
 args = sys.argv
@@ -29,38 +30,15 @@ if os.path.exists(piv_folder):
     cell_angle = cell_orientation(cell_folder)
 
     ### Get all trials folders
-    trials = [f.path for f in os.scandir(piv_folder) if f.name.isnumeric()]
-    trials.sort()
+    trials = piv_trials(path)
 
     ### Go through all trials
     for i,trial in enumerate(trials):
-        ### Get filenames
-        u_files = [f.path for f in os.scandir(trial) if f.name[:10] == 'velocity_u']
-        u_files.sort()
-        v_files = [f.path for f in os.scandir(trial) if f.name[:10] == 'velocity_v']
-        v_files.sort()
-
-        ### Go through all frames
-        angle_mean, angle_var, median_velocity = [], [], []
-        for u_file, v_file in zip(u_files, v_files):
-            if 'invalid' in u_file:
-                angle_mean.append(np.nan)
-                angle_var.append(np.nan)
-                median_velocity.append(np.nan)
-            else:
-                # Load data
-                u, v = np.loadtxt(u_file), np.loadtxt(v_file)
-
-                # Circular statistics
-                angle = np.arctan2(v, u)
-                angle_mean.append(circmean(angle))
-                angle_var.append(circvar(angle))
-
-                # Median velocity along cell axis (projection)
-                if cell_angle is not None:
-                    velocity = np.sqrt(u * u + v * v)
-                    median_velocity.append(np.median(velocity * np.cos(angle - cell_angle)))
-        angle_mean, angle_var, median_velocity = np.array(angle_mean), np.array(angle_var), np.array(median_velocity)
+        ### Load vector fields and calculate statistics on all frames
+        piv = load_piv(trial)
+        statistics = piv_statistics(piv['u'], piv['v'], cell_angle)
+        angle_mean, angle_var = statistics['angle_mean'], statistics['angle_var']
+        median_velocity = statistics.get('median_velocity', None)
 
         ### Save data
         target_file = os.path.join(analysis_folder,'analysis{:03}.txt.gz'.format(i))
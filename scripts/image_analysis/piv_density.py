@@ -2,15 +2,14 @@
 Calculates the density of particles in a movie.
 After background subtraction and filtering to enhance particles, the maximum intensity is calculated in each window of size 50 um.
 The proportion of windows with intensity > 20% of unfiltered max background intensity is reported.
+Frames are read from the TIFF files of each trial, or from its movie (see `file_management/frame_source.py`).
 '''
 import os
 import numpy as np
 from file_management import *
 import sys
 from os.path import join, splitext, split
-import imageio
 import yaml
-from scipy.ndimage import gaussian_filter
 
 args = sys.argv
 try:
@@ -27,6 +26,7 @@ maximum_movement_um = 10
 particle_size = 1. # in um, for preprocessing (filtering particles based on size; this is the sigma of the inner Gaussian)
 window_size = 50. # in um
 threshold = 0.2 # density threshold
+decode_threads = 4 # threads for reading images (hides I/O latency)
 
 # Make output folder
 output_folder = join(path, 'piv_density')
@@ -37,9 +37,7 @@ if not (os.path.exists(output_folder)):
         pass
 
 # Get image folder for each trial
-image_folder = join(path, 'images')
-trial_folders = [f.path for f in os.scandir(image_folder) if f.name.isnumeric()]
-trial_folders.sort()
+trial_folders = image_trials(path)
 
 # Get information (pixel size, morphology)
 with open(join(path, 'protocol.yaml')) as f:
@@ -50,27 +48,17 @@ sigma = int(particle_size / pixel_size)
 winsize = int(window_size / pixel_size)  # in pixels
 
 for i, image_folder in enumerate(trial_folders):
-    # Ordered list of all files
-    files = [f.path for f in os.scandir(image_folder) if f.name[-5:]=='.tiff']
-    files.sort()
-
-    # Calculate background
-    image = imageio.imread(files[0])*1.
-    for f in files[1:]:
-        image += imageio.imread(f)*1.
-    background = image/len(files)
+    # Background, and frames after background subtraction and filtering (cached)
+    background, filtered_stack = preprocessed_stack(image_folder, sigma, n_threads=decode_threads)
     max_intensity = background.max()
 
-    h, w = image.shape
+    h, w = background.shape
     h_cropped, w_cropped = winsize*int(h/winsize), winsize*int(w/winsize)
     nwindows = int(h/winsize)*int(w/winsize)
 
     # Calculate density
     p = []
-    for file in files:
-        frame = imageio.imread(file)
-        subtracted = frame - background
-        filtered = (gaussian_filter(subtracted, sigma, truncate=2) - gaussian_filter(subtracted, sigma * 1.6, truncate=2)) * 1.3 * sigma
+    for filtered in filtered_stack:
         # Normalize
         filtered = filtered/max_intensity
         # Crop to multiple of window_size
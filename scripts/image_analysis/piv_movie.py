@@ -12,6 +12,7 @@ import sys
 import pylab
 import uuid
 from scipy.ndimage import median_filter
+from image_analysis.piv_store import *
 
 default_fps = 30.
 overwrite = True
@@ -28,15 +29,9 @@ if os.path.exists(description_filename):
     with open(description_filename) as f:
         fps = 1/yaml.load(f).get('dt', 1/default_fps)
 
-    ### Grid
-    x, y = np.loadtxt(os.path.join(path, 'grid.txt.gz')).T
-    x, y = np.meshgrid(x,y)
-
-    ### Get filenames
-    u_files= [f.path for f in os.scandir(path) if f.name[:10]=='velocity_u']
-    u_files.sort()
-    v_files= [f.path for f in os.scandir(path) if f.name[:10]=='velocity_v']
-    v_files.sort()
+    ### Vector fields and grid
+    piv = load_piv(path)
+    x, y = np.meshgrid(piv['x'], piv['y'])
 
     ### Make movie
     movie_out = imageio.get_writer(new_filename, fps=fps)
@@ -44,10 +39,10 @@ if os.path.exists(description_filename):
     # File with the current PIV image
     temp_filename = 'temp{}.png'.format(str(uuid.uuid4()))
 
-    for u_file, v_file in zip(u_files, v_files):
-        if not('invalid' in u_file):
+    for k, valid in enumerate(piv['valid']):
+        if valid:
             # Load
-            u, v = np.loadtxt(u_file), np.loadtxt(v_file)
+            u, v = np.array(piv['u'][k], dtype=float), np.array(piv['v'][k], dtype=float)
 
             # Filter for visualization
             u = median_filter(u, size=3)  # Median filter does *not* take nan correctly into account
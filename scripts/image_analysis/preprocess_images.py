@@ -0,0 +1,37 @@
+'''
+Preprocesses the images of all trials of a protocol: the background and filtered frames (background subtraction,
+double Gaussian filter) of each trial are cached for PIV analysis scripts (see `file_management/image_stack.py`).
+
+Scripts that use the cache (`piv.py`, `piv_density.py`, `track_ends.py`) create it if needed;
+this script can be run beforehand on the whole data set.
+'''
+import os
+from file_management import *
+import sys
+from os.path import join
+import yaml
+
+args = sys.argv
+path = args[1]
+
+run_this_on_all_protocols(path)
+
+default_pixel_size = 0.178 # in um
+particle_size = 1. # in um, for preprocessing (filtering particles based on size; this is the sigma of the inner Gaussian)
+decode_threads = 4 # threads for reading images (hides I/O latency)
+
+if not os.path.exists(join(path, 'images')):
+    exit(0)
+
+# Get pixel size, as in piv.py
+with open(join(path, 'protocol.yaml')) as f:
+    d = yaml.safe_load(f)
+pixel_size = d.get('camera_parameters', {}).get('pixel_width', default_pixel_size)
+sigma = int(particle_size / pixel_size)
+
+trial_folders = image_trials(path)
+for i, image_folder in enumerate(trial_folders):
+    preprocessed_stack(image_folder, sigma, n_threads=decode_threads)
+
+    if ((i+1)%10 == 0):
+        print(i+1,'/',len(trial_folders))
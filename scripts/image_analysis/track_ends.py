@@ -3,18 +3,20 @@ Track anterior and posterior ends.
 The first frame of each trial is matched to subsequent frames.
 Remember that "anterior" and "posterior" refer to two unidentified ends here; they could be posterior and anterior.
 Results are saved in um, measured along the main axis and the normal axis.
+Frames are read from the TIFF files of each trial, or from its movie (see `file_management/frame_source.py`).
 '''
 import os
 import numpy as np
 from file_management import *
+from image_analysis import *
 import sys
 from os.path import join, splitext, split
-import imageio
 import yaml
-from skimage.registration import phase_cross_correlation
-from scipy.ndimage import gaussian_filter
+from concurrent.futures import ThreadPoolExecutor
 
-filter = True # filters out particles; quite slow
+filter = True # filters out particles
+n_threads = 1 # number of trials tracked in parallel
+decode_threads = 4 # threads for reading images (hides I/O latency)
 
 args = sys.argv
 try:
@@ -39,9 +41,7 @@ if not (os.path.exists(output_folder)):
         pass
 
 # Get image folder for each trial
-image_folder = join(path, 'images')
-trial_folders = [f.path for f in os.scandir(image_folder) if f.name.isnumeric()]
-trial_folders.sort()
+trial_folders = image_trials(path)
 
 # Get information (pixel size, morphology)
 cell_folder = split(path)[0]
@@ -58,44 +58,19 @@ main_axis = pixel_size * main_axis / np.linalg.norm(main_axis) # we multiply by
 normal_axis = np.array([main_axis[1], -main_axis[0]])
 
 
-# Template matching
-def calculate_shift(x, y, frame):
-    # Calculates the shift (vector) between the reference image and the frame
-    shift, _, _ = phase_cross_correlation(reference_image[int(y - feature_size / 2):int(y + feature_size / 2),
-                                          int(x - feature_size / 2):int(x + feature_size / 2)],
-                                          frame[int(y - feature_size / 2):int(y + feature_size / 2),
-                                          int(x - feature_size / 2):int(x + feature_size / 2)], upsample_factor=100)
-    ys, xs = shift
-    return np.array([xs, ys])
+# Template matching (phase correlation of patches around the two ends, see `image_analysis/tracking.py`)
+def track_trial(image_folder):
+    # Frames are streamed from the TIFF files or the movie
+    with open_frames(image_folder, n_threads=decode_threads) as source:
+        # Shifts (x, y) between the first frame and subsequent frames, for both ends
+        tracker = PatchTracker(source[0], [(x1, y1), (x2, y2)], feature_size, sigma=sigma*1.6 if filter else None)
+        return tracker.track(source.prefetched(1, len(source)))
 
+def save_results(i, displacement):
+    # Project on cell axes
+    anterior_x, posterior_x = np.dot(displacement, normal_axis).T
+    anterior_y, posterior_y = np.dot(displacement, main_axis).T
 
-for i, image_folder in enumerate(trial_folders):
-    # Ordered list of all files
-    files = [f.path for f in os.scandir(image_folder) if f.name[-5:]=='.tiff']
-    files.sort()
-
-    anterior_x, anterior_y, posterior_x, posterior_y = [], [], [], []
-
-    reference_image = imageio.imread(files[0])
-    for file in files[1:]:
-        frame = imageio.imread(file)
-
-        # Filter
-        if filter:
-            frame = gaussian_filter(frame, sigma*1.6, truncate=2)
-
-        # Anterior
-        displacement = calculate_shift(x1, y1, frame)
-        # Project on cell axes
-        anterior_x.append(np.dot(displacement, normal_axis))
-        anterior_y.append(np.dot(displacement, main_axis))
-
-        # Posterior
-        displacement = calculate_shift(x2, y2, frame)
-        posterior_x.append(np.dot(displacement, normal_axis))
-        posterior_y.append(np.dot(displacement, main_axis))
-
-    # Save results
     output_filename = join(output_folder, 'tracked_ends{:05}.txt.gz'.format(i))
     M = np.array([anterior_x, anterior_y, posterior_x, posterior_y]).T
     header = 'anterior_x anterior_y posterior_x posterior_y'
@@ -103,3 +78,11 @@ for i, image_folder in enumerate(trial_folders):
 
     if ((i+1)%10 == 0):
         print(i+1,'/',len(trial_folders))
+
+if n_threads > 1:
+    with ThreadPoolExecutor(n_threads) as executor:
+        for i, displacement in enumerate(executor.map(track_trial, trial_folders)):
+            save_results(i, displacement)
+else:
+    for i, image_folder in enumerate(trial_folders):
+        save_results(i, track_trial(image_folder))